@@ -1,36 +1,99 @@
 import os
 from datetime import timedelta
 
-import bcrypt
 from flask import Flask, redirect, url_for, flash, request
+from jinja2 import FileSystemBytecodeCache
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 
+from auth import (
+    CachedUser, HashingBusy, configure_user_cache, configure_password_hasher, user_cache,
+    user_from_session, remember_user, forget_user, password_hasher, login_throttle,
+)
 from config import Config
 from models import db, User
+from startup import StartupTimer
+from tenancy import init_tenancy, prepare_database, tenant_from_host, current_tenant, SESSION_TENANT_KEY
 
 login_manager = LoginManager()
 
 
 def create_app():
+    timer = StartupTimer()
     app = Flask(__name__)
     app.config.from_object(Config)
     app.permanent_session_lifetime = timedelta(seconds=app.config['PERMANENT_SESSION_LIFETIME'])
+    if app.config['JINJA_BYTECODE_CACHE_DIR']:
+        # compiled templates survive restarts; see `flask precompile-templates`
+        os.makedirs(app.config['JINJA_BYTECODE_CACHE_DIR'], exist_ok=True)
+        app.jinja_options = {
+            **app.jinja_options,
+            'bytecode_cache': FileSystemBytecodeCache(app.config['JINJA_BYTECODE_CACHE_DIR']),
+        }
+    timer.mark('config')
 
     db.init_app(app)
     login_manager.init_app(app)
     login_manager.login_view = 'auth_login'
     login_manager.login_message = 'Пожалуйста, войдите в систему.'
     login_manager.login_message_category = 'warning'
+    configure_user_cache(app)
+    configure_password_hasher(app)
+    init_tenancy(app)
 
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    timer.mark('extensions')
 
     from routes_leads import leads_bp
     from routes_projects import projects_bp
     from routes_commissions import commissions_bp
+    from statements import statement_worker
+    from routes_tasks import tasks_bp
+    from routes_plan_templates import plan_templates_bp
+    from routes_calendar import calendar_bp
+    from routes_reminders import reminders_bp
+    from routes_api import api_bp
+    from routes_webhooks import webhooks_bp, init_webhooks
+    from routes_events import events_bp
+    from changefeed import change_feed
 
     app.register_blueprint(leads_bp)
     app.register_blueprint(projects_bp)
     app.register_blueprint(commissions_bp)
+    statement_worker.init_app(app)
+    app.register_blueprint(tasks_bp)
+    app.register_blueprint(plan_templates_bp)
+    app.register_blueprint(calendar_bp)
+    app.register_blueprint(reminders_bp)
+    app.register_blueprint(api_bp)
+    app.register_blueprint(webhooks_bp)
+    init_webhooks(app)
+    app.register_blueprint(events_bp)
+    change_feed.init_app(app)
+
+    from audit import init_audit
+    init_audit(app)
+
+    from stage_amounts import init_stage_amounts
+    init_stage_amounts(app)
+
+    from funnel import init_funnel, take_missed_snapshots, SNAPSHOT_JOB
+    init_funnel(app)
+
+    from scheduler import scheduler
+    scheduler.init_app(app)
+    from changefeed import prune_changes
+    scheduler.every('changefeed_prune', 3600, prune_changes)
+    scheduler.daily(SNAPSHOT_JOB, app.config['FUNNEL_SNAPSHOT_AT'], take_missed_snapshots)
+    if app.config['BACKUP_AT']:
+        from backup import create_restore_point
+        scheduler.daily('backup', app.config['BACKUP_AT'], create_restore_point)
+    if app.config['REMINDER_INTERVAL']:
+        from reminders import send_reminders
+        scheduler.every('reminders', app.config['REMINDER_INTERVAL'], send_reminders)
+
+    from commands import register_commands
+    register_commands(app)
+    timer.mark('blueprints')
 
     # --- Auth routes ---
 
@@ -49,34 +112,77 @@ def create_app():
 
     @login_manager.user_loader
     def load_user(user_id):
-        return db.session.get(User, int(user_id))
+        user_id = int(user_id)
+        user = user_cache.get(user_id)
+        if user is None:
+            user = user_from_session(user_id)
+            if user is not None:
+                user_cache.put(user)
+        if user is None:
+            db_user = db.session.get(User, user_id)
+            if db_user is None:
+                return None
+            user = CachedUser.from_user(db_user)
+            remember_user(user)
+        return user
 
     @app.route('/')
     @login_required
     def index():
         return redirect(url_for('leads.lead_list'))
 
+    def login_page(status=200):
+        # without a tenant in the host name the company is typed in on the login form
+        ask_tenant = app.config['MULTI_TENANT'] and tenant_from_host(request.host) is None
+        return render_template('login.html', ask_tenant=ask_tenant), status
+
     @app.route('/login', methods=['GET', 'POST'])
     def auth_login():
         if current_user.is_authenticated:
             return redirect(url_for('index'))
         if request.method == 'POST':
+            if app.config['MULTI_TENANT'] and current_tenant() is None:
+                flash('Компания не найдена.', 'danger')
+                return login_page()
             username = request.form.get('username', '').strip()
             password = request.form.get('password', '')
+            ip = request.remote_addr or ''
+            if login_throttle.is_blocked(username, ip):
+                flash('Слишком много неудачных попыток входа. Попробуйте позже.', 'danger')
+                return login_page(429)
             user = User.query.filter_by(username=username).first()
-            if user and bcrypt.checkpw(password.encode('utf-8'), user.password_hash.encode('utf-8')):
+            try:
+                valid = bool(user) and password_hasher.check(password, user.password_hash)
+            except HashingBusy:
+                flash('Сервер перегружен, попробуйте войти через минуту.', 'warning')
+                return login_page(503)
+            if valid:
+                login_throttle.reset(username)
+                if password_hasher.needs_rehash(user.password_hash):
+                    try:
+                        user.password_hash = password_hasher.hash(password)
+                        db.session.commit()
+                    except HashingBusy:
+                        pass
+                forget_user(user.id)
+                remember_user(CachedUser.from_user(user))
                 login_user(user)
+                if app.config['MULTI_TENANT']:
+                    session[SESSION_TENANT_KEY] = current_tenant()
                 if user.must_change_password:
                     return redirect(url_for('auth_change_password'))
                 next_page = request.args.get('next')
                 return redirect(next_page or url_for('index'))
+            login_throttle.record_failure(username, ip)
             flash('Неверный логин или пароль.', 'danger')
-        return render_template('login.html')
+        return login_page()
 
     @app.route('/logout')
     @login_required
     def auth_logout():
+        forget_user(current_user.id)
         logout_user()
+        session.pop(SESSION_TENANT_KEY, None)
         flash('Вы вышли из системы.', 'info')
         return redirect(url_for('auth_login'))
 
@@ -84,11 +190,23 @@ def create_app():
     @login_required
     def auth_change_password():
         if request.method == 'POST':
+            user = db.session.get(User, current_user.id)
             current_pw = request.form.get('current_password', '')
             new_pw = request.form.get('new_password', '')
             confirm_pw = request.form.get('confirm_password', '')
 
-            if not bcrypt.checkpw(current_pw.encode('utf-8'), current_user.password_hash.encode('utf-8')):
+            ip = request.remote_addr or ''
+            if login_throttle.is_blocked(user.username, ip):
+                flash('Слишком много неудачных попыток. Попробуйте позже.', 'danger')
+                return render_template('change_password.html'), 429
+
+            try:
+                valid = password_hasher.check(current_pw, user.password_hash)
+            except HashingBusy:
+                flash('Сервер перегружен, попробуйте через минуту.', 'warning')
+                return render_template('change_password.html'), 503
+            if not valid:
+                login_throttle.record_failure(user.username, ip)
                 flash('Текущий пароль неверен.', 'danger')
                 return render_template('change_password.html')
 
@@ -100,25 +218,29 @@ def create_app():
                 flash('Пароли не совпадают.', 'danger')
                 return render_template('change_password.html')
 
-            hashed = bcrypt.hashpw(new_pw.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
-            current_user.password_hash = hashed
-            current_user.must_change_password = False
+            try:
+                hashed = password_hasher.hash(new_pw)
+            except HashingBusy:
+                flash('Сервер перегружен, попробуйте через минуту.', 'warning')
+                return render_template('change_password.html'), 503
+            user.password_hash = hashed
+            user.must_change_password = False
             db.session.commit()
+            forget_user(user.id)
+            remember_user(CachedUser.from_user(user))
             flash('Пароль успешно изменён.', 'success')
             return redirect(url_for('index'))
 
         return render_template('change_password.html')
 
     # --- Initialize database and default admin ---
+    # (tenant databases are prepared the same way on their first request)
 
-    with app.app_context():
-        db.create_all()
-        admin = User.query.filter_by(username='admin').first()
-        if not admin:
-            hashed = bcrypt.hashpw(b'admin', bcrypt.gensalt()).decode('utf-8')
-            admin = User(username='admin', password_hash=hashed, must_change_password=True)
-            db.session.add(admin)
-            db.session.commit()
+    if not app.config['SKIP_DB_BOOTSTRAP']:
+        with app.app_context():
+            prepare_database(db.engine)
+    timer.mark('database')
+    timer.init_app(app)
 
     return app
 
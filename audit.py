@@ -0,0 +1,179 @@
+import json
+from datetime import date, datetime
+from decimal import Decimal
+
+from flask import has_request_context
+from flask_login import current_user
+from sqlalchemy import event, insert, inspect
+
+from models import (
+    db, Lead, ArchivedLead, Project, PaymentPlanItem, Variation, ExtraPaymentPlanItem,
+    ProjectTask, Document, AuditEvent,
+)
+from write_buffer import BatchWriter
+
+ENTITY_NAMES = {
+    Lead: 'lead',
+    ArchivedLead: 'lead',
+    Project: 'project',
+    PaymentPlanItem: 'payment',
+    Variation: 'variation',
+    ExtraPaymentPlanItem: 'extra_payment',
+    ProjectTask: 'task',
+    Document: 'document',
+}
+
+IGNORED_FIELDS = {'phone_key'}
+
+PENDING_KEY = 'audit_pending'
+
+
+def _plain(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+
+def _actor():
+    if has_request_context() and current_user.is_authenticated:
+        return current_user.id, current_user.username
+    return None, 'system'
+
+
+def _project_id(obj):
+    state = inspect(obj)
+    if isinstance(obj, Project):
+        return state.dict.get('id')
+    if isinstance(obj, ExtraPaymentPlanItem):
+        # resolved by the writer when the variation is not loaded
+        variation = state.dict.get('variation')
+        return getattr(variation, 'project_id', None)
+    return state.dict.get('project_id')
+
+
+def _changes(obj, action):
+    state = inspect(obj)
+    changes = {}
+    for attr in state.mapper.column_attrs:
+        if attr.key in IGNORED_FIELDS:
+            continue
+        if action in ('created', 'deleted'):
+            # read loaded values only, never emit SQL from inside a flush
+            value = state.dict.get(attr.key)
+            if value not in (None, ''):
+                changes[attr.key] = [None, _plain(value)] if action == 'created' else [_plain(value), None]
+            continue
+        hist = state.attrs[attr.key].history
+        if hist.has_changes():
+            old = hist.deleted[0] if hist.deleted else None
+            new = hist.added[0] if hist.added else None
+            if _plain(old) != _plain(new):
+                changes[attr.key] = [_plain(old), _plain(new)]
+    return changes
+
+
+def _event(entity, entity_id, project_id, action, changes):
+    user_id, username = _actor()
+    return {
+        'created_at': datetime.utcnow(),
+        'user_id': user_id,
+        'username': username,
+        'entity': entity,
+        'entity_id': entity_id,
+        'project_id': project_id,
+        'action': action,
+        'changes': json.dumps(changes, ensure_ascii=False, default=str),
+    }
+
+
+def _pending(session):
+    return session.info.setdefault(PENDING_KEY, [])
+
+
+def record(entity, entity_ids, action, changes=None, project_id=None):
+    """Queue events for writes that bypass the ORM (bulk UPDATE/DELETE, imports).
+
+    Like ORM changes, they are only written once the transaction commits.
+    """
+    pending = _pending(db.session())
+    for entity_id in entity_ids or [None]:
+        pending.append(_event(entity, entity_id, project_id, action, changes or {}))
+
+
+def record_owned(entity, owners, action, changes=None):
+    for entity_id, project_id in owners:
+        record(entity, [entity_id], action, changes, project_id=project_id)
+
+
+def _after_flush(session, flush_context):
+    pending = None
+    for objects, action in (
+        (session.new, 'created'),
+        (session.dirty, 'updated'),
+        (session.deleted, 'deleted'),
+    ):
+        for obj in objects:
+            entity = ENTITY_NAMES.get(type(obj))
+            if entity is None:
+                continue
+            if action == 'updated' and not session.is_modified(obj, include_collections=False):
+                continue
+            changes = _changes(obj, action)
+            if action == 'updated' and not changes:
+                continue
+            if pending is None:
+                pending = _pending(session)
+            pending.append(_event(entity, inspect(obj).dict.get('id'), _project_id(obj), action, changes))
+
+
+def _after_commit(session):
+    events = session.info.pop(PENDING_KEY, None)
+    if events:
+        audit_buffer.submit(events)
+
+
+def _after_rollback(session):
+    session.info.pop(PENDING_KEY, None)
+
+
+def write_events(events):
+    """Writer thread: resolve missing project ids and append the batch."""
+    missing = {e['entity_id'] for e in events if e['entity'] == 'extra_payment' and e['project_id'] is None}
+    if missing:
+        owners = dict(
+            db.session.query(ExtraPaymentPlanItem.id, Variation.project_id)
+            .join(Variation, ExtraPaymentPlanItem.variation_id == Variation.id)
+            .filter(ExtraPaymentPlanItem.id.in_(missing))
+        )
+        for e in events:
+            if e['entity'] == 'extra_payment' and e['project_id'] is None:
+                e['project_id'] = owners.get(e['entity_id'])
+    db.session.execute(insert(AuditEvent), events)
+    db.session.commit()
+
+
+audit_buffer = BatchWriter('audit', write_events)
+
+
+def init_audit(app):
+    audit_buffer.init_app(
+        app,
+        max_rows=app.config['AUDIT_FLUSH_MAX_ROWS'],
+        interval=app.config['AUDIT_FLUSH_INTERVAL_MS'] / 1000,
+        max_pending=app.config['AUDIT_BUFFER_MAX'],
+    )
+    if not event.contains(db.session, 'after_flush', _after_flush):
+        event.listen(db.session, 'after_flush', _after_flush)
+        event.listen(db.session, 'after_commit', _after_commit)
+        event.listen(db.session, 'after_rollback', _after_rollback)
+
+
+def history(entity=None, entity_id=None, project_id=None, limit=200):
+    query = AuditEvent.query
+    if project_id is not None:
+        query = query.filter(AuditEvent.project_id == project_id)
+    if entity is not None:
+        query = query.filter(AuditEvent.entity == entity, AuditEvent.entity_id == entity_id)
+    return query.order_by(AuditEvent.id.desc()).limit(limit).all()
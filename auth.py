@@ -0,0 +1,212 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+from flask import current_app, session
+from flask_login import UserMixin
+
+from tenancy import current_tenant
+
+SESSION_USER_KEY = '_auth_user'
+
+
+class CachedUser(UserMixin):
+    """Detached snapshot of the fields of ``User`` needed to serve a request."""
+
+    def __init__(self, id, username, must_change_password=False):
+        self.id = id
+        self.username = username
+        self.must_change_password = bool(must_change_password)
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(user.id, user.username, user.must_change_password)
+
+    def to_payload(self, ttl):
+        return {
+            'id': self.id,
+            'username': self.username,
+            'must_change_password': self.must_change_password,
+            'exp': int(time.time()) + ttl,
+        }
+
+
+class UserCache:
+    """Per-process LRU of ``CachedUser`` snapshots with a time-to-live.
+
+    Entries are keyed by ``(tenant, user id)``: ids repeat across tenant databases.
+    """
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        key = (current_tenant(), user_id)
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None:
+                return None
+            expires, user = entry
+            if expires < time.monotonic():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return user
+
+    def put(self, user):
+        key = (current_tenant(), user.id)
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, user)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._items.pop((current_tenant(), user_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+user_cache = UserCache()
+
+
+def configure_user_cache(app):
+    user_cache.maxsize = app.config['USER_CACHE_SIZE']
+    user_cache.ttl = app.config['USER_CACHE_TTL']
+
+
+def user_from_session(user_id):
+    """Rebuild the user from the signed session payload, if enabled and fresh."""
+    if not current_app.config['AUTH_SESSION_PAYLOAD']:
+        return None
+    payload = session.get(SESSION_USER_KEY)
+    if not payload or payload.get('id') != user_id or payload.get('exp', 0) < time.time():
+        return None
+    return CachedUser(payload['id'], payload['username'], payload['must_change_password'])
+
+
+def remember_user(user):
+    """Store the snapshot in the process cache and, if enabled, in the session."""
+    user_cache.put(user)
+    if current_app.config['AUTH_SESSION_PAYLOAD']:
+        session[SESSION_USER_KEY] = user.to_payload(current_app.config['AUTH_SESSION_PAYLOAD_TTL'])
+
+
+def forget_user(user_id):
+    user_cache.invalidate(user_id)
+    session.pop(SESSION_USER_KEY, None)
+
+
+# --- Password hashing ---
+
+class HashingBusy(Exception):
+    pass
+
+
+class PasswordHasher:
+    """Runs bcrypt on a bounded thread pool so bursts cannot starve request workers.
+
+    bcrypt releases the GIL, so hashing proceeds in parallel with request
+    handling while the number of concurrent (and queued) hashes stays capped.
+    """
+
+    def __init__(self, rounds=12, max_workers=2, max_pending=8, wait_timeout=5.0):
+        self._executor = None
+        self.configure(rounds, max_workers, max_pending, wait_timeout)
+
+    def configure(self, rounds, max_workers, max_pending, wait_timeout=5.0):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        self.rounds = rounds
+        self.wait_timeout = wait_timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='bcrypt')
+        self._slots = threading.BoundedSemaphore(max_workers + max_pending)
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(timeout=self.wait_timeout):
+            raise HashingBusy()
+        try:
+            return self._executor.submit(fn, *args).result()
+        finally:
+            self._slots.release()
+
+    def check(self, password, password_hash):
+        return self._run(bcrypt.checkpw, password.encode('utf-8'), password_hash.encode('utf-8'))
+
+    def hash(self, password):
+        salt = bcrypt.gensalt(self.rounds)
+        return self._run(bcrypt.hashpw, password.encode('utf-8'), salt).decode('utf-8')
+
+    def needs_rehash(self, password_hash):
+        try:
+            return int(password_hash.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+
+password_hasher = PasswordHasher()
+
+
+def configure_password_hasher(app):
+    password_hasher.configure(
+        app.config['BCRYPT_ROUNDS'],
+        app.config['BCRYPT_MAX_WORKERS'],
+        app.config['BCRYPT_MAX_PENDING'],
+    )
+    login_throttle.window = app.config['LOGIN_THROTTLE_WINDOW']
+    login_throttle.limits = {
+        'user': app.config['LOGIN_MAX_FAILURES_PER_USER'],
+        'ip': app.config['LOGIN_MAX_FAILURES_PER_IP'],
+    }
+
+
+# --- Login throttling ---
+
+class LoginThrottle:
+    """Counts recent failed logins per username and per client address."""
+
+    def __init__(self, window=300, limits=None):
+        self.window = window
+        self.limits = limits or {'user': 5, 'ip': 20}
+        self._failures = {}
+        self._lock = threading.Lock()
+
+    def _recent(self, key, now):
+        stamps = self._failures.get(key)
+        if not stamps:
+            return 0
+        while stamps and stamps[0] <= now - self.window:
+            stamps.popleft()
+        if not stamps:
+            del self._failures[key]
+            return 0
+        return len(stamps)
+
+    def is_blocked(self, username, ip):
+        now = time.monotonic()
+        with self._lock:
+            return (
+                self._recent(('user', username.lower()), now) >= self.limits['user']
+                or self._recent(('ip', ip), now) >= self.limits['ip']
+            )
+
+    def record_failure(self, username, ip):
+        now = time.monotonic()
+        with self._lock:
+            for key in (('user', username.lower()), ('ip', ip)):
+                self._failures.setdefault(key, deque()).append(now)
+
+    def reset(self, username):
+        with self._lock:
+            self._failures.pop(('user', username.lower()), None)
+
+
+login_throttle = LoginThrottle()
@@ -0,0 +1,177 @@
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import time
+from datetime import datetime
+
+from flask import current_app
+
+from models import db
+from tenancy import current_tenant, upload_folder
+
+log = logging.getLogger(__name__)
+
+MANIFEST = 'manifest.json'
+PARTIAL_SUFFIX = '.partial'
+
+
+class BackupError(Exception):
+    pass
+
+
+def database_path():
+    """File of the database the current app context (and tenant) works with."""
+    path = db.session.get_bind().url.database
+    if not path or path == ':memory:':
+        raise BackupError('only file-based SQLite databases can be backed up')
+    return path
+
+
+def copy_database(source, target, pages=256, sleep=0.05):
+    """Copy ``source`` into a new file ``target`` with SQLite's online backup API.
+
+    Pages are copied ``pages`` at a time and the source is unlocked for
+    ``sleep`` seconds between steps, so writers wait at most one step. A
+    write by another connection makes SQLite restart the copy, so the
+    result is always a single consistent state. Returns the page count.
+    """
+    total = 0
+
+    def progress(status, remaining, count):
+        nonlocal total
+        total = count
+
+    src = sqlite3.connect(source, timeout=30)
+    dst = sqlite3.connect(target)
+    try:
+        src.backup(dst, pages=pages, progress=progress, sleep=sleep)
+    finally:
+        dst.close()
+        src.close()
+    return total
+
+
+def check_integrity(path):
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        result = [row[0] for row in conn.execute('PRAGMA integrity_check')]
+    finally:
+        conn.close()
+    if result != ['ok']:
+        raise BackupError(f'integrity check failed for {path}: ' + '; '.join(result[:5]))
+
+
+def link_tree(source, target):
+    """Snapshot ``source`` into ``target`` with hard links (copies across filesystems).
+
+    Stored files are never rewritten in place, only replaced, so a link
+    keeps the content the file had when the snapshot was taken.
+    """
+    count = 0
+    for root, dirs, files in os.walk(source):
+        dest = os.path.join(target, os.path.relpath(root, source))
+        os.makedirs(dest, exist_ok=True)
+        for name in files:
+            src, dst = os.path.join(root, name), os.path.join(dest, name)
+            try:
+                os.link(src, dst)
+            except FileNotFoundError:
+                continue  # deleted while walking
+            except OSError:
+                shutil.copy2(src, dst)
+            count += 1
+    return count
+
+
+def backup_root():
+    root = current_app.config['BACKUP_DIR']
+    tenant = current_tenant()
+    return os.path.join(root, tenant) if tenant else root
+
+
+def restore_points(root=None):
+    """Complete restore points, newest first, as their manifests."""
+    root = root or backup_root()
+    if not os.path.isdir(root):
+        return []
+    points = []
+    for name in sorted(os.listdir(root), reverse=True):
+        manifest = os.path.join(root, name, MANIFEST)
+        if name.endswith(PARTIAL_SUFFIX) or not os.path.isfile(manifest):
+            continue
+        with open(manifest, encoding='utf-8') as f:
+            points.append(dict(json.load(f), name=name, path=os.path.join(root, name)))
+    return points
+
+
+def rotate(root, keep, partial_max_age=12 * 3600):
+    """Delete all but the ``keep`` newest restore points.
+
+    Unfinished ones are deleted once untouched for ``partial_max_age``
+    seconds; younger ones may still be written by another process.
+    """
+    removed = 0
+    for point in restore_points(root)[keep:]:
+        shutil.rmtree(point['path'])
+        removed += 1
+    cutoff = time.time() - partial_max_age
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if not name.endswith(PARTIAL_SUFFIX):
+            continue
+        try:
+            if os.path.getmtime(path) < cutoff:
+                shutil.rmtree(path, ignore_errors=True)
+        except FileNotFoundError:
+            pass  # finished or cleaned up meanwhile
+    return removed
+
+
+def create_restore_point():
+    """Back up the database and the upload folder into a new verified restore point.
+
+    Everything is written to ``<name>.partial`` and renamed when the copy
+    has passed ``PRAGMA integrity_check``, so any directory with a manifest
+    is a consistent point to restore from. Returns its manifest.
+    """
+    config = current_app.config
+    root = backup_root()
+    os.makedirs(root, exist_ok=True)
+    started = time.monotonic()
+    while True:
+        # microseconds keep backups started within the same second apart; names still sort by time
+        name = datetime.utcnow().strftime('%Y%m%d-%H%M%S-%f')
+        partial = os.path.join(root, name + PARTIAL_SUFFIX)
+        try:
+            os.mkdir(partial)
+            break
+        except FileExistsError:
+            continue
+    try:
+        db_file = os.path.join(partial, 'crm.db')
+        pages = copy_database(
+            database_path(), db_file, config['BACKUP_PAGES_PER_STEP'], config['BACKUP_STEP_SLEEP_MS'] / 1000,
+        )
+        check_integrity(db_file)
+        files = link_tree(upload_folder(), os.path.join(partial, 'uploads')) \
+            if os.path.isdir(upload_folder()) else 0
+        manifest = {
+            'created_at': datetime.utcnow().isoformat(timespec='seconds'),
+            'tenant': current_tenant(),
+            'database_pages': pages,
+            'database_bytes': os.path.getsize(db_file),
+            'upload_files': files,
+            'integrity': 'ok',
+            'seconds': round(time.monotonic() - started, 2),
+        }
+        with open(os.path.join(partial, MANIFEST), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+        os.rename(partial, os.path.join(root, name))
+    except Exception:
+        shutil.rmtree(partial, ignore_errors=True)
+        raise
+    rotate(root, config['BACKUP_KEEP'], config['BACKUP_PARTIAL_MAX_AGE'])
+    log.info('backup %s: %d pages, %d files in %.1f s', name, pages, files, manifest['seconds'])
+    return dict(manifest, name=name, path=os.path.join(root, name))
@@ -0,0 +1,184 @@
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import insert, text
+
+from models import db, ChangeLog
+from tenancy import TenantLocal, tenant_context
+
+log = logging.getLogger(__name__)
+
+OVERFLOW = object()
+
+
+def publish(entity, entity_ids, action, project_id=None):
+    """Record changes in the current transaction; they become visible on commit.
+
+    An empty ``entity_ids`` records a single change without an id, meaning
+    "many rows changed, reload".
+    """
+    rows = [
+        {'entity': entity, 'entity_id': eid, 'project_id': project_id, 'action': action}
+        for eid in (entity_ids or [None])
+    ]
+    db.session.execute(insert(ChangeLog), rows)
+
+
+def publish_owned(entity, owners, action):
+    """Publish changes for ``(entity id, project id)`` pairs, grouped by project."""
+    by_project = {}
+    for entity_id, project_id in owners:
+        by_project.setdefault(project_id, []).append(entity_id)
+    for project_id, ids in by_project.items():
+        publish(entity, ids, action, project_id=project_id)
+
+
+def latest_change_id():
+    return db.session.query(db.func.max(ChangeLog.id)).scalar() or 0
+
+
+def pruned_through():
+    """Highest change-log id that pruning may have removed (0 if none).
+
+    Every change with a larger id is still in the log.
+    """
+    oldest = db.session.query(db.func.min(ChangeLog.id)).scalar()
+    if oldest is not None:
+        return oldest - 1
+    # an empty log: everything up to the last id ever handed out is gone
+    seq = db.session.execute(text("SELECT seq FROM sqlite_sequence WHERE name = 'change_log'")).scalar()
+    return seq or 0
+
+
+def changes_since(after_id, limit=500):
+    return (
+        db.session.query(ChangeLog)
+        .filter(ChangeLog.id > after_id)
+        .order_by(ChangeLog.id)
+        .limit(limit)
+        .all()
+    )
+
+
+def change_to_dict(change):
+    return {
+        'id': change.id,
+        'entity': change.entity,
+        'entity_id': change.entity_id,
+        'project_id': change.project_id,
+        'action': change.action,
+    }
+
+
+class ChangeFeed:
+    """Per-process poller of ``ChangeLog`` that fans changes out to subscribers.
+
+    Every worker process runs one poller thread while it has subscribers, so
+    the number of queries does not grow with the number of open streams;
+    processes share nothing but the database table. In multi-tenant mode each
+    tenant has its own feed.
+    """
+
+    def __init__(self, poll_interval=1.0, tenant=None):
+        self.tenant = tenant
+        self.poll_interval = poll_interval
+        self.app = None
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._last_id = 0
+
+    def init_app(self, app):
+        self.app = app
+        self.poll_interval = app.config['CHANGEFEED_POLL_INTERVAL']
+
+    def subscribe(self):
+        q = queue.Queue(maxsize=1000)
+        with self._lock:
+            self._subscribers.add(q)
+            self._ensure_thread()
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subscribers.discard(q)
+
+    def _ensure_thread(self):
+        # called with self._lock held, so it cannot race the poller deciding to stop
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        # start where the caller's catch-up query ends, so nothing falls in between
+        self._last_id = latest_change_id()
+        self._thread = threading.Thread(target=self._run, name=f'changefeed-{self.tenant}' if self.tenant else 'changefeed', daemon=True)
+        self._thread.start()
+
+    def _poll(self):
+        with self.app.app_context(), tenant_context(self.tenant):
+            try:
+                changes = [change_to_dict(c) for c in changes_since(self._last_id)]
+                if changes:
+                    self._last_id = changes[-1]['id']
+                elif max(latest_change_id(), pruned_through()) < self._last_id:
+                    # ids went backwards (e.g. a database restored from a backup; pruning may
+                    # empty the table but never takes ids back): start over and tell the
+                    # clients to reload, their last ids mean nothing now
+                    log.warning('changefeed: change ids went back below %d, resetting', self._last_id)
+                    self._last_id = 0
+                    return [OVERFLOW]
+                return changes
+            finally:
+                db.session.remove()
+
+    def _run(self):
+        # polls only while someone listens, so an idle tenant's database can be closed
+        while True:
+            time.sleep(self.poll_interval)
+            with self._lock:
+                if not self._subscribers:
+                    self._thread = None
+                    return
+            try:
+                changes = self._poll()
+            except Exception:
+                log.exception('changefeed: polling failed')
+                continue
+            if not changes:
+                continue
+            with self._lock:
+                subscribers = list(self._subscribers)
+            for q in subscribers:
+                for change in changes:
+                    try:
+                        q.put_nowait(change)
+                        if change is OVERFLOW:
+                            break
+                    except queue.Full:
+                        # slow client: tell it to reload instead of buffering forever
+                        with q.mutex:
+                            q.queue.clear()
+                        q.put_nowait(OVERFLOW)
+                        break
+
+
+def prune_changes():
+    """Scheduler job: drop change-log rows older than ``CHANGEFEED_RETENTION``."""
+    cutoff = datetime.utcnow() - timedelta(seconds=current_app.config['CHANGEFEED_RETENTION'])
+    db.session.query(ChangeLog).filter(ChangeLog.created_at < cutoff).delete()
+    db.session.commit()
+
+
+def _tenant_feed(tenant):
+    feed = ChangeFeed(tenant=tenant or None)
+    if tenant:
+        feed.init_app(current_app._get_current_object())
+    return feed
+
+
+change_feed = TenantLocal(_tenant_feed)
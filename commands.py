@@ -0,0 +1,203 @@
+import sqlite3
+
+import click
+
+
+def register_commands(app):
+
+    @app.cli.command('import-leads')
+    @click.argument('path', type=click.Path(exists=True, dir_okay=False))
+    @click.option('--source', default='', help='Источник для строк без колонки источника.')
+    @click.option('--batch-size', default=5000, show_default=True)
+    def import_leads_command(path, source, batch_size):
+        """Import leads from a CSV or XLSX file."""
+        from lead_import import import_leads, iter_rows, ImportFormatError
+
+        with open(path, 'rb') as f:
+            try:
+                result = import_leads(iter_rows(f, path), default_source=source, batch_size=batch_size)
+            except ImportFormatError as e:
+                raise click.ClickException(str(e))
+        for row_num, message in result.errors:
+            click.echo(f'row {row_num}: {message}', err=True)
+        click.echo(
+            f'rows: {result.total}, inserted: {result.inserted}, '
+            f'duplicates: {result.duplicates}, failed: {result.failed}'
+        )
+
+    @app.cli.command('load-fx-rates')
+    @click.argument('path', required=False, type=click.Path(dir_okay=False))
+    def load_fx_rates_command(path):
+        """Load FX rates (date,currency,rate) from a CSV file, FX_RATES_FILE by default."""
+        from fx import load_rates, FxFormatError
+
+        path = path or app.config['FX_RATES_FILE']
+        try:
+            with open(path, 'rb') as f:
+                count = load_rates(f)
+        except OSError as e:
+            raise click.ClickException(str(e))
+        except FxFormatError as e:
+            raise click.ClickException(str(e))
+        click.echo(f'rates loaded: {count}')
+
+    @app.cli.command('archive-leads')
+    @click.option('--days', type=int, default=None, help='Возраст закрытых лидов (по умолчанию LEAD_ARCHIVE_AFTER_DAYS).')
+    @click.option('--batch-size', type=int, default=None)
+    def archive_leads_command(days, batch_size):
+        """Move old closed leads to the archive table."""
+        from lead_archive import archive_closed_leads
+
+        moved = archive_closed_leads(
+            days if days is not None else app.config['LEAD_ARCHIVE_AFTER_DAYS'],
+            batch_size or app.config['LEAD_ARCHIVE_BATCH_SIZE'],
+        )
+        click.echo(f'archived: {moved}')
+
+    @app.cli.command('recompute-stage-amounts')
+    def recompute_stage_amounts_command():
+        """Recompute the stored amount and commission of every payment stage."""
+        from models import db
+        from stage_amounts import refresh_stage_amounts
+
+        refresh_stage_amounts()
+        db.session.commit()
+        click.echo('done')
+
+    @app.cli.command('create-tenant')
+    @click.argument('name')
+    def create_tenant_command(name):
+        """Create the database and upload folder of a tenant (MULTI_TENANT mode).
+
+        Other commands work on a tenant when CRM_TENANT names it.
+        """
+        import os
+        from tenancy import TENANT_NAME, tenant_dir, tenant_engines
+
+        if not app.config['MULTI_TENANT']:
+            raise click.ClickException('MULTI_TENANT is off')
+        if not TENANT_NAME.match(name):
+            raise click.ClickException('tenant names are lowercase letters, digits, "-" and "_"')
+        os.makedirs(os.path.join(tenant_dir(name), 'uploads'), exist_ok=True)
+        tenant_engines.engine(name)
+        click.echo(f'tenant ready: {tenant_dir(name)}')
+
+    @app.cli.command('tenant-token')
+    @click.argument('name')
+    @click.option('--webhook', 'source', default=None, help='Источник лидов для токена вебхука.')
+    def tenant_token_command(name, source):
+        """Issue an API token (or a webhook token for --webhook SOURCE) that only opens tenant NAME."""
+        import json
+        import os
+        import secrets
+        from tenancy import TOKENS_FILE, tenant_dir, tenant_exists
+
+        if not app.config['MULTI_TENANT']:
+            raise click.ClickException('MULTI_TENANT is off; use API_TOKENS / WEBHOOK_TOKENS')
+        if not tenant_exists(name):
+            raise click.ClickException(f'no tenant {name}')
+        path = os.path.join(tenant_dir(name), TOKENS_FILE)
+        data = {'api': [], 'webhooks': {}}
+        if os.path.isfile(path):
+            with open(path, encoding='utf-8') as f:
+                data.update(json.load(f))
+        token = secrets.token_urlsafe(32)
+        if source:
+            data['webhooks'][source] = token
+        else:
+            data['api'].append(token)
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp, path)
+        click.echo(token)
+
+    @app.cli.command('init-db')
+    def init_db_command():
+        """Create or upgrade the schema and the admin user (needed with SKIP_DB_BOOTSTRAP=1)."""
+        from models import db
+        from tenancy import prepare_database
+
+        prepare_database(db.engine, force=True)
+        click.echo('database ready')
+
+    @app.cli.command('precompile-templates')
+    def precompile_templates_command():
+        """Compile every template into the bytecode cache (JINJA_BYTECODE_CACHE_DIR)."""
+        import time
+
+        if app.jinja_env.bytecode_cache is None:
+            raise click.ClickException('JINJA_BYTECODE_CACHE_DIR is not set')
+        started = time.perf_counter()
+        names = [n for n in app.jinja_env.list_templates() if n.endswith('.html')]
+        for name in names:
+            app.jinja_env.get_template(name)
+        click.echo(f'templates compiled: {len(names)} in {(time.perf_counter() - started) * 1000:.0f} ms')
+
+    @app.cli.command('funnel-snapshot')
+    @click.option('--day', default=None, help='День (YYYY-MM-DD, UTC), по умолчанию сегодня.')
+    def funnel_snapshot_command(day):
+        """Write the lead funnel snapshot of one day (the scheduler takes the past days after midnight)."""
+        from helpers import parse_date
+        from funnel import take_snapshot
+
+        parsed = parse_date(day)
+        if day and parsed is None:
+            raise click.ClickException('--day must be YYYY-MM-DD')
+        click.echo(f'snapshot rows: {take_snapshot(parsed)}')
+
+    @app.cli.command('backup')
+    def backup_command():
+        """Create a verified restore point of the database and uploads in BACKUP_DIR."""
+        from backup import create_restore_point, BackupError
+
+        try:
+            point = create_restore_point()
+        except (BackupError, OSError, sqlite3.Error) as e:
+            raise click.ClickException(str(e))
+        click.echo(
+            f"{point['path']}: {point['database_bytes']} bytes, {point['upload_files']} files, "
+            f"{point['seconds']} s"
+        )
+
+    @app.cli.command('backups')
+    def backups_command():
+        """List the restore points, newest first."""
+        from backup import restore_points
+
+        for point in restore_points():
+            click.echo(
+                f"{point['name']}  {point['database_bytes']:>12} bytes  {point['upload_files']:>6} files  "
+                f"integrity {point['integrity']}"
+            )
+
+    @app.cli.command('send-reminders')
+    def send_reminders_command():
+        """Queue reminder digests and deliver the outbox now (the scheduler does it every REMINDER_INTERVAL)."""
+        from reminders import send_reminders
+
+        queued, delivered = send_reminders()
+        click.echo(f'digests queued: {queued}, messages delivered: {delivered}')
+
+    @app.cli.command('commission-statements')
+    @click.option('--start', required=True, help='Начало периода оплат (YYYY-MM-DD).')
+    @click.option('--end', required=True, help='Конец периода оплат (YYYY-MM-DD).')
+    @click.option('--format', 'fmt', default='xlsx', show_default=True)
+    def commission_statements_command(start, end, fmt):
+        """Build the period statement and one per project paid in it (month-end run)."""
+        import time
+        from helpers import parse_date
+        from statements import available_formats, month_end_statements
+
+        start_date, end_date = parse_date(start), parse_date(end)
+        if start_date is None or end_date is None:
+            raise click.ClickException('--start and --end must be YYYY-MM-DD')
+        if fmt not in available_formats():
+            raise click.ClickException(f"format {fmt} is not available (have: {', '.join(available_formats())})")
+        started = time.perf_counter()
+        paths, failures = month_end_statements(fmt, start_date, end_date)
+        for spec, error in failures:
+            click.echo(f'failed {spec}: {error}', err=True)
+        click.echo(f'statements: {len(paths)} in {time.perf_counter() - started:.1f} s')
+        if failures:
+            raise SystemExit(1)
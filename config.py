@@ -10,5 +10,98 @@ class Config:
     UPLOAD_FOLDER = os.path.join(BASE_DIR, 'uploads')
     MAX_CONTENT_LENGTH = 50 * 1024 * 1024  # 50 MB
     ALLOWED_EXTENSIONS = {'pdf', 'doc', 'docx', 'xls', 'xlsx', 'png', 'jpg', 'jpeg'}
+    # '' (off), 'gzip' or 'zstd' (falls back to gzip without the zstandard package)
+    DOCUMENT_COMPRESSION = os.environ.get('DOCUMENT_COMPRESSION', '')
+    # docx/xlsx/png/jpg are already compressed containers
+    COMPRESSIBLE_EXTENSIONS = {'pdf', 'doc', 'xls'}
+    DOCUMENT_COMPRESSION_MIN_SAVING = 0.1  # keep the compressed copy only if it is 10% smaller
     PERMANENT_SESSION_LIFETIME = 3600  # 60 minutes
     PER_PAGE = 25
+    # Compiled templates are kept here across restarts ('' turns the cache off)
+    JINJA_BYTECODE_CACHE_DIR = os.environ.get('JINJA_BYTECODE_CACHE_DIR', os.path.join(BASE_DIR, '.jinja_cache'))
+    # Skip the schema check and admin bootstrap at startup (the deploy runs them once);
+    # even without it they are skipped while the schema fingerprint is unchanged
+    SKIP_DB_BOOTSTRAP = os.environ.get('SKIP_DB_BOOTSTRAP', '') == '1'
+    # One SQLite database and upload folder per tenant, under TENANT_ROOT/<name>/
+    MULTI_TENANT = os.environ.get('MULTI_TENANT', '') == '1'
+    TENANT_ROOT = os.environ.get('TENANT_ROOT', os.path.join(BASE_DIR, 'tenants'))
+    # Tenant from the host name: "<tenant>.TENANT_DOMAIN" or explicit "host:tenant,host:tenant";
+    # other hosts ask for the company on the login form
+    TENANT_DOMAIN = os.environ.get('TENANT_DOMAIN', '').lower()
+    TENANT_HOSTS = dict(
+        item.lower().split(':', 1) for item in os.environ.get('TENANT_HOSTS', '').split(',') if ':' in item
+    )
+    TENANT_ENGINE_CACHE_SIZE = 32  # tenant databases kept open per process
+    TENANT_IDLE_TIMEOUT = 600  # seconds before an unused tenant database is closed
+    LEAD_ARCHIVE_AFTER_DAYS = 180  # closed leads created earlier than this move to lead_archive
+    LEAD_ARCHIVE_BATCH_SIZE = 1000
+    # Daily jobs (funnel snapshot, ...) run in a background thread of each worker, once per day overall
+    SCHEDULER_ENABLED = os.environ.get('SCHEDULER_ENABLED', '1') == '1'
+    SCHEDULER_CHECK_INTERVAL = 60  # seconds
+    SCHEDULER_CLAIM_TIMEOUT = 3 * 3600  # seconds before an unfinished run (dead worker) is run again
+    FUNNEL_SNAPSHOT_AT = '00:05'  # UTC; snapshots the days up to yesterday
+    FUNNEL_BACKFILL_DAYS = 31  # days filled in when the snapshot job has never run
+    FUNNEL_DEFAULT_DAYS = 30
+    # Restore points (online copy of the database + hard-linked uploads), one folder each
+    BACKUP_DIR = os.environ.get('BACKUP_DIR', os.path.join(BASE_DIR, 'backups'))
+    BACKUP_AT = os.environ.get('BACKUP_AT', '02:30')  # UTC; '' disables the nightly backup
+    BACKUP_KEEP = int(os.environ.get('BACKUP_KEEP', 14))
+    BACKUP_PARTIAL_MAX_AGE = 12 * 3600  # seconds before an unfinished backup folder counts as abandoned
+    BACKUP_PAGES_PER_STEP = 256  # database pages copied while holding the read lock
+    BACKUP_STEP_SLEEP_MS = 50  # pause between steps so writers can get in
+    PAYMENT_TERMS_DAYS = 14  # an invoiced stage is overdue this many days after invoice_date
+    # Reminder digests (overdue/near deadlines, unpaid invoices) for users who opted in
+    REMINDER_INTERVAL = int(os.environ.get('REMINDER_INTERVAL', 900))  # seconds; 0 disables the sweep
+    REMINDER_LEAD_DAYS = 3  # tasks and project hand-overs this close are reminded of in advance
+    REMINDER_DIGEST_MAX_ITEMS = 50  # per section; the rest is only counted
+    # Links in digests; may contain {tenant}, e.g. https://{tenant}.crm.example.com ('' leaves them out)
+    APP_BASE_URL = os.environ.get('APP_BASE_URL', '')
+    # 'smtp', 'maildir' or '' (messages stay in the outbox table)
+    MAIL_TRANSPORT = os.environ.get('MAIL_TRANSPORT', '')
+    MAIL_FROM = os.environ.get('MAIL_FROM', 'crm@localhost')
+    MAIL_SMTP_HOST = os.environ.get('MAIL_SMTP_HOST', 'localhost')
+    MAIL_SMTP_PORT = int(os.environ.get('MAIL_SMTP_PORT', 1025))
+    MAIL_SMTP_STARTTLS = os.environ.get('MAIL_SMTP_STARTTLS', '') == '1'
+    MAIL_SMTP_USER = os.environ.get('MAIL_SMTP_USER', '')
+    MAIL_SMTP_PASSWORD = os.environ.get('MAIL_SMTP_PASSWORD', '')
+    MAIL_MAILDIR = os.environ.get('MAIL_MAILDIR', os.path.join(BASE_DIR, 'maildir'))
+    MAIL_MAX_ATTEMPTS = 5
+    FORECAST_MONTHS = 12
+    # Commission statements are built on a thread pool and cached per data version
+    STATEMENT_CACHE_DIR = os.environ.get('STATEMENT_CACHE_DIR', os.path.join(BASE_DIR, 'statement_cache'))
+    STATEMENT_WORKERS = int(os.environ.get('STATEMENT_WORKERS', 4))
+    STATEMENT_WAIT = 2  # seconds a download waits for the build before showing the "being prepared" page
+    # TTF font with Cyrillic glyphs for PDF statements (PDF is offered only when it exists)
+    STATEMENT_PDF_FONT = os.environ.get('STATEMENT_PDF_FONT', '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf')
+    # Portfolio totals are converted to this currency with the rates from FX_RATES_FILE
+    REPORTING_CURRENCY = os.environ.get('REPORTING_CURRENCY', 'AED')
+    FX_RATES_FILE = os.environ.get('FX_RATES_FILE', os.path.join(BASE_DIR, 'fx_rates.csv'))
+    FX_CHECK_INTERVAL = 60  # seconds between checks whether the rate table changed
+    CALENDAR_CHECK_INTERVAL = 5  # seconds an ICS feed is served from memory without checking for changes
+    USER_CACHE_SIZE = 1024
+    USER_CACHE_TTL = 300  # seconds a cached user is trusted without a DB read
+    # Carry the user fields in the signed session cookie, so auth needs no queries at all
+    AUTH_SESSION_PAYLOAD = os.environ.get('AUTH_SESSION_PAYLOAD', '') == '1'
+    AUTH_SESSION_PAYLOAD_TTL = 900
+    # Bearer tokens accepted by the JSON API (comma separated); with MULTI_TENANT each tenant
+    # has its own in <tenant>/tokens.json instead (see `flask tenant-token`)
+    API_TOKENS = [t for t in os.environ.get('API_TOKENS', '').split(',') if t]
+    # Inbound lead webhooks: "source:token,source:token"; the source is written to Lead.source
+    # (per tenant in <tenant>/tokens.json with MULTI_TENANT)
+    WEBHOOK_TOKENS = dict(
+        item.split(':', 1) for item in os.environ.get('WEBHOOK_TOKENS', '').split(',') if ':' in item
+    )
+    WEBHOOK_FLUSH_INTERVAL_MS = 200
+    WEBHOOK_FLUSH_MAX_ROWS = 500
+    WEBHOOK_BUFFER_MAX = 50000
+    CHANGEFEED_POLL_INTERVAL = 1.0  # seconds between change-log polls per worker
+    CHANGEFEED_RETENTION = 24 * 3600
+    AUDIT_FLUSH_INTERVAL_MS = 500
+    AUDIT_FLUSH_MAX_ROWS = 500
+    AUDIT_BUFFER_MAX = 100000
+    BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))  # hashes with another cost are upgraded on login
+    BCRYPT_MAX_WORKERS = int(os.environ.get('BCRYPT_MAX_WORKERS', 2))
+    BCRYPT_MAX_PENDING = 8
+    LOGIN_THROTTLE_WINDOW = 300  # seconds
+    LOGIN_MAX_FAILURES_PER_USER = 5
+    LOGIN_MAX_FAILURES_PER_IP = 20
@@ -0,0 +1,311 @@
+import csv
+import io
+import tempfile
+
+from flask import Response, send_file, stream_with_context
+from sqlalchemy import select, func, case
+
+from models import db, Lead, Project, PaymentPlanItem, Variation, ExtraPaymentPlanItem
+
+try:
+    import openpyxl
+except ImportError:  # optional dependency, only needed for .xlsx exports
+    openpyxl = None
+
+YIELD_PER = 1000
+
+
+# ======================== RESPONSES ========================
+
+def _iter_csv(header, rows):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    # BOM so that Excel opens the UTF-8 file with Cyrillic text correctly
+    buf.write('\ufeff')
+    writer.writerow(header)
+    for row in rows:
+        writer.writerow(row)
+        if buf.tell() > 64 * 1024:
+            yield buf.getvalue().encode('utf-8')
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue().encode('utf-8')
+
+
+def csv_response(filename, header, rows):
+    return Response(
+        stream_with_context(_iter_csv(header, rows)),
+        mimetype='text/csv',
+        headers={'Content-Disposition': f'attachment; filename={filename}.csv'},
+    )
+
+
+def xlsx_response(filename, header, rows):
+    # XLSX is a zip archive and cannot be streamed while it is being written;
+    # the write-only workbook keeps memory flat and spills rows to a temp file.
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(header)
+    for row in rows:
+        sheet.append(row)
+    tmp = tempfile.TemporaryFile()
+    workbook.save(tmp)
+    tmp.seek(0)
+    return send_file(
+        tmp,
+        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        as_attachment=True,
+        download_name=f'{filename}.xlsx',
+    )
+
+
+def export_response(fmt, filename, header, rows):
+    if fmt == 'xlsx' and openpyxl is not None:
+        return xlsx_response(filename, header, rows)
+    return csv_response(filename, header, rows)
+
+
+def _stream(stmt):
+    """Execute ``stmt`` and yield rows from a server-side cursor in chunks."""
+    result = db.session.execute(stmt.execution_options(yield_per=YIELD_PER))
+    try:
+        yield from result
+    finally:
+        result.close()
+
+
+def _date(d):
+    return d.strftime('%d.%m.%Y') if d else ''
+
+
+def _num(value):
+    return round(float(value or 0), 2)
+
+
+# ======================== AGGREGATES ========================
+
+def _amount(column):
+    """Sum of a minor-unit column as an amount."""
+    return func.coalesce(func.sum(column), 0) / 100.0
+
+
+def payment_totals_subquery():
+    """Per project: planned and paid percent, paid amount and commission of the contract plan."""
+    paid = PaymentPlanItem.invoice_status == 'paid'
+    return (
+        select(
+            PaymentPlanItem.project_id.label('project_id'),
+            func.sum(PaymentPlanItem.percent).label('percent_total'),
+            func.sum(case((paid, PaymentPlanItem.percent), else_=0)).label('paid_percent'),
+            _amount(case((paid, PaymentPlanItem.amount_minor))).label('paid_amount'),
+            _amount(case((paid, PaymentPlanItem.commission_minor))).label('paid_commission'),
+        )
+        .group_by(PaymentPlanItem.project_id)
+        .subquery()
+    )
+
+
+def variation_totals_subquery():
+    """Per project: variation amounts, and scheduled/paid amounts and commission of their stages."""
+    paid = ExtraPaymentPlanItem.invoice_status == 'paid'
+    stages = (
+        select(
+            Variation.project_id.label('project_id'),
+            _amount(ExtraPaymentPlanItem.amount_minor).label('stages_amount'),
+            _amount(case((paid, ExtraPaymentPlanItem.amount_minor))).label('paid_amount'),
+            _amount(ExtraPaymentPlanItem.commission_minor).label('stages_commission'),
+            _amount(case((paid, ExtraPaymentPlanItem.commission_minor))).label('paid_commission'),
+        )
+        .join(ExtraPaymentPlanItem, ExtraPaymentPlanItem.variation_id == Variation.id)
+        .group_by(Variation.project_id)
+        .subquery()
+    )
+    amounts = (
+        select(
+            Variation.project_id.label('project_id'),
+            func.sum(Variation.extra_amount).label('extra_amount'),
+        )
+        .group_by(Variation.project_id)
+        .subquery()
+    )
+    return amounts, stages
+
+
+def project_totals_select(project_ids):
+    """Project columns joined with payment, variation and commission aggregates."""
+    pay = payment_totals_subquery()
+    var_amounts, var_stages = variation_totals_subquery()
+    return (
+        select(
+            Project.id,
+            Project.project_name,
+            Project.client_name,
+            Project.location_text,
+            Project.status,
+            Project.contract_amount,
+            Project.currency,
+            Project.start_date,
+            Project.duration_days,
+            Project.commission_percent,
+            func.coalesce(pay.c.percent_total, 0).label('percent_total'),
+            func.coalesce(pay.c.paid_percent, 0).label('paid_percent'),
+            func.coalesce(pay.c.paid_amount, 0).label('paid_amount'),
+            func.coalesce(pay.c.paid_commission, 0).label('paid_commission'),
+            func.coalesce(var_amounts.c.extra_amount, 0).label('variations_amount'),
+            func.coalesce(var_stages.c.stages_amount, 0).label('variation_stages_amount'),
+            func.coalesce(var_stages.c.paid_amount, 0).label('variation_paid_amount'),
+            func.coalesce(var_stages.c.stages_commission, 0).label('variation_commission'),
+            func.coalesce(var_stages.c.paid_commission, 0).label('variation_paid_commission'),
+        )
+        .outerjoin(pay, pay.c.project_id == Project.id)
+        .outerjoin(var_amounts, var_amounts.c.project_id == Project.id)
+        .outerjoin(var_stages, var_stages.c.project_id == Project.id)
+        .where(Project.id.in_(project_ids))
+        .order_by(Project.id.desc())
+    )
+
+
+def portfolio_totals(project_ids, rate_of):
+    """Contract, payment and commission sums over ``project_ids`` in one currency.
+
+    ``rate_of(currency_column)`` returns the SQL conversion rate of a row; rows
+    whose currency has no rate are left out and listed in ``unconverted``.
+    """
+    t = project_totals_select(project_ids).order_by(None).subquery()
+    rate = rate_of(t.c.currency)
+    paid = t.c.paid_amount
+    commission_total = t.c.contract_amount * t.c.commission_percent / 100 + t.c.variation_commission
+    commission_received = t.c.paid_commission + t.c.variation_paid_commission
+    return db.session.execute(select(
+        func.count().label('projects'),
+        func.coalesce(func.sum(t.c.contract_amount * rate), 0).label('contract'),
+        func.coalesce(func.sum(t.c.variations_amount * rate), 0).label('variations'),
+        func.coalesce(func.sum((paid + t.c.variation_paid_amount) * rate), 0).label('paid'),
+        func.coalesce(func.sum(commission_total * rate), 0).label('commission_total'),
+        func.coalesce(func.sum(commission_received * rate), 0).label('commission_received'),
+        func.group_concat(func.distinct(case((rate.is_(None), t.c.currency)))).label('unconverted'),
+    )).one()
+
+
+def commission_figures(row):
+    """Same figures as ``commission_detail`` computed from one aggregated row."""
+    total = float(row.contract_amount or 0) * float(row.commission_percent or 0) / 100
+    received = float(row.paid_commission)
+    var_total = float(row.variation_commission)
+    received_var = float(row.variation_paid_commission)
+    grand_total = total + var_total
+    total_received = received + received_var
+    return {
+        'total': total,
+        'received': received,
+        'var_total': var_total,
+        'received_var': received_var,
+        'grand_total': grand_total,
+        'total_received': total_received,
+        'pending': grand_total - total_received,
+    }
+
+
+# ======================== ROWS ========================
+
+LEAD_HEADER = [
+    'ID', 'Дата', 'Имя клиента', 'Телефон', 'Локация', 'Описание запроса',
+    'Источник', 'Статус', 'Комментарий',
+]
+
+
+def lead_rows(stmt):
+    """Rows of ``stmt``, a select over the lead columns (see ``lead_archive.leads_select``)."""
+    for r in _stream(stmt):
+        yield [
+            r.id, r.created_at.strftime('%d.%m.%Y %H:%M') if r.created_at else '',
+            r.client_name, r.phone, r.location_text, r.request_description,
+            r.source, Lead.STATUS_LABELS.get(r.status, r.status), r.comment,
+        ]
+
+
+PROJECT_HEADER = [
+    'ID', 'Проект', 'Клиент', 'Локация', 'Статус', 'Сумма контракта', 'Валюта',
+    'Дата начала', 'Срок (дн.)', 'План оплат, %', 'Оплачено, %', 'Оплачено',
+    'Доп. работы', '% комиссии', 'Комиссия итого', 'Комиссия получено', 'Комиссия осталось',
+]
+
+
+def project_rows(project_ids):
+    for r in _stream(project_totals_select(project_ids)):
+        ca = float(r.contract_amount or 0)
+        c = commission_figures(r)
+        yield [
+            r.id, r.project_name, r.client_name, r.location_text,
+            Project.STATUS_LABELS.get(r.status, r.status),
+            _num(ca), r.currency, _date(r.start_date), r.duration_days or '',
+            _num(r.percent_total), _num(r.paid_percent), _num(r.paid_amount),
+            _num(r.variations_amount), _num(r.commission_percent),
+            _num(c['grand_total']), _num(c['total_received']), _num(c['pending']),
+        ]
+
+
+PAYMENT_HEADER = [
+    'ID проекта', 'Проект', 'Доп. работа', 'Этап', 'Процент', 'Сумма', 'Валюта',
+    'Условие', 'Статус', 'Дата счёта', 'Дата оплаты', 'Комиссия',
+]
+
+
+def payment_rows(project_ids):
+    contract = (
+        select(
+            Project.id.label('project_id'), Project.project_name, Project.currency,
+            db.literal('').label('variation_title'),
+            PaymentPlanItem.id.label('item_id'), PaymentPlanItem.title, PaymentPlanItem.percent,
+            PaymentPlanItem.amount_minor, PaymentPlanItem.commission_minor,
+            PaymentPlanItem.due_condition, PaymentPlanItem.invoice_status,
+            PaymentPlanItem.invoice_date, PaymentPlanItem.paid_date,
+            db.literal(0).label('kind'),
+        )
+        .join(PaymentPlanItem, PaymentPlanItem.project_id == Project.id)
+        .where(Project.id.in_(project_ids))
+    )
+    extra = (
+        select(
+            Project.id.label('project_id'), Project.project_name, Project.currency,
+            Variation.title.label('variation_title'),
+            ExtraPaymentPlanItem.id.label('item_id'), ExtraPaymentPlanItem.title,
+            ExtraPaymentPlanItem.percent,
+            ExtraPaymentPlanItem.amount_minor, ExtraPaymentPlanItem.commission_minor,
+            ExtraPaymentPlanItem.due_condition, ExtraPaymentPlanItem.invoice_status,
+            ExtraPaymentPlanItem.invoice_date, ExtraPaymentPlanItem.paid_date,
+            db.literal(1).label('kind'),
+        )
+        .join(Variation, Variation.project_id == Project.id)
+        .join(ExtraPaymentPlanItem, ExtraPaymentPlanItem.variation_id == Variation.id)
+        .where(Project.id.in_(project_ids))
+    )
+    union = contract.union_all(extra).subquery()
+    stmt = select(union).order_by(union.c.project_id.desc(), union.c.kind, union.c.item_id)
+    for r in _stream(stmt):
+        yield [
+            r.project_id, r.project_name, r.variation_title, r.title, _num(r.percent),
+            _num((r.amount_minor or 0) / 100), r.currency, r.due_condition,
+            PaymentPlanItem.STATUS_LABELS.get(r.invoice_status, r.invoice_status),
+            _date(r.invoice_date), _date(r.paid_date),
+            _num((r.commission_minor or 0) / 100),
+        ]
+
+
+COMMISSION_HEADER = [
+    'ID', 'Проект', 'Клиент', 'Сумма контракта', 'Валюта', '% комиссии',
+    'Комиссия по контракту', 'Получено по контракту',
+    'Комиссия по доп. работам', 'Получено по доп. работам',
+    'Итого комиссия', 'Итого получено', 'Осталось',
+]
+
+
+def commission_rows(project_ids):
+    for r in _stream(project_totals_select(project_ids)):
+        c = commission_figures(r)
+        yield [
+            r.id, r.project_name, r.client_name, _num(r.contract_amount), r.currency,
+            _num(r.commission_percent),
+            _num(c['total']), _num(c['received']), _num(c['var_total']), _num(c['received_var']),
+            _num(c['grand_total']), _num(c['total_received']), _num(c['pending']),
+        ]
@@ -0,0 +1,156 @@
+import threading
+from datetime import date, timedelta
+
+from flask import current_app
+from sqlalchemy import select
+
+from models import db, Project, PaymentPlanItem, Variation, ExtraPaymentPlanItem
+from changefeed import latest_change_id
+from fx import fx_rates, rate_expr
+from tenancy import TenantLocal
+
+SERIES = ('invoiced', 'planned', 'commission')
+
+
+def month_index(start, day):
+    """Months between the first month of the horizon and ``day``."""
+    return (day.year - start.year) * 12 + day.month - start.month
+
+
+def months(start, count):
+    result = []
+    year, month = start.year, start.month
+    for _ in range(count):
+        result.append(date(year, month, 1))
+        month += 1
+        if month > 12:
+            year, month = year + 1, 1
+    return result
+
+
+def _spread(begin, end, position):
+    """Date at ``position`` percent of the way from ``begin`` to ``end``."""
+    return begin + timedelta(days=round((end - begin).days * position / 100))
+
+
+def expected_date(status, invoice_date, terms, begin, end, position):
+    """When a stage that is not paid yet should bring money.
+
+    Invoiced stages are due ``terms`` after the invoice; the rest are placed on
+    the timeline at their cumulative percent of the plan. ``None`` when the
+    project has no schedule to place them on.
+    """
+    if status == 'invoiced' and invoice_date:
+        return invoice_date + terms
+    if begin and end:
+        return _spread(begin, max(begin, end), position)
+    return None
+
+
+def contract_stages():
+    return db.session.execute(
+        select(
+            Project.id.label('project_id'), Project.currency, Project.start_date, Project.duration_days,
+            PaymentPlanItem.amount_minor, PaymentPlanItem.commission_minor, PaymentPlanItem.percent, PaymentPlanItem.invoice_status, PaymentPlanItem.invoice_date,
+            rate_expr(Project.currency).label('rate'),
+        )
+        .join(PaymentPlanItem, PaymentPlanItem.project_id == Project.id)
+        .where(Project.status != 'cancelled')
+        .order_by(Project.id, PaymentPlanItem.id)
+    ).all()
+
+
+def variation_stages():
+    return db.session.execute(
+        select(
+            Variation.id.label('variation_id'), Project.currency, Project.start_date, Project.duration_days,
+            Variation.created_at, ExtraPaymentPlanItem.amount_minor, ExtraPaymentPlanItem.commission_minor,
+            ExtraPaymentPlanItem.percent, ExtraPaymentPlanItem.invoice_status,
+            ExtraPaymentPlanItem.invoice_date, rate_expr(Project.currency).label('rate'),
+        )
+        .join(Variation, Variation.project_id == Project.id)
+        .join(ExtraPaymentPlanItem, ExtraPaymentPlanItem.variation_id == Variation.id)
+        .where(Project.status != 'cancelled', Variation.status != 'draft')
+        .order_by(Variation.id, ExtraPaymentPlanItem.id)
+    ).all()
+
+
+def _with_total(series):
+    return dict(series, total=[a + b for a, b in zip(series['invoiced'], series['planned'])])
+
+
+def build_forecast(today, horizon, terms, reporting_currency):
+    """Expected receipts per currency and month, plus commission on them.
+
+    Every currency gets one list per series with ``horizon + 1`` slots: the
+    months from the current one on, and a last slot for stages that cannot
+    be placed on the calendar. Overdue amounts land in the current month.
+    ``reporting`` holds the same series summed over all currencies at
+    today's rates.
+    """
+    start = today.replace(day=1)
+    buckets = {}
+    reporting = {s: [0.0] * (horizon + 1) for s in SERIES}
+    unconverted = set()
+
+    def add(row, when):
+        series = buckets.setdefault(row.currency or '', {s: [0.0] * (horizon + 1) for s in SERIES})
+        slot = horizon if when is None else min(max(month_index(start, when), 0), horizon)
+        if slot == horizon and when is not None:
+            return  # beyond the horizon
+        kind = 'invoiced' if row.invoice_status == 'invoiced' else 'planned'
+        amount = (row.amount_minor or 0) / 100
+        commission = (row.commission_minor or 0) / 100
+        series[kind][slot] += amount
+        series['commission'][slot] += commission
+        if row.rate is None:
+            unconverted.add(row.currency or '')
+        else:
+            reporting[kind][slot] += amount * row.rate
+            reporting['commission'][slot] += commission * row.rate
+
+    def place(rows, key, begin_of):
+        owner, position = None, 0.0
+        for r in rows:
+            if getattr(r, key) != owner:
+                owner, position = getattr(r, key), 0.0
+            # paid stages are not forecast but still move later stages along the timeline
+            position += float(r.percent or 0)
+            if r.invoice_status == 'paid':
+                continue
+            end = r.start_date + timedelta(days=r.duration_days) if r.start_date and r.duration_days else None
+            when = expected_date(r.invoice_status, r.invoice_date, terms, begin_of(r), end, position)
+            add(r, when)
+
+    place(contract_stages(), 'project_id', lambda r: r.start_date)
+    place(variation_stages(), 'variation_id', lambda r: r.created_at.date() if r.created_at else r.start_date)
+
+    return {
+        'months': months(start, horizon),
+        'currencies': {currency: _with_total(series) for currency, series in sorted(buckets.items())},
+        'reporting_currency': reporting_currency,
+        'reporting': _with_total(reporting) if len(buckets) > 1 else None,
+        'unconverted': sorted(unconverted),
+    }
+
+
+_cache = TenantLocal(lambda tenant: {})
+_cache_lock = threading.Lock()
+
+
+def monthly_forecast():
+    """Forecast for today, rebuilt when the day, the change log or the FX rates move."""
+    today = date.today()
+    fx_rates.rates_on(today)
+    key = (today, latest_change_id(), fx_rates.version)
+    cache = _cache.get()
+    with _cache_lock:
+        if cache.get('key') == key:
+            return cache['value']
+    value = build_forecast(
+        today, current_app.config['FORECAST_MONTHS'], timedelta(days=current_app.config['PAYMENT_TERMS_DAYS']),
+        current_app.config['REPORTING_CURRENCY'],
+    )
+    with _cache_lock:
+        cache['key'], cache['value'] = key, value
+    return value
@@ -0,0 +1,224 @@
+from datetime import datetime, timedelta, time as dtime
+
+from flask import current_app, has_request_context
+from flask_login import current_user
+from sqlalchemy import event, select, insert, delete, func, case, union_all
+
+from models import db, Lead, ArchivedLead, LeadStatusChange, LeadFunnelSnapshot, JobRun
+
+PENDING_KEY = 'funnel_pending'
+SNAPSHOT_JOB = 'funnel_snapshot'
+
+STATUS_ORDER = list(Lead.STATUS_LABELS)
+
+
+def _user_id():
+    if has_request_context() and current_user.is_authenticated:
+        return current_user.id
+    return None
+
+
+def _change(lead_id, source, from_status, to_status, created_at):
+    return {
+        'lead_id': lead_id,
+        'source': source or '',
+        'from_status': from_status,
+        'to_status': to_status,
+        'lead_created_at': created_at,
+        'changed_at': datetime.utcnow(),
+        'user_id': _user_id(),
+    }
+
+
+# --- Capturing transitions ---
+
+def _after_flush(session, flush_context):
+    changes = []
+    for obj in session.dirty:
+        if not isinstance(obj, (Lead, ArchivedLead)):
+            continue
+        hist = db.inspect(obj).attrs.status.history
+        if not hist.has_changes() or not hist.deleted:
+            continue
+        old, new = hist.deleted[0], hist.added[0] if hist.added else None
+        if new is not None and old != new:
+            # loaded values only, never emit SQL from inside a flush
+            values = db.inspect(obj).dict
+            changes.append(_change(values.get('id'), values.get('source'), old, new, values.get('created_at')))
+    if changes:
+        session.info.setdefault(PENDING_KEY, []).extend(changes)
+
+
+def _after_flush_postexec(session, flush_context):
+    changes = session.info.pop(PENDING_KEY, None)
+    if changes:
+        session.connection().execute(insert(LeadStatusChange), changes)
+
+
+def record_status_changes(ids, new_status):
+    """Transitions for a bulk status UPDATE; call it before the UPDATE runs."""
+    rows = db.session.execute(
+        select(Lead.id, Lead.source, Lead.status, Lead.created_at)
+        .where(Lead.id.in_(ids), Lead.status != new_status)
+    ).all()
+    if rows:
+        db.session.execute(insert(LeadStatusChange), [
+            _change(r.id, r.source, r.status, new_status, r.created_at) for r in rows
+        ])
+
+
+def init_funnel(app):
+    if not event.contains(db.session, 'after_flush', _after_flush):
+        event.listen(db.session, 'after_flush', _after_flush)
+        event.listen(db.session, 'after_flush_postexec', _after_flush_postexec)
+
+
+# --- Daily snapshot ---
+
+def _all_leads():
+    return union_all(*[
+        select(m.id, func.coalesce(m.source, '').label('source'), m.status, m.created_at)
+        for m in (Lead, ArchivedLead)
+    ]).subquery()
+
+
+def take_snapshot(day=None):
+    """Replace the snapshot rows of ``day`` (UTC, today by default); returns how many were written.
+
+    ``lead_count`` is the number of leads in each status at the end of the
+    day (now, for today). ``entered_count`` counts leads created that day in
+    their first status plus the transitions of that day. Both are rebuilt
+    from the recorded transitions, so past days can be snapshotted later.
+    """
+    day = day or datetime.utcnow().date()
+    start = datetime.combine(day, dtime.min)
+    end = start + timedelta(days=1)
+    leads = _all_leads()
+    rows = {}
+
+    def row(status, source):
+        return rows.setdefault((status, source), {
+            'day': day, 'status': status, 'source': source,
+            'lead_count': 0, 'entered_count': 0, 'days_to_close_total': 0.0,
+        })
+
+    first_status = (
+        select(LeadStatusChange.from_status)
+        .where(LeadStatusChange.lead_id == leads.c.id)
+        .order_by(LeadStatusChange.id)
+        .limit(1)
+        .scalar_subquery()
+    )
+    initial = func.coalesce(first_status, leads.c.status)
+
+    if end > datetime.utcnow():
+        status_then = leads.c.status
+    else:
+        last_status = (
+            select(LeadStatusChange.to_status)
+            .where(LeadStatusChange.lead_id == leads.c.id, LeadStatusChange.changed_at < end)
+            .order_by(LeadStatusChange.id.desc())
+            .limit(1)
+            .scalar_subquery()
+        )
+        status_then = func.coalesce(last_status, initial)
+    for status, source, count in db.session.execute(
+        select(status_then, leads.c.source, func.count())
+        .where(leads.c.created_at < end)
+        .group_by(status_then, leads.c.source)
+    ):
+        row(status, source)['lead_count'] = count
+
+    for status, source, count in db.session.execute(
+        select(initial, leads.c.source, func.count())
+        .where(leads.c.created_at >= start, leads.c.created_at < end)
+        .group_by(initial, leads.c.source)
+    ):
+        row(status, source)['entered_count'] += count
+
+    source = func.coalesce(LeadStatusChange.source, '')
+    days_open = func.julianday(LeadStatusChange.changed_at) - func.julianday(LeadStatusChange.lead_created_at)
+    for status, src, count, days in db.session.execute(
+        select(
+            LeadStatusChange.to_status, source, func.count(),
+            func.coalesce(func.sum(case((LeadStatusChange.to_status == 'closed', days_open))), 0),
+        )
+        .where(LeadStatusChange.changed_at >= start, LeadStatusChange.changed_at < end)
+        .group_by(LeadStatusChange.to_status, source)
+    ):
+        r = row(status, src)
+        r['entered_count'] += count
+        r['days_to_close_total'] += days
+
+    db.session.execute(delete(LeadFunnelSnapshot).where(LeadFunnelSnapshot.day == day))
+    if rows:
+        db.session.execute(insert(LeadFunnelSnapshot), list(rows.values()))
+    db.session.commit()
+    return len(rows)
+
+
+def take_missed_snapshots():
+    """Scheduler job, right after midnight: snapshot every day since the last run up to yesterday.
+
+    The day the last run happened on is taken again, since a snapshot taken
+    during a day only covers part of it. Without a previous run, up to
+    ``FUNNEL_BACKFILL_DAYS`` days are filled in.
+    """
+    today = datetime.utcnow().date()
+    first = today - timedelta(days=current_app.config['FUNNEL_BACKFILL_DAYS'])
+    last_run = db.session.scalar(
+        select(func.max(JobRun.run_on))
+        .where(JobRun.job == SNAPSHOT_JOB, JobRun.finished_at.isnot(None), JobRun.run_on < today)
+    )
+    day = max(first, last_run) if last_run else first
+    count = 0
+    while day < today:
+        count += take_snapshot(day)
+        day += timedelta(days=1)
+    return count
+
+
+# --- Reports (read the snapshot table only) ---
+
+def snapshot_sources(start, end):
+    return list(db.session.scalars(
+        select(LeadFunnelSnapshot.source).where(LeadFunnelSnapshot.day.between(start, end))
+        .distinct().order_by(LeadFunnelSnapshot.source)
+    ))
+
+
+def funnel_report(start, end, source=None):
+    """Funnel, conversion by source and daily stock for ``start``..``end``."""
+    conditions = [LeadFunnelSnapshot.day.between(start, end)]
+    if source is not None:
+        conditions.append(LeadFunnelSnapshot.source == source)
+    snap = LeadFunnelSnapshot
+
+    by_source = {}
+    for src, status, entered, days in db.session.execute(
+        select(snap.source, snap.status, func.sum(snap.entered_count), func.sum(snap.days_to_close_total))
+        .where(*conditions).group_by(snap.source, snap.status)
+    ):
+        entry = by_source.setdefault(src, {'entered': {s: 0 for s in STATUS_ORDER}, 'close_days': 0.0})
+        entry['entered'][status] = entered
+        entry['close_days'] += days or 0
+
+    funnel = {s: sum(e['entered'].get(s, 0) for e in by_source.values()) for s in STATUS_ORDER}
+    conversion = []
+    for src, entry in sorted(by_source.items()):
+        new, closed = entry['entered'].get('new', 0), entry['entered'].get('closed', 0)
+        conversion.append({
+            'source': src,
+            'entered': entry['entered'],
+            'conversion': closed / new * 100 if new else None,
+            'days_to_close': entry['close_days'] / closed if closed else None,
+        })
+
+    stock = {}
+    for day, status, count in db.session.execute(
+        select(snap.day, snap.status, func.sum(snap.lead_count))
+        .where(*conditions).group_by(snap.day, snap.status).order_by(snap.day)
+    ):
+        stock.setdefault(day, {s: 0 for s in STATUS_ORDER})[status] = count
+
+    return {'funnel': funnel, 'conversion': conversion, 'stock': stock}
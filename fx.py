@@ -0,0 +1,150 @@
+import bisect
+import csv
+import io
+import threading
+import time
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+
+from flask import current_app
+from sqlalchemy import case, func, literal
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from models import db, FxRate
+from tenancy import TenantLocal
+
+DATE_FORMATS = ('%Y-%m-%d', '%d.%m.%Y')
+
+
+class FxFormatError(ValueError):
+    pass
+
+
+def normalize_currency(value):
+    return (value or '').strip().upper()
+
+
+def _parse_date(value):
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(value.strip(), fmt).date()
+        except ValueError:
+            continue
+    raise FxFormatError(f'некорректная дата «{value}»')
+
+
+def parse_rates(stream):
+    """Yield ``(currency, date, rate)`` from a ``date,currency,rate`` CSV file."""
+    reader = csv.reader(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+    header = [h.strip().lower() for h in next(reader, [])]
+    try:
+        columns = [header.index(name) for name in ('date', 'currency', 'rate')]
+    except ValueError:
+        raise FxFormatError('ожидаются колонки date, currency, rate')
+    for row_num, row in enumerate(reader, start=2):
+        if not any(cell.strip() for cell in row):
+            continue
+        try:
+            day, currency, rate = (row[i] for i in columns)
+            rate = Decimal(rate.strip().replace(',', '.'))
+        except (IndexError, InvalidOperation):
+            raise FxFormatError(f'строка {row_num}: некорректный курс')
+        if rate <= 0:
+            raise FxFormatError(f'строка {row_num}: курс должен быть больше нуля')
+        try:
+            yield normalize_currency(currency), _parse_date(day), rate
+        except FxFormatError as e:
+            raise FxFormatError(f'строка {row_num}: {e}')
+
+
+def load_rates(stream, batch_size=1000):
+    """Insert or update rates from a CSV file; returns the number of rows read."""
+    stmt = sqlite_insert(FxRate)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['currency', 'rate_date'], set_={'rate': stmt.excluded.rate},
+    )
+    count = 0
+    batch = []
+    for currency, day, rate in parse_rates(stream):
+        batch.append({'currency': currency, 'rate_date': day, 'rate': rate})
+        if len(batch) >= batch_size:
+            db.session.execute(stmt, batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        db.session.execute(stmt, batch)
+        count += len(batch)
+    db.session.commit()
+    fx_rates.invalidate()
+    return count
+
+
+class FxRates:
+    """In-memory copy of ``FxRate``: per currency, dates in order and their rates.
+
+    The table is re-read only when its fingerprint changes (row count, largest
+    id and sums of the rates, so a corrected rate that keeps its row id is
+    noticed too), which is checked at most every ``FX_CHECK_INTERVAL`` seconds.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rates = {}
+        self._checked = 0
+        self.version = None
+
+    def invalidate(self):
+        with self._lock:
+            self._checked = 0
+            self.version = None
+
+    def _refresh(self):
+        if time.monotonic() - self._checked < current_app.config['FX_CHECK_INTERVAL']:
+            return
+        version = tuple(db.session.query(
+            func.count(FxRate.id), func.max(FxRate.id),
+            func.total(FxRate.rate), func.total(FxRate.rate * FxRate.id),
+        ).one())
+        if version != self.version:
+            rates = {}
+            query = db.session.query(FxRate.currency, FxRate.rate_date, FxRate.rate) \
+                .order_by(FxRate.currency, FxRate.rate_date)
+            for currency, day, rate in query:
+                dates, values = rates.setdefault(currency, ([], []))
+                dates.append(day)
+                values.append(float(rate))
+            self._rates = rates
+            self.version = version
+        self._checked = time.monotonic()
+
+    def rates_on(self, day):
+        """``{currency: rate}`` in effect on ``day``, including the reporting currency itself."""
+        with self._lock:
+            self._refresh()
+            result = {}
+            for currency, (dates, values) in self._rates.items():
+                i = bisect.bisect_right(dates, day) - 1
+                if i >= 0:
+                    result[currency] = values[i]
+        result[normalize_currency(current_app.config['REPORTING_CURRENCY'])] = 1.0
+        return result
+
+    def rate(self, currency, day=None):
+        return self.rates_on(day or date.today()).get(normalize_currency(currency))
+
+
+fx_rates = TenantLocal(lambda tenant: FxRates())
+
+
+def rate_expr(currency_column, day=None):
+    """SQL expression giving the rate of ``currency_column`` on ``day`` (NULL if unknown).
+
+    Rates come from the in-memory cache and are inlined as a CASE, so the
+    aggregation query converts amounts itself without joining the rate table.
+    """
+    rates = fx_rates.rates_on(day or date.today())
+    return case(
+        {currency: literal(rate) for currency, rate in rates.items()},
+        value=func.upper(func.trim(currency_column)),
+        else_=None,
+    )
@@ -0,0 +1,53 @@
+from datetime import datetime
+
+from flask import request, redirect
+
+
+def selected_ids():
+    """Ids of the rows ticked in a multi-select form."""
+    return [int(i) for i in request.form.getlist('ids') if i.isdigit()]
+
+
+def parse_date(s):
+    if not s:
+        return None
+    try:
+        return datetime.strptime(s, '%Y-%m-%d').date()
+    except ValueError:
+        return None
+
+
+def redirect_back(default):
+    """Redirect to the local ``next`` form field, falling back to ``default``."""
+    next_page = request.form.get('next', '')
+    if next_page.startswith('/') and not next_page.startswith('//'):
+        return redirect(next_page)
+    return redirect(default)
+
+
+class ListPagination:
+    """Same interface as Flask-SQLAlchemy's pagination for pages built by hand."""
+
+    def __init__(self, items, total, page, per_page):
+        self.items = items
+        self.total = total
+        self.page = page
+        self.per_page = per_page
+        self.pages = max(1, (total + per_page - 1) // per_page)
+        self.has_prev = page > 1
+        self.has_next = page < self.pages
+        self.prev_num = page - 1
+        self.next_num = page + 1
+
+    def iter_pages(self, left_edge=2, left_current=2, right_current=3, right_edge=2):
+        last = 0
+        for num in range(1, self.pages + 1):
+            if (
+                num <= left_edge
+                or (self.page - left_current <= num <= self.page + right_current)
+                or num > self.pages - right_edge
+            ):
+                if last + 1 != num:
+                    yield None
+                yield num
+                last = num
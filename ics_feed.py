@@ -0,0 +1,205 @@
+import hashlib
+import threading
+import time
+from datetime import timedelta
+
+from flask import current_app
+from sqlalchemy import select
+
+from models import db, User, Project, ProjectTask, PaymentPlanItem, Variation, ExtraPaymentPlanItem
+from changefeed import latest_change_id, changes_since, pruned_through
+from tenancy import TenantLocal
+
+MAX_INCREMENTAL_CHANGES = 500
+# change-log entities that show up in the calendar
+CALENDAR_ENTITIES = ('project', 'task', 'payment', 'extra_payment', 'variation')
+
+HEADER = (
+    'BEGIN:VCALENDAR\r\n'
+    'VERSION:2.0\r\n'
+    'PRODID:-//CRM//Calendar//RU\r\n'
+    'CALSCALE:GREGORIAN\r\n'
+    'X-WR-CALNAME:CRM\r\n'
+).encode('utf-8')
+FOOTER = b'END:VCALENDAR\r\n'
+
+
+def _escape(text):
+    return (
+        (text or '').replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,')
+        .replace('\r\n', '\\n').replace('\n', '\\n')
+    )
+
+
+def _fold(line):
+    """Split a content line into 75-octet chunks as RFC 5545 requires."""
+    raw = line.encode('utf-8')
+    if len(raw) <= 75:
+        return raw + b'\r\n'
+    parts = []
+    limit = 75
+    while raw:
+        cut = min(limit, len(raw))
+        # never split a multi-byte UTF-8 sequence
+        while cut < len(raw) and (raw[cut] & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(raw[:cut])
+        raw = raw[cut:]
+        limit = 74  # continuation lines start with a space
+    return b'\r\n '.join(parts) + b'\r\n'
+
+
+def vevent(uid, day, summary, description='', url=''):
+    """All-day event; DTSTAMP is derived from the date so output is reproducible."""
+    lines = [
+        'BEGIN:VEVENT',
+        f'UID:{uid}@crm',
+        f'DTSTAMP:{day.strftime("%Y%m%d")}T000000Z',
+        f'DTSTART;VALUE=DATE:{day.strftime("%Y%m%d")}',
+        f'DTEND;VALUE=DATE:{(day + timedelta(days=1)).strftime("%Y%m%d")}',
+        f'SUMMARY:{_escape(summary)}',
+    ]
+    if description:
+        lines.append(f'DESCRIPTION:{_escape(description)}')
+    if url:
+        lines.append(f'URL:{url}')
+    lines.append('END:VEVENT')
+    return b''.join(_fold(line) for line in lines)
+
+
+def render_projects(project_ids=None):
+    """Serialized VEVENTs grouped by project, for all projects or only ``project_ids``."""
+    terms = timedelta(days=current_app.config['PAYMENT_TERMS_DAYS'])
+    blocks = {}
+
+    def scope(column):
+        return [] if project_ids is None else [column.in_(project_ids)]
+
+    projects = db.session.execute(
+        select(Project.id, Project.project_name, Project.start_date, Project.duration_days, Project.status)
+        .where(*scope(Project.id))
+    ).all()
+    for p in projects:
+        blocks[p.id] = []
+        if p.start_date and p.duration_days and p.status not in ('completed', 'cancelled'):
+            blocks[p.id].append(vevent(
+                f'project-end-{p.id}', p.start_date + timedelta(days=p.duration_days),
+                f'Сдача проекта: {p.project_name}',
+            ))
+
+    tasks = db.session.execute(
+        select(ProjectTask.id, ProjectTask.project_id, ProjectTask.title, ProjectTask.description,
+               ProjectTask.deadline_date)
+        .where(ProjectTask.status == 'open', ProjectTask.deadline_date.isnot(None), *scope(ProjectTask.project_id))
+        .order_by(ProjectTask.id)
+    ).all()
+    names = {p.id: p.project_name for p in projects}
+    for t in tasks:
+        blocks[t.project_id].append(vevent(
+            f'task-{t.id}', t.deadline_date, f'{t.title} — {names[t.project_id]}', t.description,
+        ))
+
+    payments = db.session.execute(
+        select(PaymentPlanItem.id, PaymentPlanItem.project_id, PaymentPlanItem.title, PaymentPlanItem.invoice_date)
+        .where(PaymentPlanItem.invoice_status == 'invoiced', PaymentPlanItem.invoice_date.isnot(None),
+               *scope(PaymentPlanItem.project_id))
+        .order_by(PaymentPlanItem.id)
+    ).all()
+    for i in payments:
+        blocks[i.project_id].append(vevent(
+            f'payment-{i.id}', i.invoice_date + terms, f'Ожидается оплата: {i.title} — {names[i.project_id]}',
+        ))
+
+    extras = db.session.execute(
+        select(ExtraPaymentPlanItem.id, Variation.project_id, ExtraPaymentPlanItem.title,
+               ExtraPaymentPlanItem.invoice_date, Variation.title.label('variation_title'))
+        .join(Variation, Variation.id == ExtraPaymentPlanItem.variation_id)
+        .where(ExtraPaymentPlanItem.invoice_status == 'invoiced', ExtraPaymentPlanItem.invoice_date.isnot(None),
+               *scope(Variation.project_id))
+        .order_by(ExtraPaymentPlanItem.id)
+    ).all()
+    for i in extras:
+        blocks[i.project_id].append(vevent(
+            f'extra-payment-{i.id}', i.invoice_date + terms,
+            f'Ожидается оплата: {i.title} ({i.variation_title}) — {names[i.project_id]}',
+        ))
+
+    return {pid: b''.join(events) for pid, events in blocks.items()}
+
+
+class CalendarFeed:
+    """Pre-serialized ICS body kept in sync with the change log.
+
+    Events are cached per project. When the change counter moves, only the
+    projects named in the new ``ChangeLog`` rows are re-rendered; polls in
+    between are answered from memory without touching the database.
+    Everything is re-rendered when changes since the last check may have
+    been pruned already, and at least once per ``CHANGEFEED_RETENTION``.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._blocks = None
+        self._rendered = 0
+        self._last_id = 0
+        self._checked = 0
+        self._tokens = {}
+        self.body = b''
+        self.etag = ''
+
+    def current(self):
+        """Return ``(body, etag)``, refreshing at most every ``CALENDAR_CHECK_INTERVAL`` seconds."""
+        with self._lock:
+            if self._blocks is not None and time.monotonic() - self._checked < current_app.config['CALENDAR_CHECK_INTERVAL']:
+                return self.body, self.etag
+            latest = latest_change_id()
+            stale = (
+                self._blocks is None or latest < self._last_id
+                or time.monotonic() - self._rendered > current_app.config['CHANGEFEED_RETENTION']
+            )
+            if not stale and latest != self._last_id:
+                # pruned changes cannot tell which projects they touched
+                stale = pruned_through() > self._last_id
+            if not stale and latest != self._last_id:
+                changes = changes_since(self._last_id, limit=MAX_INCREMENTAL_CHANGES + 1)
+                # a change without a project means "many rows changed"
+                stale = len(changes) > MAX_INCREMENTAL_CHANGES or any(
+                    c.project_id is None and c.entity in CALENDAR_ENTITIES for c in changes
+                )
+                if not stale:
+                    affected = {c.project_id for c in changes if c.entity in CALENDAR_ENTITIES}
+                    if affected:
+                        for pid in affected:
+                            self._blocks.pop(pid, None)
+                        self._blocks.update(render_projects(affected))
+            if stale:
+                self._blocks = render_projects()
+                self._rendered = time.monotonic()
+                self.etag = ''
+            if latest != self._last_id or not self.etag:
+                self.body = HEADER + b''.join(self._blocks[pid] for pid in sorted(self._blocks)) + FOOTER
+                self.etag = hashlib.sha1(self.body).hexdigest()
+            self._last_id = latest
+            self._checked = time.monotonic()
+            return self.body, self.etag
+
+    def user_for_token(self, token):
+        """Id of the user owning ``token``; lookups are cached for ``USER_CACHE_TTL`` seconds."""
+        now = time.monotonic()
+        with self._lock:
+            cached = self._tokens.get(token)
+            if cached and cached[1] > now:
+                return cached[0]
+        user_id = db.session.query(User.id).filter(User.calendar_token == token).scalar()
+        with self._lock:
+            if len(self._tokens) > 10000:
+                self._tokens.clear()
+            self._tokens[token] = (user_id, now + current_app.config['USER_CACHE_TTL'])
+        return user_id
+
+    def forget_token(self, token):
+        with self._lock:
+            self._tokens.pop(token, None)
+
+
+calendar_feed = TenantLocal(lambda tenant: CalendarFeed())
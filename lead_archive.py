@@ -0,0 +1,125 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, insert, delete, func, literal, or_, union_all, text
+
+from models import db, Lead, ArchivedLead
+from changefeed import publish
+from audit import record
+
+LEAD_COLUMNS = [c.name for c in Lead.__table__.columns]
+
+
+def _move(source, target, ids, extra=None):
+    """Copy rows ``ids`` from ``source`` to ``target`` and delete them from ``source``."""
+    extra = extra or {}
+    columns = LEAD_COLUMNS + list(extra)
+    rows = select(*[source.__table__.c[c] for c in LEAD_COLUMNS], *[literal(v) for v in extra.values()]) \
+        .where(source.id.in_(ids))
+    db.session.execute(insert(target).from_select(columns, rows))
+    db.session.execute(delete(source).where(source.id.in_(ids)), execution_options={'synchronize_session': False})
+
+
+def reserve_archived_ids(connection=None):
+    """Keep new lead ids above every archived one.
+
+    ``lead`` is AUTOINCREMENT, but a database upgraded from before that may
+    have a sequence below ids that already sit in the archive.
+    """
+    conn = connection or db.session.connection()
+    top = conn.execute(select(func.max(ArchivedLead.id))).scalar()
+    if not top:
+        return
+    params = {'name': Lead.__tablename__, 'top': top}
+    updated = conn.execute(
+        text('UPDATE sqlite_sequence SET seq = :top WHERE name = :name AND seq < :top'), params
+    ).rowcount
+    if not updated:
+        conn.execute(text(
+            'INSERT INTO sqlite_sequence (name, seq) SELECT :name, :top '
+            'WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = :name)'
+        ), params)
+
+
+def archive_closed_leads(older_than_days, batch_size=1000):
+    """Move closed leads created more than ``older_than_days`` ago to ``lead_archive``.
+
+    Works in batches of ``batch_size``, one transaction each, so the writer
+    lock is released between them. Returns the number of leads moved.
+    """
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    reserve_archived_ids()
+    moved = 0
+    while True:
+        ids = [i for (i,) in db.session.execute(
+            select(Lead.id)
+            .where(Lead.status == 'closed', Lead.created_at < cutoff)
+            .order_by(Lead.id)
+            .limit(batch_size)
+        )]
+        if not ids:
+            return moved
+        _move(Lead, ArchivedLead, ids, {'archived_at': datetime.utcnow()})
+        publish('lead', ids, 'archived')
+        record('lead', ids, 'archived')
+        db.session.commit()
+        moved += len(ids)
+
+
+def restore_leads(ids):
+    """Move the archived leads among ``ids`` back to the ``lead`` table."""
+    archived = [i for (i,) in db.session.execute(select(ArchivedLead.id).where(ArchivedLead.id.in_(ids)))]
+    if archived:
+        _move(ArchivedLead, Lead, archived)
+        publish('lead', archived, 'created')
+        record('lead', archived, 'restored')
+    return archived
+
+
+def restore_lead(lead_id):
+    """Move an archived lead back to the ``lead`` table and return it."""
+    archived = db.session.get(ArchivedLead, lead_id)
+    if archived is not None:
+        # the row is moved with Core statements; drop the stale archive object
+        db.session.expunge(archived)
+    restore_leads([lead_id])
+    return db.session.get(Lead, lead_id)
+
+
+def find_lead(lead_id):
+    """The lead with ``lead_id`` from the hot table or, failing that, the archive."""
+    return db.session.get(Lead, lead_id) or db.session.get(ArchivedLead, lead_id)
+
+
+def lead_conditions(model, status='', source='', search=''):
+    conditions = []
+    if status:
+        conditions.append(model.status == status)
+    if source:
+        conditions.append(model.source == source)
+    if search:
+        like = f'%{search}%'
+        conditions.append(or_(model.client_name.ilike(like), model.phone.ilike(like)))
+    return conditions
+
+
+def includes_archive(status='', search=''):
+    """Only closed leads are archived: read the archive for them and for searches."""
+    return status == 'closed' or (bool(search) and not status)
+
+
+def leads_select(status='', source='', search=''):
+    """Leads matching the filters, newest first, with an ``archived`` flag per row."""
+    parts = [Lead]
+    if includes_archive(status, search):
+        parts.append(ArchivedLead)
+    selects = [
+        select(
+            *[model.__table__.c[c] for c in LEAD_COLUMNS],
+            literal(model.archived).label('archived'),
+        ).where(*lead_conditions(model, status, source, search))
+        for model in parts
+    ]
+    if len(selects) == 1:
+        return selects[0].order_by(Lead.created_at.desc())
+    union = union_all(*selects).subquery()
+    return select(union).order_by(union.c.created_at.desc())
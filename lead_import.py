@@ -0,0 +1,217 @@
+import csv
+import io
+import zipfile
+from datetime import datetime
+
+from sqlalchemy import insert
+from sqlalchemy.exc import SQLAlchemyError
+
+from models import db, Lead, ArchivedLead, normalize_phone, phone_key
+from changefeed import publish
+from audit import record
+
+try:
+    import openpyxl
+    from openpyxl.utils.exceptions import InvalidFileException
+except ImportError:  # optional dependency, only needed for .xlsx files
+    openpyxl = None
+
+BATCH_SIZE = 5000
+MAX_REPORTED_ERRORS = 500
+
+# Header aliases (compared lower-cased, without surrounding spaces)
+COLUMN_ALIASES = {
+    'client_name': {'client_name', 'client', 'name', 'full_name', 'full name', 'имя', 'клиент', 'имя клиента'},
+    'phone': {'phone', 'phone_number', 'phone number', 'tel', 'mobile', 'телефон'},
+    'location_text': {'location_text', 'location', 'city', 'address', 'локация', 'адрес', 'город'},
+    'request_description': {'request_description', 'description', 'request', 'message', 'описание', 'запрос'},
+    'source': {'source', 'utm_source', 'platform', 'источник'},
+    'status': {'status', 'статус'},
+    'comment': {'comment', 'notes', 'note', 'комментарий'},
+}
+
+STATUS_BY_LABEL = {label.lower(): key for key, label in Lead.STATUS_LABELS.items()}
+
+
+class ImportResult:
+    def __init__(self):
+        self.total = 0
+        self.inserted = 0
+        self.duplicates = 0
+        self.failed = 0
+        self.errors = []  # (row number, message), capped at MAX_REPORTED_ERRORS
+
+    def add_error(self, row_num, message):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((row_num, message))
+
+
+class ImportFormatError(ValueError):
+    pass
+
+
+def _cell_to_str(value):
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M')
+    return str(value).strip()
+
+
+def iter_csv_rows(stream, encoding='utf-8-sig'):
+    text = io.TextIOWrapper(stream, encoding=encoding, errors='replace', newline='')
+    sample = text.read(4096)
+    text.seek(0)
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    yield from csv.reader(text, dialect)
+
+
+def iter_xlsx_rows(stream):
+    if openpyxl is None:
+        raise ImportFormatError('Для импорта XLSX установите пакет openpyxl.')
+    try:
+        workbook = openpyxl.load_workbook(stream, read_only=True, data_only=True)
+    except (zipfile.BadZipFile, InvalidFileException):
+        raise ImportFormatError('Файл XLSX повреждён или имеет неверный формат.')
+    try:
+        for row in workbook.worksheets[0].iter_rows(values_only=True):
+            yield [_cell_to_str(v) for v in row]
+    finally:
+        workbook.close()
+
+
+def iter_rows(stream, filename):
+    ext = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    if ext == 'xlsx':
+        return iter_xlsx_rows(stream)
+    if ext in ('csv', 'txt'):
+        return iter_csv_rows(stream)
+    raise ImportFormatError('Поддерживаются только файлы CSV и XLSX.')
+
+
+def map_columns(header):
+    mapping = {}
+    for idx, title in enumerate(header):
+        title = _cell_to_str(title).lower()
+        for field, aliases in COLUMN_ALIASES.items():
+            if title in aliases and field not in mapping:
+                mapping[field] = idx
+    if 'client_name' not in mapping:
+        raise ImportFormatError('Не найдена колонка с именем клиента.')
+    return mapping
+
+
+def backfill_phone_keys(batch_size=BATCH_SIZE):
+    """Fill ``Lead.phone_key`` for rows created before the column existed."""
+    while True:
+        rows = (
+            db.session.query(Lead.id, Lead.phone)
+            .filter(Lead.phone_key.is_(None), Lead.phone != '', Lead.phone.isnot(None))
+            .limit(batch_size)
+            .all()
+        )
+        updates = [{'id': r.id, 'phone_key': phone_key(r.phone) or ''} for r in rows]
+        if not updates:
+            break
+        db.session.execute(db.update(Lead), updates)
+        db.session.commit()
+
+
+def _flush(batch, result):
+    keys = {row['phone_key'] for _, row in batch if row['phone_key']}
+    existing = set()
+    if keys:
+        # archived leads count too, otherwise re-importing an old list revives them
+        for model in (Lead, ArchivedLead):
+            existing.update(
+                k for (k,) in db.session.query(model.phone_key).filter(model.phone_key.in_(keys))
+            )
+    rows = []
+    seen = set()
+    for row_num, row in batch:
+        key = row['phone_key']
+        if key and (key in existing or key in seen):
+            result.duplicates += 1
+            continue
+        if key:
+            seen.add(key)
+        rows.append((row_num, row))
+    if not rows:
+        return
+    try:
+        db.session.execute(insert(Lead), [row for _, row in rows])
+        db.session.commit()
+        result.inserted += len(rows)
+    except SQLAlchemyError:
+        db.session.rollback()
+        # fall back to row-by-row inserts to report exactly which rows fail
+        for row_num, row in rows:
+            try:
+                db.session.execute(insert(Lead), [row])
+                db.session.commit()
+                result.inserted += 1
+            except SQLAlchemyError as e:
+                db.session.rollback()
+                result.add_error(row_num, str(e.orig if hasattr(e, 'orig') else e))
+
+
+def import_leads(rows, default_source='', batch_size=BATCH_SIZE):
+    """Insert leads from an iterator of rows whose first row is the header.
+
+    Rows are validated one by one and written in batches of ``batch_size``;
+    leads whose phone already exists are skipped.
+    """
+    result = ImportResult()
+    rows = iter(rows)
+    try:
+        header = next(rows)
+    except StopIteration:
+        raise ImportFormatError('Файл пуст.')
+    mapping = map_columns(header)
+
+    backfill_phone_keys()
+
+    batch = []
+    for row_num, row in enumerate(rows, start=2):
+        if not any(row):
+            continue
+        result.total += 1
+        values = {
+            field: _cell_to_str(row[idx]) if idx < len(row) else ''
+            for field, idx in mapping.items()
+        }
+        if not values['client_name']:
+            result.add_error(row_num, 'Пустое имя клиента')
+            continue
+        status = values.get('status', '')
+        status = STATUS_BY_LABEL.get(status.lower(), status) or 'new'
+        if status not in Lead.STATUS_LABELS:
+            result.add_error(row_num, f'Неизвестный статус «{status}»')
+            continue
+        phone = normalize_phone(values.get('phone', ''))
+        batch.append((row_num, {
+            'client_name': values['client_name'][:200],
+            'phone': phone[:50],
+            'phone_key': phone_key(phone),
+            'location_text': values.get('location_text', '')[:300],
+            'request_description': values.get('request_description', ''),
+            'source': (values.get('source') or default_source)[:200],
+            'status': status,
+            'comment': values.get('comment', ''),
+        }))
+        if len(batch) >= batch_size:
+            _flush(batch, result)
+            batch = []
+    if batch:
+        _flush(batch, result)
+    if result.inserted:
+        publish('lead', [], 'imported')
+        record('lead', [], 'imported', {'count': [None, result.inserted]})
+        db.session.commit()
+    return result
@@ -1,8 +1,40 @@
+import json
+import re
 from datetime import datetime, date, timedelta
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
+from sqlalchemy.orm import validates
 
-db = SQLAlchemy()
+from tenancy import TenantSession
+
+db = SQLAlchemy(session_options={'class_': TenantSession})
+
+
+def normalize_phone(value):
+    """Canonical form of a phone number: digits with a leading '+' for international numbers."""
+    value = (value or '').strip()
+    digits = re.sub(r'\D', '', value)
+    if not digits:
+        return value
+    if value.startswith('+'):
+        return '+' + digits
+    if digits.startswith('00'):
+        return '+' + digits[2:]
+    return digits
+
+
+def phone_key(value):
+    """Digits-only key used to find duplicate leads by phone."""
+    return re.sub(r'\D', '', normalize_phone(value)) or None
+
+
+MINOR_UNITS = 100
+
+
+def _minor_sum(column, *conditions):
+    """SUM of a minor-unit column as a float amount."""
+    total = db.session.query(db.func.coalesce(db.func.sum(column), 0)).filter(*conditions).scalar()
+    return total / MINOR_UNITS
 
 
 class User(db.Model, UserMixin):
@@ -10,9 +42,13 @@ class User(db.Model, UserMixin):
     username = db.Column(db.String(80), unique=True, nullable=False)
     password_hash = db.Column(db.String(128), nullable=False)
     must_change_password = db.Column(db.Boolean, default=False)
+    calendar_token = db.Column(db.String(64), nullable=True, unique=True, index=True)
+    email = db.Column(db.String(200), default='')
+    reminders_enabled = db.Column(db.Boolean, default=False)
 
 
-class Lead(db.Model):
+class LeadFields:
+    """Columns shared by ``Lead`` and its archive copy ``ArchivedLead``."""
     id = db.Column(db.Integer, primary_key=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     client_name = db.Column(db.String(200), nullable=False)
@@ -22,6 +58,7 @@ class Lead(db.Model):
     source = db.Column(db.String(200), default='')
     status = db.Column(db.String(20), default='new')
     comment = db.Column(db.Text, default='')
+    phone_key = db.Column(db.String(50), nullable=True, index=True)
 
     STATUS_LABELS = {
         'new': 'Новый',
@@ -29,11 +66,31 @@ class Lead(db.Model):
         'closed': 'Закрыт',
     }
 
+    @validates('phone')
+    def _set_phone_key(self, key, value):
+        self.phone_key = phone_key(value)
+        return value
+
     @property
     def status_label(self):
         return self.STATUS_LABELS.get(self.status, self.status)
 
 
+class Lead(LeadFields, db.Model):
+    archived = False
+
+    # archived leads keep their ids, so an id must never be handed out twice
+    __table_args__ = {'sqlite_autoincrement': True}
+
+
+class ArchivedLead(LeadFields, db.Model):
+    """Closed lead moved out of the hot ``lead`` table by ``lead_archive``; keeps its id."""
+    __tablename__ = 'lead_archive'
+    archived = True
+
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
 class Project(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     project_name = db.Column(db.String(300), nullable=False)
@@ -81,6 +138,13 @@ class Project(db.Model):
             return self.start_date + timedelta(days=self.duration_days)
         return None
 
+    @classmethod
+    def end_date_expr(cls):
+        """SQL counterpart of ``end_date`` as an ISO date string (NULL when unknown)."""
+        return db.case(
+            (cls.duration_days > 0, db.func.date(cls.start_date, db.func.printf('+%d days', cls.duration_days))),
+        )
+
     @property
     def days_left(self):
         ed = self.end_date
@@ -106,8 +170,8 @@ class Project(db.Model):
 
     @property
     def paid_amount(self):
-        items = self.payment_items.filter_by(invoice_status='paid').all()
-        return sum(i.amount for i in items)
+        return _minor_sum(PaymentPlanItem.amount_minor, PaymentPlanItem.project_id == self.id,
+                          PaymentPlanItem.invoice_status == 'paid')
 
     @property
     def total_variations_amount(self):
@@ -121,38 +185,28 @@ class Project(db.Model):
 
     @property
     def commission_received(self):
-        cp = float(self.commission_percent or 0)
-        if cp == 0:
-            return 0
-        total = 0.0
-        for item in self.payment_items.filter_by(invoice_status='paid').all():
-            total += item.amount * cp / 100
-        return total
+        return _minor_sum(PaymentPlanItem.commission_minor, PaymentPlanItem.project_id == self.id,
+                          PaymentPlanItem.invoice_status == 'paid')
 
     @property
     def commission_pending(self):
         return self.commission_total - self.commission_received
 
+    @property
+    def variation_commission_total(self):
+        return _minor_sum(ExtraPaymentPlanItem.commission_minor, self._variation_stages())
+
     @property
     def commission_total_with_variations(self):
-        cp = float(self.commission_percent or 0)
-        base = self.commission_total
-        extra = 0.0
-        for v in self.variations.all():
-            for item in v.payment_items.all():
-                extra += item.amount * cp / 100
-        return base + extra - self.commission_received_from_variations
+        return self.commission_total + self.variation_commission_total - self.commission_received_from_variations
 
     @property
     def commission_received_from_variations(self):
-        cp = float(self.commission_percent or 0)
-        if cp == 0:
-            return 0
-        total = 0.0
-        for v in self.variations.all():
-            for item in v.payment_items.filter_by(invoice_status='paid').all():
-                total += item.amount * cp / 100
-        return total
+        return _minor_sum(ExtraPaymentPlanItem.commission_minor, self._variation_stages(),
+                          ExtraPaymentPlanItem.invoice_status == 'paid')
+
+    def _variation_stages(self):
+        return ExtraPaymentPlanItem.variation_id.in_(db.select(Variation.id).where(Variation.project_id == self.id))
 
 
 class PaymentPlanItem(db.Model):
@@ -164,6 +218,13 @@ class PaymentPlanItem(db.Model):
     invoice_status = db.Column(db.String(20), default='not_invoiced')
     invoice_date = db.Column(db.Date, nullable=True)
     paid_date = db.Column(db.Date, nullable=True)
+    # stage amount and its commission in minor units (cents), kept up to date by stage_amounts
+    amount_minor = db.Column(db.BigInteger, default=0)
+    commission_minor = db.Column(db.BigInteger, default=0)
+
+    __table_args__ = (
+        db.Index('ix_payment_plan_item_status_invoice_date', 'invoice_status', 'invoice_date'),
+    )
 
     STATUS_LABELS = {
         'not_invoiced': 'Не выставлен',
@@ -177,9 +238,11 @@ class PaymentPlanItem(db.Model):
 
     @property
     def amount(self):
-        if self.project and self.project.contract_amount:
-            return float(self.project.contract_amount) * float(self.percent) / 100
-        return 0.0
+        return (self.amount_minor or 0) / MINOR_UNITS
+
+    @property
+    def commission(self):
+        return (self.commission_minor or 0) / MINOR_UNITS
 
 
 class Variation(db.Model):
@@ -218,8 +281,8 @@ class Variation(db.Model):
 
     @property
     def paid_amount(self):
-        items = self.payment_items.filter_by(invoice_status='paid').all()
-        return sum(i.amount for i in items)
+        return _minor_sum(ExtraPaymentPlanItem.amount_minor, ExtraPaymentPlanItem.variation_id == self.id,
+                          ExtraPaymentPlanItem.invoice_status == 'paid')
 
 
 class ExtraPaymentPlanItem(db.Model):
@@ -231,6 +294,13 @@ class ExtraPaymentPlanItem(db.Model):
     invoice_status = db.Column(db.String(20), default='not_invoiced')
     invoice_date = db.Column(db.Date, nullable=True)
     paid_date = db.Column(db.Date, nullable=True)
+    # stage amount and its commission in minor units (cents), kept up to date by stage_amounts
+    amount_minor = db.Column(db.BigInteger, default=0)
+    commission_minor = db.Column(db.BigInteger, default=0)
+
+    __table_args__ = (
+        db.Index('ix_extra_payment_plan_item_status_invoice_date', 'invoice_status', 'invoice_date'),
+    )
 
     STATUS_LABELS = {
         'not_invoiced': 'Не выставлен',
@@ -244,9 +314,36 @@ class ExtraPaymentPlanItem(db.Model):
 
     @property
     def amount(self):
-        if self.variation and self.variation.extra_amount:
-            return float(self.variation.extra_amount) * float(self.percent) / 100
-        return 0.0
+        return (self.amount_minor or 0) / MINOR_UNITS
+
+    @property
+    def commission(self):
+        return (self.commission_minor or 0) / MINOR_UNITS
+
+
+class PaymentPlanTemplate(db.Model):
+    """Named staged schedule (advance / rough-in / handover / ...) applied to projects and variations."""
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(200), nullable=False, unique=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    stages = db.relationship(
+        'PaymentPlanTemplateStage', backref='template', order_by='PaymentPlanTemplateStage.position',
+        cascade='all, delete-orphan'
+    )
+
+    @property
+    def percent_total(self):
+        return sum((s.percent or 0) for s in self.stages)
+
+
+class PaymentPlanTemplateStage(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    template_id = db.Column(db.Integer, db.ForeignKey('payment_plan_template.id'), nullable=False, index=True)
+    position = db.Column(db.Integer, nullable=False, default=0)
+    title = db.Column(db.String(200), nullable=False)
+    percent = db.Column(db.Numeric(6, 2), nullable=False, default=0)
+    due_condition = db.Column(db.String(300), default='')
 
 
 class ProjectTask(db.Model):
@@ -259,6 +356,10 @@ class ProjectTask(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     completed_at = db.Column(db.DateTime, nullable=True)
 
+    __table_args__ = (
+        db.Index('ix_project_task_status_deadline', 'status', 'deadline_date'),
+    )
+
     STATUS_LABELS = {
         'open': 'Открыта',
         'done': 'Выполнена',
@@ -283,6 +384,7 @@ class Document(db.Model):
     file_name = db.Column(db.String(300), nullable=False)
     original_name = db.Column(db.String(300), nullable=False)
     uploaded_at = db.Column(db.DateTime, default=datetime.utcnow)
+    encoding = db.Column(db.String(10), default='')
 
     TYPE_LABELS = {
         'contract': 'Договор',
@@ -293,3 +395,226 @@ class Document(db.Model):
     @property
     def type_label(self):
         return self.TYPE_LABELS.get(self.doc_type, self.doc_type)
+
+
+class WebhookReceipt(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    idempotency_key = db.Column(db.String(200), unique=True, nullable=False)
+    lead_id = db.Column(db.Integer, nullable=True)
+    received_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class FxRate(db.Model):
+    """Units of ``REPORTING_CURRENCY`` per one unit of ``currency``, valid from ``rate_date``."""
+    id = db.Column(db.Integer, primary_key=True)
+    currency = db.Column(db.String(10), nullable=False)
+    rate_date = db.Column(db.Date, nullable=False)
+    rate = db.Column(db.Numeric(18, 8), nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_fx_rate_currency_date', 'currency', 'rate_date', unique=True),
+    )
+
+
+class ChangeLog(db.Model):
+    """Append-only feed of writes, polled by every worker to fan out live updates."""
+    id = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    entity = db.Column(db.String(20), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=True)
+    project_id = db.Column(db.Integer, nullable=True)
+    action = db.Column(db.String(20), nullable=False)
+
+    # ids must never be reused once pruning empties the table: pollers and
+    # clients resume from the last id they saw
+    __table_args__ = {'sqlite_autoincrement': True}
+
+
+class LeadStatusChange(db.Model):
+    """One status transition of a lead, written by ``funnel``.
+
+    ``source`` and ``lead_created_at`` are copied from the lead so the funnel
+    snapshot needs no join; leads created with a status have no row for it.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    lead_id = db.Column(db.Integer, nullable=False, index=True)
+    source = db.Column(db.String(200), default='')
+    from_status = db.Column(db.String(20), nullable=True)
+    to_status = db.Column(db.String(20), nullable=False)
+    lead_created_at = db.Column(db.DateTime, nullable=True)
+    changed_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    user_id = db.Column(db.Integer, nullable=True)
+
+
+class LeadFunnelSnapshot(db.Model):
+    """Daily per status and source: leads in the status, leads that entered it, days to close."""
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    status = db.Column(db.String(20), nullable=False)
+    source = db.Column(db.String(200), nullable=False, default='')
+    lead_count = db.Column(db.Integer, nullable=False, default=0)
+    entered_count = db.Column(db.Integer, nullable=False, default=0)
+    # sum over leads closed that day of (closed - created) in days; divide by entered_count
+    days_to_close_total = db.Column(db.Float, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_lead_funnel_snapshot_day_status_source', 'day', 'status', 'source', unique=True),
+    )
+
+
+class JobRun(db.Model):
+    """Claim of a scheduled job for a day, so only one worker process runs it."""
+    id = db.Column(db.Integer, primary_key=True)
+    job = db.Column(db.String(50), nullable=False)
+    run_on = db.Column(db.Date, nullable=False)
+    started_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_job_run_job_run_on', 'job', 'run_on', unique=True),
+    )
+
+
+class OutboxMessage(db.Model):
+    """Email queued by the app; ``sent_at`` stays empty until a transport accepted it."""
+    __tablename__ = 'outbox'
+    id = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True, index=True)
+    recipient = db.Column(db.String(200), nullable=False)
+    subject = db.Column(db.String(300), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    sent_at = db.Column(db.DateTime, nullable=True, index=True)
+    attempts = db.Column(db.Integer, default=0)
+    error = db.Column(db.String(500), default='')
+
+
+class ReminderSent(db.Model):
+    """One item already put in a user's reminder digest, for one due date and reason."""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    kind = db.Column(db.String(20), nullable=False)
+    item_id = db.Column(db.Integer, nullable=False)
+    reason = db.Column(db.String(20), nullable=False)
+    due_date = db.Column(db.Date, nullable=False)
+    sent_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+    __table_args__ = (
+        db.Index('ix_reminder_sent_item', 'user_id', 'kind', 'item_id', 'reason', 'due_date', unique=True),
+    )
+
+
+class AuditEvent(db.Model):
+    """Append-only record of who changed what; written in batches by ``audit``."""
+    id = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    user_id = db.Column(db.Integer, nullable=True)
+    username = db.Column(db.String(80), default='')
+    entity = db.Column(db.String(20), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=True)
+    project_id = db.Column(db.Integer, nullable=True, index=True)
+    action = db.Column(db.String(20), nullable=False)
+    changes = db.Column(db.Text, default='{}')
+
+    __table_args__ = (
+        db.Index('ix_audit_event_entity', 'entity', 'entity_id'),
+    )
+
+    ACTION_LABELS = {
+        'created': 'Создание',
+        'updated': 'Изменение',
+        'deleted': 'Удаление',
+        'bulk_updated': 'Массовое изменение',
+        'bulk_deleted': 'Массовое удаление',
+        'imported': 'Импорт',
+        'archived': 'В архив',
+        'restored': 'Из архива',
+    }
+
+    ENTITY_LABELS = {
+        'lead': 'Лид',
+        'project': 'Проект',
+        'payment': 'Этап оплаты',
+        'variation': 'Доп. работа',
+        'extra_payment': 'Этап оплаты (доп.)',
+        'task': 'Задача',
+        'document': 'Документ',
+    }
+
+    @property
+    def action_label(self):
+        return self.ACTION_LABELS.get(self.action, self.action)
+
+    @property
+    def entity_label(self):
+        return self.ENTITY_LABELS.get(self.entity, self.entity)
+
+    @property
+    def changes_dict(self):
+        return json.loads(self.changes or '{}')
+
+
+for _op in ('UPDATE', 'DELETE'):
+    db.event.listen(AuditEvent.__table__, 'after_create', db.DDL(
+        f'CREATE TRIGGER IF NOT EXISTS audit_event_no_{_op.lower()} BEFORE {_op} ON audit_event '
+        f"BEGIN SELECT RAISE(ABORT, 'audit_event is append-only'); END"
+    ))
+
+
+def upgrade_schema(engine=None):
+    """Add columns and indexes that are missing from already existing tables.
+
+    ``db.create_all()`` only creates missing tables, so databases created by an
+    older version are brought up to date here. Returns the ``(table, column)``
+    pairs that were added, so callers can backfill them. ``engine`` defaults
+    to ``db.engine``; tenant databases pass their own.
+    """
+    added = set()
+    engine = engine or db.engine
+    inspector = db.inspect(engine)
+    quote = engine.dialect.identifier_preparer.quote
+    with engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = f'ALTER TABLE {quote(table.name)} ADD COLUMN {quote(column.name)} ' \
+                      f'{column.type.compile(engine.dialect)}'
+                default = column.default.arg if column.default is not None and column.default.is_scalar else None
+                if isinstance(default, bool):
+                    ddl += f' DEFAULT {int(default)}'
+                elif isinstance(default, (int, float)):
+                    ddl += f' DEFAULT {default}'
+                elif isinstance(default, str):
+                    ddl += " DEFAULT '{}'".format(default.replace("'", "''"))
+                conn.execute(db.text(ddl))
+                added.add((table.name, column.name))
+            if table.kwargs.get('sqlite_autoincrement'):
+                _ensure_autoincrement(conn, table, quote)
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+    return added
+
+
+def _ensure_autoincrement(conn, table, quote):
+    """Rebuild ``table`` with AUTOINCREMENT if it was created without it.
+
+    SQLite can only set AUTOINCREMENT in CREATE TABLE, so the rows are
+    copied into a new table that then takes the old one's name; copying the
+    ids seeds ``sqlite_sequence`` with the highest one.
+    """
+    sql = conn.execute(
+        db.text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': table.name}
+    ).scalar()
+    if sql is None or 'AUTOINCREMENT' in sql.upper():
+        return
+    name, new = quote(table.name), quote(table.name + '__new')
+    create = str(db.schema.CreateTable(table).compile(dialect=conn.dialect)).strip()
+    conn.execute(db.text(create.replace(f'CREATE TABLE {name}', f'CREATE TABLE {new}', 1)))
+    columns = ', '.join(quote(c.name) for c in table.columns)
+    conn.execute(db.text(f'INSERT INTO {new} ({columns}) SELECT {columns} FROM {name}'))
+    conn.execute(db.text(f'DROP TABLE {name}'))
+    conn.execute(db.text(f'ALTER TABLE {new} RENAME TO {name}'))
@@ -0,0 +1,112 @@
+from decimal import Decimal, InvalidOperation
+from itertools import zip_longest
+
+from sqlalchemy import select, insert
+
+from models import db, Project, PaymentPlanItem, Variation, ExtraPaymentPlanItem
+from changefeed import publish_owned
+from audit import record_owned
+from stage_amounts import refresh_stage_amounts
+
+HUNDRED = Decimal('100')
+CENT = Decimal('0.01')
+
+
+class PlanTemplateError(ValueError):
+    pass
+
+
+def parse_stages(titles, percents, conditions):
+    """Stages from the parallel form lists; blank rows are skipped."""
+    stages = []
+    for title, percent, condition in zip_longest(titles, percents, conditions, fillvalue=''):
+        title, percent = title.strip(), percent.strip()
+        if not title and not percent:
+            continue
+        if not title:
+            raise PlanTemplateError('У каждого этапа должно быть название.')
+        try:
+            value = Decimal(percent.replace(',', '.')).quantize(CENT)
+        except InvalidOperation:
+            raise PlanTemplateError(f'Этап «{title}»: неверный процент «{percent}».')
+        if not 0 < value <= HUNDRED:
+            raise PlanTemplateError(f'Этап «{title}»: процент должен быть от 0 до 100.')
+        stages.append({'title': title, 'percent': value, 'due_condition': condition.strip()})
+    validate_stages(stages)
+    return stages
+
+
+def validate_stages(stages):
+    if not stages:
+        raise PlanTemplateError('Добавьте хотя бы один этап.')
+    total = sum(Decimal(str(s['percent'])) for s in stages)
+    if total != HUNDRED:
+        raise PlanTemplateError(f'Сумма процентов этапов {total}%, должна быть 100%.')
+
+
+def _stage_rows(template):
+    stages = [
+        {'title': s.title, 'percent': s.percent, 'due_condition': s.due_condition or ''}
+        for s in template.stages
+    ]
+    validate_stages(stages)
+    return stages
+
+
+def _audit_changes(stage, template):
+    return {
+        'title': [None, stage['title']],
+        'percent': [None, float(stage['percent'])],
+        'plan_template': [None, template.name],
+    }
+
+
+def apply_template(template, project_ids=(), variation_ids=()):
+    """Add the template's stages to every given project and variation without stages.
+
+    Each stage table gets one executemany INSERT ... RETURNING for all
+    targets; stored amounts are then refreshed with the set-based UPDATEs
+    of ``stage_amounts``. The caller commits. Returns ``(applied, skipped)``
+    counts of targets.
+    """
+    stages = _stage_rows(template)
+    project_ids, variation_ids = set(project_ids), set(variation_ids)
+
+    projects = set(db.session.scalars(select(Project.id).where(Project.id.in_(project_ids))))
+    projects -= set(db.session.scalars(
+        select(PaymentPlanItem.project_id).where(PaymentPlanItem.project_id.in_(projects)).distinct()
+    ))
+    variations = dict(db.session.execute(
+        select(Variation.id, Variation.project_id).where(Variation.id.in_(variation_ids))
+    ).all())
+    for variation_id in db.session.scalars(
+        select(ExtraPaymentPlanItem.variation_id).where(ExtraPaymentPlanItem.variation_id.in_(variations)).distinct()
+    ):
+        del variations[variation_id]
+
+    if projects:
+        rows = [{'project_id': pid, **stage} for pid in sorted(projects) for stage in stages]
+        owners = db.session.execute(
+            insert(PaymentPlanItem).returning(
+                PaymentPlanItem.id, PaymentPlanItem.project_id, sort_by_parameter_order=True
+            ), rows
+        ).all()
+        publish_owned('payment', owners, 'created')
+        for (item_id, project_id), stage in zip(owners, rows):
+            record_owned('payment', [(item_id, project_id)], 'created', _audit_changes(stage, template))
+    if variations:
+        rows = [{'variation_id': vid, **stage} for vid in sorted(variations) for stage in stages]
+        created = db.session.execute(
+            insert(ExtraPaymentPlanItem).returning(
+                ExtraPaymentPlanItem.id, ExtraPaymentPlanItem.variation_id, sort_by_parameter_order=True
+            ), rows
+        ).all()
+        owners = [(item_id, variations[vid]) for item_id, vid in created]
+        publish_owned('extra_payment', owners, 'created')
+        for owner, stage in zip(owners, rows):
+            record_owned('extra_payment', [owner], 'created', _audit_changes(stage, template))
+    if projects or variations:
+        refresh_stage_amounts(projects, variations)
+
+    applied = len(projects) + len(variations)
+    return applied, len(project_ids) + len(variation_ids) - applied
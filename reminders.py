@@ -0,0 +1,277 @@
+import logging
+import mailbox
+import smtplib
+from datetime import date, datetime, timedelta
+from email.message import EmailMessage
+from email.utils import formatdate, make_msgid
+
+from flask import current_app
+from sqlalchemy import select, insert, update
+
+from models import (
+    db, User, Project, ProjectTask, PaymentPlanItem, Variation, ExtraPaymentPlanItem,
+    OutboxMessage, ReminderSent,
+)
+from tenancy import current_tenant
+
+log = logging.getLogger(__name__)
+
+# digest sections in the order they are listed
+SECTIONS = {
+    ('task', 'overdue'): 'Просроченные задачи',
+    ('task', 'soon'): 'Задачи со скорым сроком',
+    ('project', 'overdue'): 'Проекты с прошедшей датой сдачи',
+    ('project', 'soon'): 'Скорая сдача проектов',
+    ('payment', 'overdue'): 'Неоплаченные счета',
+    ('extra_payment', 'overdue'): 'Неоплаченные счета по доп. работам',
+}
+
+
+def _item(kind, reason, row, due_date, title):
+    return {
+        'kind': kind, 'item_id': row.id, 'reason': reason, 'due_date': due_date,
+        'title': title, 'project_id': row.project_id, 'project_name': row.project_name,
+    }
+
+
+def _reason(due_date, today):
+    return 'overdue' if due_date < today else 'soon'
+
+
+def due_items(today=None):
+    """Everything that needs a reminder today, in one query per kind.
+
+    Open tasks due within ``REMINDER_LEAD_DAYS`` (a range on
+    ``ix_project_task_status_deadline``), planned/active projects whose end
+    date is that close or already past, and invoiced stages unpaid for
+    longer than ``PAYMENT_TERMS_DAYS`` (``..._status_invoice_date`` indexes).
+    """
+    today = today or date.today()
+    horizon = today + timedelta(days=current_app.config['REMINDER_LEAD_DAYS'])
+    cutoff = today - timedelta(days=current_app.config['PAYMENT_TERMS_DAYS'])
+    terms = timedelta(days=current_app.config['PAYMENT_TERMS_DAYS'])
+    items = []
+
+    for r in db.session.execute(
+        select(ProjectTask.id, ProjectTask.title, ProjectTask.deadline_date, ProjectTask.project_id,
+               Project.project_name)
+        .join(Project, Project.id == ProjectTask.project_id)
+        .where(ProjectTask.status == 'open', ProjectTask.deadline_date <= horizon)
+        .order_by(ProjectTask.deadline_date, ProjectTask.id)
+    ):
+        items.append(_item('task', _reason(r.deadline_date, today), r, r.deadline_date, r.title))
+
+    for r in db.session.execute(
+        select(Project.id, Project.id.label('project_id'), Project.project_name, Project.start_date,
+               Project.duration_days)
+        .where(Project.status.in_(('planned', 'active')), Project.start_date.isnot(None),
+               Project.duration_days > 0, Project.end_date_expr() <= horizon.isoformat())
+        .order_by(Project.end_date_expr(), Project.id)
+    ):
+        end = r.start_date + timedelta(days=r.duration_days)
+        items.append(_item('project', _reason(end, today), r, end, r.project_name))
+
+    for r in db.session.execute(
+        select(PaymentPlanItem.id, PaymentPlanItem.title, PaymentPlanItem.invoice_date,
+               PaymentPlanItem.project_id, Project.project_name)
+        .join(Project, Project.id == PaymentPlanItem.project_id)
+        .where(PaymentPlanItem.invoice_status == 'invoiced', PaymentPlanItem.invoice_date < cutoff)
+        .order_by(PaymentPlanItem.invoice_date, PaymentPlanItem.id)
+    ):
+        items.append(_item('payment', 'overdue', r, r.invoice_date + terms, r.title))
+
+    for r in db.session.execute(
+        select(ExtraPaymentPlanItem.id, ExtraPaymentPlanItem.title, ExtraPaymentPlanItem.invoice_date,
+               Variation.project_id, Variation.title.label('variation_title'), Project.project_name)
+        .join(Variation, Variation.id == ExtraPaymentPlanItem.variation_id)
+        .join(Project, Project.id == Variation.project_id)
+        .where(ExtraPaymentPlanItem.invoice_status == 'invoiced', ExtraPaymentPlanItem.invoice_date < cutoff)
+        .order_by(ExtraPaymentPlanItem.invoice_date, ExtraPaymentPlanItem.id)
+    ):
+        items.append(_item('extra_payment', 'overdue', r, r.invoice_date + terms,
+                           f'{r.title} ({r.variation_title})'))
+
+    return items
+
+
+def _key(item):
+    return item['kind'], item['item_id'], item['reason'], item['due_date']
+
+
+def already_sent(user_ids, items):
+    """``(user_id, kind, item_id, reason, due_date)`` of the items these users were reminded of."""
+    sent = set()
+    ids_by_kind = {}
+    for item in items:
+        ids_by_kind.setdefault(item['kind'], set()).add(item['item_id'])
+    for kind, ids in ids_by_kind.items():
+        sent.update(tuple(row) for row in db.session.execute(
+            select(ReminderSent.user_id, ReminderSent.kind, ReminderSent.item_id, ReminderSent.reason,
+                   ReminderSent.due_date)
+            .where(ReminderSent.user_id.in_(user_ids), ReminderSent.kind == kind, ReminderSent.item_id.in_(ids))
+        ))
+    return sent
+
+
+def _link(project_id):
+    base = current_app.config['APP_BASE_URL']
+    if not base:
+        return ''
+    return f"{base.format(tenant=current_tenant() or '').rstrip('/')}/projects/{project_id}"
+
+
+def render_digest(items, today):
+    """Subject and plain-text body listing ``items`` by section."""
+    limit = current_app.config['REMINDER_DIGEST_MAX_ITEMS']
+    lines = [f'Напоминания CRM на {today.strftime("%d.%m.%Y")}.', '']
+    for section, heading in SECTIONS.items():
+        rows = [i for i in items if (i['kind'], i['reason']) == section]
+        if not rows:
+            continue
+        lines.append(f'{heading} ({len(rows)}):')
+        for i in rows[:limit]:
+            line = f"  {i['due_date'].strftime('%d.%m.%Y')}  {i['title']}"
+            if i['kind'] != 'project':
+                line += f" — {i['project_name']}"
+            lines.append(line)
+            link = _link(i['project_id'])
+            if link:
+                lines.append(f'    {link}')
+        if len(rows) > limit:
+            lines.append(f'  … и ещё {len(rows) - limit}')
+        lines.append('')
+    return f'CRM: напоминания ({len(items)})', '\n'.join(lines)
+
+
+def queue_digests(today=None):
+    """Queue one digest per subscribed user with the items new to them; returns how many were queued.
+
+    Every item put in a digest is recorded in ``ReminderSent`` together with
+    its due date and reason, so later runs skip it until the deadline moves
+    or the reason changes (a task due soon is reminded of again once overdue).
+    """
+    today = today or date.today()
+    users = db.session.execute(
+        select(User.id, User.email).where(User.reminders_enabled.is_(True), User.email != '')
+    ).all()
+    if not users:
+        return 0
+    items = due_items(today)
+    if not items:
+        return 0
+    sent = already_sent([u.id for u in users], items)
+    messages, records = [], []
+    for user in users:
+        fresh = [i for i in items if (user.id, *_key(i)) not in sent]
+        if not fresh:
+            continue
+        subject, body = render_digest(fresh, today)
+        messages.append({'user_id': user.id, 'recipient': user.email, 'subject': subject, 'body': body})
+        records.extend(
+            {'user_id': user.id, 'kind': i['kind'], 'item_id': i['item_id'], 'reason': i['reason'],
+             'due_date': i['due_date']}
+            for i in fresh
+        )
+    if messages:
+        db.session.execute(insert(OutboxMessage), messages)
+        db.session.execute(insert(ReminderSent), records)
+    db.session.commit()
+    return len(messages)
+
+
+# --- Delivery ---
+
+def _email(message):
+    config = current_app.config
+    email = EmailMessage()
+    email['From'] = config['MAIL_FROM']
+    email['To'] = message.recipient
+    email['Subject'] = message.subject
+    email['Date'] = formatdate(localtime=True)
+    email['Message-ID'] = make_msgid(domain=config['MAIL_FROM'].rpartition('@')[2] or None)
+    email.set_content(message.body)
+    return email
+
+
+class _Smtp:
+    """One SMTP connection for the whole batch."""
+
+    def __init__(self, config):
+        self.smtp = smtplib.SMTP(config['MAIL_SMTP_HOST'], config['MAIL_SMTP_PORT'], timeout=30)
+        if config['MAIL_SMTP_STARTTLS']:
+            self.smtp.starttls()
+        if config['MAIL_SMTP_USER']:
+            self.smtp.login(config['MAIL_SMTP_USER'], config['MAIL_SMTP_PASSWORD'])
+
+    def send(self, email):
+        self.smtp.send_message(email)
+
+    def close(self):
+        try:
+            self.smtp.quit()
+        except smtplib.SMTPException:
+            pass
+
+
+class _Maildir:
+    def __init__(self, config):
+        self.box = mailbox.Maildir(config['MAIL_MAILDIR'], create=True)
+
+    def send(self, email):
+        self.box.add(email)
+
+    def close(self):
+        pass
+
+
+TRANSPORTS = {'smtp': _Smtp, 'maildir': _Maildir}
+
+
+def deliver_outbox():
+    """Hand unsent outbox messages to ``MAIL_TRANSPORT``; returns how many went out.
+
+    Without a transport the messages just stay in the outbox (and on the
+    reminders page). A failed message keeps its error and is retried on the
+    next run, up to ``MAIL_MAX_ATTEMPTS`` times.
+    """
+    config = current_app.config
+    transport = TRANSPORTS.get(config['MAIL_TRANSPORT'])
+    if transport is None:
+        return 0
+    pending = db.session.scalars(
+        select(OutboxMessage)
+        .where(OutboxMessage.sent_at.is_(None), OutboxMessage.attempts < config['MAIL_MAX_ATTEMPTS'])
+        .order_by(OutboxMessage.id)
+    ).all()
+    if not pending:
+        return 0
+    delivered = 0
+    try:
+        connection = transport(config)
+    except (OSError, smtplib.SMTPException) as e:
+        log.warning('outbox: %s transport unavailable: %s', config['MAIL_TRANSPORT'], e)
+        return 0
+    try:
+        for message in pending:
+            values = {'attempts': OutboxMessage.attempts + 1}
+            try:
+                connection.send(_email(message))
+                values.update(sent_at=datetime.utcnow(), error='')
+                delivered += 1
+            except (OSError, smtplib.SMTPException) as e:
+                values['error'] = str(e)[:500]
+                log.warning('outbox: message %d to %s failed: %s', message.id, message.recipient, e)
+            db.session.execute(update(OutboxMessage).where(OutboxMessage.id == message.id).values(**values))
+    finally:
+        connection.close()
+        db.session.commit()
+    return delivered
+
+
+def send_reminders(today=None):
+    """Scheduler job: queue new digests and deliver whatever is waiting in the outbox."""
+    queued = queue_digests(today)
+    delivered = deliver_outbox()
+    if queued or delivered:
+        log.info('reminders: %d digests queued, %d messages delivered', queued, delivered)
+    return queued, delivered
@@ -0,0 +1,246 @@
+import base64
+import hashlib
+import hmac
+import json
+from datetime import date, datetime
+from decimal import Decimal
+
+from flask import Blueprint, request, jsonify, current_app, url_for
+from flask_login import current_user
+
+from models import (
+    db, Lead, Project, PaymentPlanItem, Variation, ExtraPaymentPlanItem,
+    ProjectTask, Document,
+)
+from tenancy import tenant_tokens
+
+api_bp = Blueprint('api', __name__, url_prefix='/api/v1')
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+
+class Resource:
+    """Exposed model: readable columns, filterable columns and related collections.
+
+    ``children`` maps an include name to ``(resource name, foreign key column on
+    the child)``; ``parents`` maps it to ``(resource name, foreign key column on
+    this model)``.
+    """
+
+    def __init__(self, model, filters=(), exclude=(), children=None, parents=None):
+        self.model = model
+        self.table = model.__table__
+        self.fields = [c.name for c in self.table.columns if c.name not in exclude]
+        self.filters = filters
+        self.children = children or {}
+        self.parents = parents or {}
+
+
+RESOURCES = {
+    'leads': Resource(Lead, filters=('status', 'source'), exclude=('phone_key',)),
+    'projects': Resource(
+        Project, filters=('status', 'currency'),
+        children={
+            'payments': ('payments', 'project_id'),
+            'variations': ('variations', 'project_id'),
+            'tasks': ('tasks', 'project_id'),
+            'documents': ('documents', 'project_id'),
+        },
+    ),
+    'payments': Resource(
+        PaymentPlanItem, filters=('project_id', 'invoice_status'),
+        parents={'project': ('projects', 'project_id')},
+    ),
+    'variations': Resource(
+        Variation, filters=('project_id', 'status'),
+        children={'extra-payments': ('extra-payments', 'variation_id')},
+        parents={'project': ('projects', 'project_id')},
+    ),
+    'extra-payments': Resource(
+        ExtraPaymentPlanItem, filters=('variation_id', 'invoice_status'),
+        parents={'variation': ('variations', 'variation_id')},
+    ),
+    'tasks': Resource(
+        ProjectTask, filters=('project_id', 'status'),
+        parents={'project': ('projects', 'project_id')},
+    ),
+    'documents': Resource(
+        Document, filters=('project_id', 'doc_type'), exclude=('file_name', 'encoding'),
+        parents={'project': ('projects', 'project_id')},
+    ),
+}
+
+
+class ApiError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+@api_bp.errorhandler(ApiError)
+def handle_api_error(e):
+    return jsonify(error=e.message), e.status
+
+
+@api_bp.before_request
+def authenticate():
+    if current_user.is_authenticated:
+        return None
+    auth = request.headers.get('Authorization', '')
+    token = auth[7:].strip() if auth.startswith('Bearer ') else ''
+    api_tokens, _ = tenant_tokens()
+    if token and any(hmac.compare_digest(token, t) for t in api_tokens):
+        return None
+    return jsonify(error='Требуется авторизация.'), 401
+
+
+# ======================== HELPERS ========================
+
+def _json_default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f'Cannot serialize {type(value).__name__}')
+
+
+def json_response(payload):
+    body = json.dumps(payload, default=_json_default, ensure_ascii=False, sort_keys=True).encode('utf-8')
+    response = current_app.response_class(body, mimetype='application/json')
+    response.set_etag(hashlib.sha1(body).hexdigest())
+    return response.make_conditional(request)
+
+
+def encode_cursor(last_id):
+    return base64.urlsafe_b64encode(str(last_id).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        return int(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode())
+    except (ValueError, UnicodeDecodeError):
+        raise ApiError('Некорректный cursor.')
+
+
+def get_resource(name):
+    resource = RESOURCES.get(name)
+    if resource is None:
+        raise ApiError(f'Неизвестный ресурс «{name}».', 404)
+    return resource
+
+
+def requested_fields(name, resource, required=()):
+    """Sparse fieldset from ``fields[name]=`` (or plain ``fields=`` for the primary resource)."""
+    raw = request.args.get(f'fields[{name}]')
+    if raw is None and name == request.view_args.get('name'):
+        raw = request.args.get('fields')
+    if not raw:
+        fields = list(resource.fields)
+    else:
+        fields = [f.strip() for f in raw.split(',') if f.strip()]
+        unknown = [f for f in fields if f not in resource.fields]
+        if unknown:
+            raise ApiError(f'Неизвестные поля {name}: {", ".join(unknown)}.')
+    for f in ('id',) + tuple(required):
+        if f not in fields:
+            fields.append(f)
+    return fields
+
+
+def fetch_rows(resource, fields, where):
+    columns = [resource.table.c[f] for f in fields]
+    return [dict(r._mapping) for r in db.session.execute(db.select(*columns).where(where))]
+
+
+def attach_includes(name, resource, rows):
+    """Load every requested relation with one query and embed it into ``rows``."""
+    includes = [i.strip() for i in request.args.get('include', '').split(',') if i.strip()]
+    for include in includes:
+        if include in resource.children:
+            child_name, fk = resource.children[include]
+            child = RESOURCES[child_name]
+            fields = requested_fields(child_name, child, required=(fk,))
+            ids = [r['id'] for r in rows]
+            grouped = {}
+            if ids:
+                for item in fetch_rows(child, fields, child.table.c[fk].in_(ids)):
+                    grouped.setdefault(item[fk], []).append(item)
+            for r in rows:
+                r[include] = sorted(grouped.get(r['id'], []), key=lambda i: i['id'])
+        elif include in resource.parents:
+            parent_name, fk = resource.parents[include]
+            parent = RESOURCES[parent_name]
+            fields = requested_fields(parent_name, parent)
+            ids = {r[fk] for r in rows if r.get(fk) is not None}
+            by_id = {}
+            if ids:
+                by_id = {p['id']: p for p in fetch_rows(parent, fields, parent.table.c.id.in_(ids))}
+            for r in rows:
+                r[include] = by_id.get(r.get(fk))
+        else:
+            raise ApiError(f'Неизвестный include «{include}» для {name}.')
+
+
+def _with_fk_fields(resource, fields):
+    """Foreign keys that parent includes need, even if not asked for."""
+    includes = request.args.get('include', '').split(',')
+    required = [resource.parents[i.strip()][1] for i in includes if i.strip() in resource.parents]
+    return fields + [f for f in required if f not in fields]
+
+
+# ======================== ENDPOINTS ========================
+
+@api_bp.route('/')
+def api_index():
+    return json_response({
+        'resources': {
+            name: {
+                'url': url_for('api.api_list', name=name, _external=False),
+                'fields': r.fields,
+                'filters': list(r.filters),
+                'include': sorted(list(r.children) + list(r.parents)),
+            }
+            for name, r in RESOURCES.items()
+        },
+    })
+
+
+@api_bp.route('/<name>')
+def api_list(name):
+    resource = get_resource(name)
+    fields = _with_fk_fields(resource, requested_fields(name, resource))
+    limit = min(max(request.args.get('limit', DEFAULT_LIMIT, type=int), 1), MAX_LIMIT)
+
+    conditions = []
+    for f in resource.filters:
+        value = request.args.get(f)
+        if value:
+            conditions.append(resource.table.c[f] == value)
+    cursor = request.args.get('cursor')
+    if cursor:
+        conditions.append(resource.table.c.id > decode_cursor(cursor))
+
+    columns = [resource.table.c[f] for f in fields]
+    stmt = db.select(*columns).where(*conditions).order_by(resource.table.c.id).limit(limit + 1)
+    rows = [dict(r._mapping) for r in db.session.execute(stmt)]
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]['id'])
+
+    attach_includes(name, resource, rows)
+    return json_response({'data': rows, 'next_cursor': next_cursor})
+
+
+@api_bp.route('/<name>/<int:obj_id>')
+def api_detail(name, obj_id):
+    resource = get_resource(name)
+    fields = _with_fk_fields(resource, requested_fields(name, resource))
+    rows = fetch_rows(resource, fields, resource.table.c.id == obj_id)
+    if not rows:
+        raise ApiError('Объект не найден.', 404)
+    attach_includes(name, resource, rows)
+    return json_response({'data': rows[0]})
@@ -0,0 +1,44 @@
+import secrets
+
+from flask import Blueprint, render_template, request, redirect, url_for, flash, abort, current_app
+from flask_login import login_required, current_user
+
+from models import db, User
+from ics_feed import calendar_feed
+from tenancy import current_tenant, tenant_from_host
+
+calendar_bp = Blueprint('calendar', __name__, url_prefix='/calendar')
+
+
+@calendar_bp.route('/')
+@login_required
+def calendar_settings():
+    token = db.session.query(User.calendar_token).filter(User.id == current_user.id).scalar()
+    # calendar clients send no session cookie: name the tenant unless the host does
+    tenant = current_tenant() if tenant_from_host(request.host) is None else None
+    feed_url = url_for('calendar.calendar_ics', token=token, tenant=tenant, _external=True) if token else None
+    return render_template('calendar.html', feed_url=feed_url)
+
+
+@calendar_bp.route('/token', methods=['POST'])
+@login_required
+def calendar_token():
+    user = db.session.get(User, current_user.id)
+    if user.calendar_token:
+        calendar_feed.forget_token(user.calendar_token)
+    user.calendar_token = None if request.form.get('action') == 'revoke' else secrets.token_urlsafe(24)
+    db.session.commit()
+    flash('Ссылка на календарь обновлена.' if user.calendar_token else 'Ссылка на календарь отключена.', 'success')
+    return redirect(url_for('calendar.calendar_settings'))
+
+
+@calendar_bp.route('/<token>.ics')
+def calendar_ics(token):
+    if calendar_feed.user_for_token(token) is None:
+        abort(404)
+    body, etag = calendar_feed.current()
+    response = current_app.response_class(body, mimetype='text/calendar')
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.max_age = current_app.config['CALENDAR_CHECK_INTERVAL']
+    return response.make_conditional(request)
@@ -1,17 +1,30 @@
-from flask import Blueprint, render_template, request
+from concurrent.futures import TimeoutError as FutureTimeout
+
+from flask import Blueprint, render_template, request, current_app, send_file, flash, redirect, url_for
 from flask_login import login_required
 from models import db, Project
+from exports import export_response, commission_rows, portfolio_totals, COMMISSION_HEADER
+from fx import rate_expr
+from forecast import monthly_forecast
+from helpers import parse_date
+from statements import (
+    StatementError, MIMETYPES, available_formats, statement_name, cached_statement, statement_worker,
+)
 
 commissions_bp = Blueprint('commissions', __name__, url_prefix='/commissions')
 
 
+def commission_projects():
+    return Project.query.filter(Project.commission_percent > 0)
+
+
 @commissions_bp.route('/')
 @login_required
 def commission_list():
     page = request.args.get('page', 1, type=int)
     per_page = 25
 
-    query = Project.query.filter(Project.commission_percent > 0)
+    query = commission_projects()
     query = query.order_by(Project.id.desc())
     pagination = query.paginate(page=page, per_page=per_page, error_out=False)
 
@@ -19,6 +32,78 @@ def commission_list():
         'commissions/list.html',
         projects=pagination.items,
         pagination=pagination,
+        totals=portfolio_totals(commission_projects().with_entities(Project.id).statement, rate_expr),
+        reporting_currency=current_app.config['REPORTING_CURRENCY'],
+        statement_formats=available_formats(),
+    )
+
+
+@commissions_bp.route('/export')
+@login_required
+def commission_export():
+    project_ids = commission_projects().with_entities(Project.id).statement
+    return export_response(
+        request.args.get('format', 'csv'), 'commissions', COMMISSION_HEADER, commission_rows(project_ids),
+    )
+
+
+@commissions_bp.route('/forecast')
+@login_required
+def commission_forecast():
+    return render_template('commissions/forecast.html', forecast=monthly_forecast())
+
+
+def _open_statement(path):
+    """Open a cached statement now, so a concurrent rebuild deleting it cannot break the download."""
+    if path is None:
+        return None
+    try:
+        return open(path, 'rb')
+    except FileNotFoundError:
+        return None
+
+
+@commissions_bp.route('/statement')
+@login_required
+def commission_statement():
+    """Download a statement (``project_id`` and/or a ``start``..``end`` period by paid date).
+
+    A statement cached for the current data version is sent at once. Otherwise
+    it is built in the background; the request waits ``STATEMENT_WAIT`` seconds
+    and then shows a page that reloads until the file is ready.
+    """
+    formats = available_formats()
+    fmt = request.args.get('format', formats[0])
+    if fmt not in formats:
+        fmt = formats[0]
+    project_id = request.args.get('project_id', type=int)
+    start = parse_date(request.args.get('start'))
+    end = parse_date(request.args.get('end'))
+    back = url_for('commissions.commission_detail', project_id=project_id) if project_id \
+        else url_for('commissions.commission_list')
+
+    statement = _open_statement(cached_statement(fmt, project_id, start, end))
+    if statement is None:
+        future = statement_worker.submit(fmt, project_id, start, end)
+        try:
+            path = future.result(timeout=current_app.config['STATEMENT_WAIT'])
+        except FutureTimeout:
+            return render_template('commissions/statement_pending.html', back=back), 202
+        except StatementError as e:
+            flash(str(e), 'danger')
+            return redirect(back)
+        except Exception:
+            flash('Не удалось сформировать выписку.', 'danger')
+            return redirect(back)
+        # a newer build may have replaced it already
+        statement = _open_statement(path) or _open_statement(cached_statement(fmt, project_id, start, end))
+        if statement is None:
+            return render_template('commissions/statement_pending.html', back=back), 202
+    return send_file(
+        statement,
+        mimetype=MIMETYPES[fmt],
+        as_attachment=True,
+        download_name=f'commission-{statement_name(project_id, start, end)}.{fmt}',
     )
 
 
@@ -35,12 +120,11 @@ def commission_detail(project_id):
 
     contract_stages = []
     for item in project.payment_items.all():
-        commission_amount = item.amount * cp / 100
         contract_stages.append({
             'title': item.title,
             'percent': float(item.percent),
             'amount': item.amount,
-            'commission': commission_amount,
+            'commission': item.commission,
             'status': item.invoice_status,
             'status_label': item.status_label,
             'is_paid': item.invoice_status == 'paid',
@@ -50,12 +134,11 @@ def commission_detail(project_id):
     for v in project.variations.all():
         v_items = []
         for item in v.payment_items.all():
-            commission_amount = item.amount * cp / 100
             v_items.append({
                 'title': item.title,
                 'percent': float(item.percent),
                 'amount': item.amount,
-                'commission': commission_amount,
+                'commission': item.commission,
                 'status': item.invoice_status,
                 'status_label': item.status_label,
                 'is_paid': item.invoice_status == 'paid',
@@ -71,10 +154,7 @@ def commission_detail(project_id):
     received_var = project.commission_received_from_variations
     total_received = received + received_var
 
-    total_var_commission = 0
-    for v in project.variations.all():
-        for item in v.payment_items.all():
-            total_var_commission += item.amount * cp / 100
+    total_var_commission = project.variation_commission_total
 
     grand_total = total_commission + total_var_commission
     grand_pending = grand_total - total_received
@@ -92,4 +172,5 @@ def commission_detail(project_id):
         grand_total=grand_total,
         total_received=total_received,
         grand_pending=grand_pending,
+        statement_formats=available_formats(),
     )
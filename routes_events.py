@@ -0,0 +1,82 @@
+import json
+import queue
+
+from flask import Blueprint, Response, request
+from flask_login import login_required
+
+from changefeed import change_feed, changes_since, change_to_dict, pruned_through, OVERFLOW
+from models import db
+
+events_bp = Blueprint('events', __name__, url_prefix='/events')
+
+KEEPALIVE_SECONDS = 15
+BACKLOG_LIMIT = 500
+
+
+def topic_filter(topic):
+    if topic == 'leads':
+        return lambda c: c['entity'] == 'lead'
+    if topic.startswith('project:') and topic[8:].isdigit():
+        project_id = int(topic[8:])
+        return lambda c: c['project_id'] == project_id
+    return lambda c: True
+
+
+def format_event(change):
+    return f'id: {change["id"]}\nevent: change\ndata: {json.dumps(change)}\n\n'
+
+
+@events_bp.route('/')
+@login_required
+def event_stream():
+    matches = topic_filter(request.args.get('topic', ''))
+    after = request.headers.get('Last-Event-ID') or request.args.get('after', '')
+    after = int(after) if after.isdigit() else 0
+
+    # Catch up before streaming, then release the DB session: the stream
+    # itself only reads from the in-process queue.
+    feed = change_feed.get()  # the stream outlives the request context that names the tenant
+    q = feed.subscribe()
+    backlog = []
+    if after:
+        backlog = [change_to_dict(c) for c in changes_since(after, limit=BACKLOG_LIMIT)]
+        if len(backlog) >= BACKLOG_LIMIT or after < pruned_through():
+            # part of what the client missed is beyond the backlog or pruned: it has to reload
+            backlog = [OVERFLOW]
+    db.session.remove()
+
+    def stream():
+        last_id = after
+        try:
+            yield 'retry: 3000\n\n'
+            for change in backlog:
+                if change is OVERFLOW:
+                    last_id = 0
+                    yield 'event: reset\ndata: {}\n\n'
+                    break
+                last_id = change['id']
+                if matches(change):
+                    yield format_event(change)
+            while True:
+                try:
+                    change = q.get(timeout=KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                if change is OVERFLOW:
+                    last_id = 0  # the client reloads; ids may also have started over
+                    yield 'event: reset\ndata: {}\n\n'
+                    continue
+                if change['id'] <= last_id:
+                    continue
+                last_id = change['id']
+                if matches(change):
+                    yield format_event(change)
+        finally:
+            feed.unsubscribe(q)
+
+    return Response(
+        stream(),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
@@ -1,36 +1,37 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash
+from datetime import datetime, timedelta
+
+from flask import Blueprint, render_template, request, redirect, url_for, flash, abort, current_app
 from flask_login import login_required
-from models import db, Lead
+from models import db, Lead, ArchivedLead
+from exports import export_response, lead_rows, LEAD_HEADER
+from helpers import selected_ids, redirect_back, parse_date, ListPagination
+from changefeed import publish, latest_change_id
+from audit import record, history
+from lead_import import import_leads, iter_rows, ImportFormatError
+from lead_archive import leads_select, find_lead, restore_lead, restore_leads
+from funnel import record_status_changes, take_snapshot, funnel_report, snapshot_sources, STATUS_ORDER
 
 leads_bp = Blueprint('leads', __name__, url_prefix='/leads')
 
 
-@leads_bp.route('/')
-@login_required
-def lead_list():
-    page = request.args.get('page', 1, type=int)
-    per_page = 25
+def filtered_leads():
     status_filter = request.args.get('status', '')
     source_filter = request.args.get('source', '')
     search = request.args.get('q', '').strip()
+    stmt = leads_select(status_filter, source_filter, search)
+    return stmt, status_filter, source_filter, search
 
-    query = Lead.query
-
-    if status_filter:
-        query = query.filter(Lead.status == status_filter)
-    if source_filter:
-        query = query.filter(Lead.source == source_filter)
-    if search:
-        like = f'%{search}%'
-        query = query.filter(
-            db.or_(
-                Lead.client_name.ilike(like),
-                Lead.phone.ilike(like),
-            )
-        )
 
-    query = query.order_by(Lead.created_at.desc())
-    pagination = query.paginate(page=page, per_page=per_page, error_out=False)
+@leads_bp.route('/')
+@login_required
+def lead_list():
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = 25
+    last_change_id = latest_change_id()
+    stmt, status_filter, source_filter, search = filtered_leads()
+    total = db.session.scalar(db.select(db.func.count()).select_from(stmt.order_by(None).subquery()))
+    leads = db.session.execute(stmt.limit(per_page).offset((page - 1) * per_page)).all()
+    pagination = ListPagination(leads, total, page, per_page)
 
     sources = db.session.query(Lead.source).filter(Lead.source != '').distinct().all()
     sources = sorted(set(s[0] for s in sources if s[0]))
@@ -44,9 +45,53 @@ def lead_list():
         search=search,
         sources=sources,
         statuses=Lead.STATUS_LABELS,
+        last_change_id=last_change_id,
     )
 
 
+@leads_bp.route('/funnel')
+@login_required
+def lead_funnel():
+    today = datetime.utcnow().date()
+    end = parse_date(request.args.get('end')) or today
+    start = parse_date(request.args.get('start')) or end - timedelta(days=current_app.config['FUNNEL_DEFAULT_DAYS'] - 1)
+    source = request.args.get('source') or None
+    return render_template(
+        'leads/funnel.html',
+        start=start,
+        end=end,
+        source=source,
+        sources=snapshot_sources(start, end),
+        report=funnel_report(start, end, source),
+        statuses=Lead.STATUS_LABELS,
+        status_order=STATUS_ORDER,
+    )
+
+
+@leads_bp.route('/funnel/snapshot', methods=['POST'])
+@login_required
+def lead_funnel_snapshot():
+    take_snapshot()
+    flash('Срез воронки за сегодня обновлён.', 'success')
+    return redirect_back(url_for('leads.lead_funnel'))
+
+
+@leads_bp.route('/<int:lead_id>/row')
+@login_required
+def lead_row(lead_id):
+    lead = find_lead(lead_id)
+    if not lead:
+        abort(404)
+    return render_template('leads/_row.html', lead=lead, statuses=Lead.STATUS_LABELS)
+
+
+@leads_bp.route('/export')
+@login_required
+def lead_export():
+    stmt = filtered_leads()[0]
+    return export_response(request.args.get('format', 'csv'), 'leads', LEAD_HEADER, lead_rows(stmt))
+
+
 @leads_bp.route('/create', methods=['GET', 'POST'])
 @login_required
 def lead_create():
@@ -64,6 +109,8 @@ def lead_create():
             flash('Имя клиента обязательно.', 'danger')
             return render_template('leads/form.html', lead=lead, is_new=True)
         db.session.add(lead)
+        db.session.flush()
+        publish('lead', [lead.id], 'created')
         db.session.commit()
         flash('Лид создан.', 'success')
         return redirect(url_for('leads.lead_list'))
@@ -74,12 +121,15 @@ def lead_create():
 @leads_bp.route('/<int:lead_id>/edit', methods=['GET', 'POST'])
 @login_required
 def lead_edit(lead_id):
-    lead = db.session.get(Lead, lead_id)
+    lead = find_lead(lead_id)
     if not lead:
         flash('Лид не найден.', 'danger')
         return redirect(url_for('leads.lead_list'))
 
     if request.method == 'POST':
+        if lead.archived and request.form.get('status', 'new') != 'closed':
+            # reopened: the lead belongs in the hot table again
+            lead = restore_lead(lead.id)
         lead.client_name = request.form.get('client_name', '').strip()
         lead.phone = request.form.get('phone', '').strip()
         lead.location_text = request.form.get('location_text', '').strip()
@@ -92,19 +142,21 @@ def lead_edit(lead_id):
             flash('Имя клиента обязательно.', 'danger')
             return render_template('leads/form.html', lead=lead, is_new=False)
 
+        publish('lead', [lead.id], 'updated')
         db.session.commit()
         flash('Лид обновлён.', 'success')
         return redirect(url_for('leads.lead_list'))
 
-    return render_template('leads/form.html', lead=lead, is_new=False)
+    return render_template('leads/form.html', lead=lead, is_new=False, events=history('lead', lead.id))
 
 
 @leads_bp.route('/<int:lead_id>/delete', methods=['POST'])
 @login_required
 def lead_delete(lead_id):
-    lead = db.session.get(Lead, lead_id)
+    lead = find_lead(lead_id)
     if lead:
         db.session.delete(lead)
+        publish('lead', [lead_id], 'deleted')
         db.session.commit()
         flash('Лид удалён.', 'success')
     return redirect(url_for('leads.lead_list'))
@@ -113,11 +165,101 @@ def lead_delete(lead_id):
 @leads_bp.route('/<int:lead_id>/status', methods=['POST'])
 @login_required
 def lead_status(lead_id):
-    lead = db.session.get(Lead, lead_id)
+    lead = find_lead(lead_id)
     if lead:
         new_status = request.form.get('status', '')
         if new_status in Lead.STATUS_LABELS:
+            if lead.archived and new_status != 'closed':
+                lead = restore_lead(lead.id)
             lead.status = new_status
+            publish('lead', [lead.id], 'updated')
             db.session.commit()
             flash('Статус обновлён.', 'success')
     return redirect(url_for('leads.lead_list'))
+
+
+@leads_bp.route('/<int:lead_id>/restore', methods=['POST'])
+@login_required
+def lead_restore(lead_id):
+    if db.session.get(ArchivedLead, lead_id):
+        restore_lead(lead_id)
+        db.session.commit()
+        flash('Лид возвращён из архива.', 'success')
+    return redirect_back(url_for('leads.lead_list'))
+
+
+@leads_bp.route('/bulk', methods=['POST'])
+@login_required
+def lead_bulk():
+    back = url_for('leads.lead_list')
+    ids = selected_ids()
+    if not ids:
+        flash('Не выбрано ни одного лида.', 'warning')
+        return redirect_back(back)
+
+    action = request.form.get('action', '')
+    options = {'synchronize_session': False}
+    if action == 'status':
+        new_status = request.form.get('status', '')
+        if new_status not in Lead.STATUS_LABELS:
+            flash('Неизвестный статус.', 'danger')
+            return redirect_back(back)
+        if new_status != 'closed':
+            restore_leads(ids)
+        record_status_changes(ids, new_status)
+        count = db.session.execute(
+            db.update(Lead).where(Lead.id.in_(ids)).values(status=new_status), execution_options=options,
+        ).rowcount
+        message = 'Статус обновлён'
+    elif action == 'source':
+        source = request.form.get('source', '').strip()
+        count = sum(
+            db.session.execute(
+                db.update(model).where(model.id.in_(ids)).values(source=source), execution_options=options,
+            ).rowcount
+            for model in (Lead, ArchivedLead)
+        )
+        message = 'Источник обновлён'
+    elif action == 'delete':
+        count = sum(
+            db.session.execute(db.delete(model).where(model.id.in_(ids)), execution_options=options).rowcount
+            for model in (Lead, ArchivedLead)
+        )
+        message = 'Удалено'
+    else:
+        flash('Неизвестное действие.', 'danger')
+        return redirect_back(back)
+
+    publish('lead', ids, 'deleted' if action == 'delete' else 'updated')
+    if action == 'delete':
+        record('lead', ids, 'bulk_deleted')
+    else:
+        record('lead', ids, 'bulk_updated', {action: [None, request.form.get(action, '').strip()]})
+    db.session.commit()
+    flash(f'{message}: {count} лид(ов).', 'success')
+    return redirect_back(back)
+
+
+@leads_bp.route('/import', methods=['GET', 'POST'])
+@login_required
+def lead_import():
+    result = None
+    if request.method == 'POST':
+        file = request.files.get('file')
+        if not file or file.filename == '':
+            flash('Файл не выбран.', 'danger')
+            return redirect(url_for('leads.lead_import'))
+        try:
+            result = import_leads(
+                iter_rows(file.stream, file.filename),
+                default_source=request.form.get('source', '').strip(),
+            )
+        except ImportFormatError as e:
+            flash(str(e), 'danger')
+            return redirect(url_for('leads.lead_import'))
+        flash(
+            f'Импорт завершён: добавлено {result.inserted}, дубликатов {result.duplicates}, '
+            f'ошибок {result.failed}.',
+            'warning' if result.failed else 'success',
+        )
+    return render_template('leads/import.html', result=result)
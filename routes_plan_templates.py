@@ -0,0 +1,141 @@
+from flask import Blueprint, render_template, request, redirect, url_for, flash, abort
+from flask_login import login_required
+from sqlalchemy.exc import IntegrityError
+
+from models import db, PaymentPlanTemplate, PaymentPlanTemplateStage
+from payment_templates import PlanTemplateError, parse_stages, apply_template
+from helpers import selected_ids, redirect_back
+
+plan_templates_bp = Blueprint('plan_templates', __name__, url_prefix='/plan-templates')
+
+BLANK_STAGE_ROWS = 3
+
+
+def _form_stages():
+    return parse_stages(
+        request.form.getlist('stage_title'),
+        request.form.getlist('stage_percent'),
+        request.form.getlist('stage_condition'),
+    )
+
+
+def _submitted_rows():
+    """The stage rows as typed, to show the form again after an error."""
+    return [
+        {'title': title, 'percent': percent, 'due_condition': condition}
+        for title, percent, condition in zip(
+            request.form.getlist('stage_title'),
+            request.form.getlist('stage_percent'),
+            request.form.getlist('stage_condition'),
+        )
+        if title.strip() or percent.strip()
+    ]
+
+
+def _render_form(template, is_new, name=None, rows=None):
+    if rows is None:
+        rows = [{'title': s.title, 'percent': s.percent, 'due_condition': s.due_condition} for s in template.stages]
+    return render_template(
+        'plan_templates/form.html',
+        template=template,
+        is_new=is_new,
+        name=template.name if name is None else name,
+        rows=rows + [{'title': '', 'percent': '', 'due_condition': ''}] * BLANK_STAGE_ROWS,
+    )
+
+
+def _save(template):
+    """Fill ``template`` from the form and commit; returns an error message or None."""
+    name = request.form.get('name', '').strip()
+    if not name:
+        return 'Название шаблона обязательно.'
+    try:
+        stages = _form_stages()
+    except PlanTemplateError as e:
+        return str(e)
+    template.name = name
+    template.stages = [PaymentPlanTemplateStage(position=i, **stage) for i, stage in enumerate(stages)]
+    if template.id is None:
+        db.session.add(template)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return 'Шаблон с таким названием уже есть.'
+    return None
+
+
+@plan_templates_bp.route('/')
+@login_required
+def template_list():
+    templates = PaymentPlanTemplate.query.order_by(PaymentPlanTemplate.name).all()
+    return render_template('plan_templates/list.html', templates=templates)
+
+
+@plan_templates_bp.route('/create', methods=['GET', 'POST'])
+@login_required
+def template_create():
+    template = PaymentPlanTemplate()
+    if request.method == 'POST':
+        error = _save(template)
+        if error is None:
+            flash('Шаблон графика создан.', 'success')
+            return redirect(url_for('plan_templates.template_list'))
+        flash(error, 'danger')
+        return _render_form(template, True, request.form.get('name', ''), _submitted_rows())
+    return _render_form(template, True)
+
+
+@plan_templates_bp.route('/<int:template_id>/edit', methods=['GET', 'POST'])
+@login_required
+def template_edit(template_id):
+    template = db.session.get(PaymentPlanTemplate, template_id)
+    if not template:
+        abort(404)
+    if request.method == 'POST':
+        error = _save(template)
+        if error is None:
+            flash('Шаблон графика обновлён.', 'success')
+            return redirect(url_for('plan_templates.template_list'))
+        flash(error, 'danger')
+        return _render_form(template, False, request.form.get('name', ''), _submitted_rows())
+    return _render_form(template, False)
+
+
+@plan_templates_bp.route('/<int:template_id>/delete', methods=['POST'])
+@login_required
+def template_delete(template_id):
+    template = db.session.get(PaymentPlanTemplate, template_id)
+    if not template:
+        abort(404)
+    db.session.delete(template)
+    db.session.commit()
+    flash('Шаблон графика удалён.', 'success')
+    return redirect(url_for('plan_templates.template_list'))
+
+
+@plan_templates_bp.route('/apply', methods=['POST'])
+@login_required
+def template_apply():
+    """Apply a template to the ticked projects (``ids``) and/or variations (``variation_ids``)."""
+    back = url_for('projects.project_list')
+    template = db.session.get(PaymentPlanTemplate, request.form.get('template_id', type=int) or 0)
+    if not template:
+        flash('Выберите шаблон графика.', 'warning')
+        return redirect_back(back)
+    project_ids = selected_ids()
+    variation_ids = [int(i) for i in request.form.getlist('variation_ids') if i.isdigit()]
+    if not project_ids and not variation_ids:
+        flash('Не выбрано ни одного проекта.', 'warning')
+        return redirect_back(back)
+    try:
+        applied, skipped = apply_template(template, project_ids, variation_ids)
+    except PlanTemplateError as e:
+        flash(f'Шаблон «{template.name}»: {e}', 'danger')
+        return redirect_back(back)
+    db.session.commit()
+    message = f'График «{template.name}» добавлен: {applied}.'
+    if skipped:
+        message += f' Пропущено (уже есть этапы или не найдено): {skipped}.'
+    flash(message, 'success' if applied else 'warning')
+    return redirect_back(back)
@@ -4,15 +4,24 @@ from datetime import datetime, date
 
 from flask import (
     Blueprint, render_template, request, redirect, url_for, flash,
-    current_app, send_from_directory, abort,
+    current_app, send_from_directory, send_file, abort,
 )
 from flask_login import login_required
 from werkzeug.utils import secure_filename
 
 from models import (
     db, Project, PaymentPlanItem, Variation, ExtraPaymentPlanItem,
-    ProjectTask, Document,
+    ProjectTask, Document, PaymentPlanTemplate,
 )
+from storage import compress_stored_file, open_decoded
+from exports import (
+    export_response, project_rows, payment_rows, portfolio_totals, PROJECT_HEADER, PAYMENT_HEADER,
+)
+from fx import rate_expr
+from helpers import selected_ids, redirect_back, parse_date, ListPagination
+from changefeed import publish, publish_owned, latest_change_id
+from audit import record_owned, history
+from tenancy import upload_folder
 
 projects_bp = Blueprint('projects', __name__, url_prefix='/projects')
 
@@ -24,15 +33,6 @@ def allowed_file(filename):
     )
 
 
-def parse_date(s):
-    if not s:
-        return None
-    try:
-        return datetime.strptime(s, '%Y-%m-%d').date()
-    except ValueError:
-        return None
-
-
 def parse_decimal(s, default=0):
     if not s:
         return default
@@ -42,13 +42,58 @@ def parse_decimal(s, default=0):
         return default
 
 
+def stage_status_values(model, new_status):
+    """Column values for a set-based status change of payment stages.
+
+    Mirrors ``payment_status``: the invoice/paid dates are stamped only when
+    still empty and are cleared when a stage goes back to not invoiced.
+    """
+    values = {'invoice_status': new_status}
+    if new_status == 'invoiced':
+        values['invoice_date'] = db.func.coalesce(model.invoice_date, date.today())
+    elif new_status == 'paid':
+        values['paid_date'] = db.func.coalesce(model.paid_date, date.today())
+    elif new_status == 'not_invoiced':
+        values['invoice_date'] = None
+        values['paid_date'] = None
+    return values
+
+
+def bulk_stage_update(model, entity, owners):
+    """Apply the bulk action from the form to the selected stages.
+
+    ``owners`` holds ``(stage id, project id)`` of every selected stage.
+    Returns the number of affected rows, or None for an invalid action.
+    """
+    scope = model.id.in_([stage_id for stage_id, _ in owners])
+    action = request.form.get('action', '')
+    if action == 'status':
+        new_status = request.form.get('invoice_status', '')
+        if new_status not in model.STATUS_LABELS:
+            return None
+        stmt = db.update(model).where(scope).values(stage_status_values(model, new_status))
+    elif action == 'delete':
+        stmt = db.delete(model).where(scope)
+    else:
+        return None
+    result = db.session.execute(stmt, execution_options={'synchronize_session': False})
+    publish_owned(entity, owners, 'deleted' if action == 'delete' else 'updated')
+    if action == 'delete':
+        record_owned(entity, owners, 'bulk_deleted')
+    else:
+        record_owned(entity, owners, 'bulk_updated', {'invoice_status': [None, new_status]})
+    db.session.commit()
+    return result.rowcount
+
+
+def plan_template_choices():
+    return db.session.query(PaymentPlanTemplate.id, PaymentPlanTemplate.name) \
+        .order_by(PaymentPlanTemplate.name).all()
+
+
 # ======================== PROJECT CRUD ========================
 
-@projects_bp.route('/')
-@login_required
-def project_list():
-    page = request.args.get('page', 1, type=int)
-    per_page = 25
+def filtered_projects():
     status_filter = request.args.get('status', '')
     search = request.args.get('q', '').strip()
     overdue = request.args.get('overdue', '')
@@ -66,6 +111,27 @@ def project_list():
             )
         )
 
+    return query, status_filter, search, overdue
+
+
+def filtered_project_ids():
+    """SELECT of the ids matching the list filters, overdue included, for use in IN."""
+    query, _, _, overdue = filtered_projects()
+    if overdue:
+        query = query.filter(
+            Project.end_date_expr() < date.today().isoformat(),
+            Project.status.notin_(('completed', 'cancelled')),
+        )
+    return query.with_entities(Project.id).statement
+
+
+@projects_bp.route('/')
+@login_required
+def project_list():
+    page = request.args.get('page', 1, type=int)
+    per_page = 25
+    query, status_filter, search, overdue = filtered_projects()
+
     projects_all = query.order_by(Project.id.desc()).all()
 
     if overdue:
@@ -80,32 +146,7 @@ def project_list():
     end = start + per_page
     projects_page = projects_all[start:end]
 
-    class FakePagination:
-        def __init__(self, items, total, page, per_page):
-            self.items = items
-            self.total = total
-            self.page = page
-            self.per_page = per_page
-            self.pages = max(1, (total + per_page - 1) // per_page)
-            self.has_prev = page > 1
-            self.has_next = page < self.pages
-            self.prev_num = page - 1
-            self.next_num = page + 1
-
-        def iter_pages(self, left_edge=2, left_current=2, right_current=3, right_edge=2):
-            last = 0
-            for num in range(1, self.pages + 1):
-                if (
-                    num <= left_edge
-                    or (self.page - left_current <= num <= self.page + right_current)
-                    or num > self.pages - right_edge
-                ):
-                    if last + 1 != num:
-                        yield None
-                    yield num
-                    last = num
-
-    pagination = FakePagination(projects_page, total, page, per_page)
+    pagination = ListPagination(projects_page, total, page, per_page)
 
     return render_template(
         'projects/list.html',
@@ -115,9 +156,22 @@ def project_list():
         search=search,
         overdue=overdue,
         statuses=Project.STATUS_LABELS,
+        totals=portfolio_totals(filtered_project_ids(), rate_expr),
+        reporting_currency=current_app.config['REPORTING_CURRENCY'],
+        plan_templates=plan_template_choices(),
     )
 
 
+@projects_bp.route('/export')
+@login_required
+def project_export():
+    project_ids = filtered_project_ids()
+    fmt = request.args.get('format', 'csv')
+    if request.args.get('what') == 'payments':
+        return export_response(fmt, 'payment_plans', PAYMENT_HEADER, payment_rows(project_ids))
+    return export_response(fmt, 'projects', PROJECT_HEADER, project_rows(project_ids))
+
+
 @projects_bp.route('/create', methods=['GET', 'POST'])
 @login_required
 def project_create():
@@ -136,6 +190,8 @@ def project_create():
             flash('Название проекта обязательно.', 'danger')
             return render_template('projects/form.html', project=project, is_new=True)
         db.session.add(project)
+        db.session.flush()
+        publish('project', [project.id], 'created', project_id=project.id)
         db.session.commit()
         flash('Проект создан.', 'success')
         return redirect(url_for('projects.project_detail', project_id=project.id))
@@ -169,6 +225,9 @@ def project_detail(project_id):
         tasks=tasks,
         tasks_filter=tasks_filter,
         today=date.today(),
+        last_change_id=latest_change_id(),
+        events=history(project_id=project.id) if tab == 'history' else [],
+        plan_templates=plan_template_choices() if tab in ('payments', 'variations') else [],
     )
 
 
@@ -194,6 +253,7 @@ def project_edit(project_id):
             flash('Название проекта обязательно.', 'danger')
             return render_template('projects/form.html', project=project, is_new=False)
 
+        publish('project', [project.id], 'updated', project_id=project.id)
         db.session.commit()
         flash('Проект обновлён.', 'success')
         return redirect(url_for('projects.project_detail', project_id=project.id))
@@ -209,6 +269,7 @@ def project_delete(project_id):
         flash('Проект не найден.', 'danger')
         return redirect(url_for('projects.project_list'))
     project.status = 'cancelled'
+    publish('project', [project.id], 'updated', project_id=project.id)
     db.session.commit()
     flash('Проект отменён (архивирован).', 'warning')
     return redirect(url_for('projects.project_list'))
@@ -229,6 +290,8 @@ def payment_add(project_id):
         due_condition=request.form.get('due_condition', '').strip(),
     )
     db.session.add(item)
+    db.session.flush()
+    publish('payment', [item.id], 'created', project_id=project_id)
     db.session.commit()
     flash('Этап оплаты добавлен.', 'success')
     return redirect(url_for('projects.project_detail', project_id=project_id, tab='payments'))
@@ -243,6 +306,7 @@ def payment_edit(item_id):
     item.title = request.form.get('title', '').strip() or item.title
     item.percent = parse_decimal(request.form.get('percent'), float(item.percent))
     item.due_condition = request.form.get('due_condition', '').strip()
+    publish('payment', [item.id], 'updated', project_id=item.project_id)
     db.session.commit()
     flash('Этап обновлён.', 'success')
     return redirect(url_for('projects.project_detail', project_id=item.project_id, tab='payments'))
@@ -256,6 +320,7 @@ def payment_delete(item_id):
         abort(404)
     pid = item.project_id
     db.session.delete(item)
+    publish('payment', [item_id], 'deleted', project_id=pid)
     db.session.commit()
     flash('Этап удалён.', 'success')
     return redirect(url_for('projects.project_detail', project_id=pid, tab='payments'))
@@ -277,11 +342,33 @@ def payment_status(item_id):
         if new_status == 'not_invoiced':
             item.invoice_date = None
             item.paid_date = None
+        publish('payment', [item.id], 'updated', project_id=item.project_id)
         db.session.commit()
         flash('Статус этапа обновлён.', 'success')
     return redirect(url_for('projects.project_detail', project_id=item.project_id, tab='payments'))
 
 
+@projects_bp.route('/payments/bulk', methods=['POST'])
+@login_required
+def payment_bulk():
+    back = url_for('projects.project_list')
+    ids = selected_ids()
+    if not ids:
+        flash('Не выбрано ни одного этапа.', 'warning')
+        return redirect_back(back)
+    owners = (
+        db.session.query(PaymentPlanItem.id, PaymentPlanItem.project_id)
+        .filter(PaymentPlanItem.id.in_(ids))
+        .all()
+    )
+    count = bulk_stage_update(PaymentPlanItem, 'payment', owners)
+    if count is None:
+        flash('Неизвестное действие.', 'danger')
+    else:
+        flash(f'Обновлено этапов: {count}.', 'success')
+    return redirect_back(back)
+
+
 # ======================== VARIATIONS ========================
 
 @projects_bp.route('/<int:project_id>/variations/add', methods=['POST'])
@@ -297,6 +384,8 @@ def variation_add(project_id):
         status=request.form.get('status', 'draft'),
     )
     db.session.add(v)
+    db.session.flush()
+    publish('variation', [v.id], 'created', project_id=project_id)
     db.session.commit()
     flash('Доп. работа добавлена.', 'success')
     return redirect(url_for('projects.project_detail', project_id=project_id, tab='variations'))
@@ -311,6 +400,7 @@ def variation_edit(var_id):
     v.title = request.form.get('title', '').strip() or v.title
     v.extra_amount = parse_decimal(request.form.get('extra_amount'), float(v.extra_amount))
     v.status = request.form.get('status', v.status)
+    publish('variation', [v.id], 'updated', project_id=v.project_id)
     db.session.commit()
     flash('Доп. работа обновлена.', 'success')
     return redirect(url_for('projects.project_detail', project_id=v.project_id, tab='variations'))
@@ -324,6 +414,7 @@ def variation_delete(var_id):
         abort(404)
     pid = v.project_id
     db.session.delete(v)
+    publish('variation', [var_id], 'deleted', project_id=pid)
     db.session.commit()
     flash('Доп. работа удалена.', 'success')
     return redirect(url_for('projects.project_detail', project_id=pid, tab='variations'))
@@ -344,6 +435,8 @@ def extra_payment_add(var_id):
         due_condition=request.form.get('due_condition', '').strip(),
     )
     db.session.add(item)
+    db.session.flush()
+    publish('extra_payment', [item.id], 'created', project_id=v.project_id)
     db.session.commit()
     flash('Этап оплаты (доп.) добавлен.', 'success')
     return redirect(url_for('projects.project_detail', project_id=v.project_id, tab='variations'))
@@ -358,6 +451,7 @@ def extra_payment_edit(item_id):
     item.title = request.form.get('title', '').strip() or item.title
     item.percent = parse_decimal(request.form.get('percent'), float(item.percent))
     item.due_condition = request.form.get('due_condition', '').strip()
+    publish('extra_payment', [item.id], 'updated', project_id=item.variation.project_id)
     db.session.commit()
     flash('Этап (доп.) обновлён.', 'success')
     return redirect(url_for('projects.project_detail', project_id=item.variation.project_id, tab='variations'))
@@ -371,6 +465,7 @@ def extra_payment_delete(item_id):
         abort(404)
     pid = item.variation.project_id
     db.session.delete(item)
+    publish('extra_payment', [item_id], 'deleted', project_id=pid)
     db.session.commit()
     flash('Этап (доп.) удалён.', 'success')
     return redirect(url_for('projects.project_detail', project_id=pid, tab='variations'))
@@ -392,11 +487,34 @@ def extra_payment_status(item_id):
         if new_status == 'not_invoiced':
             item.invoice_date = None
             item.paid_date = None
+        publish('extra_payment', [item.id], 'updated', project_id=item.variation.project_id)
         db.session.commit()
         flash('Статус этапа (доп.) обновлён.', 'success')
     return redirect(url_for('projects.project_detail', project_id=item.variation.project_id, tab='variations'))
 
 
+@projects_bp.route('/extra-payments/bulk', methods=['POST'])
+@login_required
+def extra_payment_bulk():
+    back = url_for('projects.project_list')
+    ids = selected_ids()
+    if not ids:
+        flash('Не выбрано ни одного этапа.', 'warning')
+        return redirect_back(back)
+    owners = (
+        db.session.query(ExtraPaymentPlanItem.id, Variation.project_id)
+        .join(Variation, ExtraPaymentPlanItem.variation_id == Variation.id)
+        .filter(ExtraPaymentPlanItem.id.in_(ids))
+        .all()
+    )
+    count = bulk_stage_update(ExtraPaymentPlanItem, 'extra_payment', owners)
+    if count is None:
+        flash('Неизвестное действие.', 'danger')
+    else:
+        flash(f'Обновлено этапов (доп.): {count}.', 'success')
+    return redirect_back(back)
+
+
 # ======================== TASKS ========================
 
 @projects_bp.route('/<int:project_id>/tasks/add', methods=['POST'])
@@ -412,6 +530,8 @@ def task_add(project_id):
         deadline_date=parse_date(request.form.get('deadline_date')),
     )
     db.session.add(t)
+    db.session.flush()
+    publish('task', [t.id], 'created', project_id=project_id)
     db.session.commit()
     flash('Задача добавлена.', 'success')
     return redirect(url_for('projects.project_detail', project_id=project_id, tab='tasks'))
@@ -426,6 +546,7 @@ def task_edit(task_id):
     t.title = request.form.get('title', '').strip() or t.title
     t.description = request.form.get('description', '').strip()
     t.deadline_date = parse_date(request.form.get('deadline_date'))
+    publish('task', [t.id], 'updated', project_id=t.project_id)
     db.session.commit()
     flash('Задача обновлена.', 'success')
     return redirect(url_for('projects.project_detail', project_id=t.project_id, tab='tasks'))
@@ -444,6 +565,7 @@ def task_toggle(task_id):
             t.completed_at = datetime.utcnow()
         elif new_status == 'open':
             t.completed_at = None
+        publish('task', [t.id], 'updated', project_id=t.project_id)
         db.session.commit()
         flash('Статус задачи обновлён.', 'success')
     return redirect(url_for('projects.project_detail', project_id=t.project_id, tab='tasks'))
@@ -457,11 +579,52 @@ def task_delete(task_id):
         abort(404)
     pid = t.project_id
     db.session.delete(t)
+    publish('task', [task_id], 'deleted', project_id=pid)
     db.session.commit()
     flash('Задача удалена.', 'success')
     return redirect(url_for('projects.project_detail', project_id=pid, tab='tasks'))
 
 
+@projects_bp.route('/tasks/bulk', methods=['POST'])
+@login_required
+def task_bulk():
+    back = url_for('projects.project_list')
+    ids = selected_ids()
+    if not ids:
+        flash('Не выбрано ни одной задачи.', 'warning')
+        return redirect_back(back)
+
+    action = request.form.get('action', '')
+    selected = ProjectTask.id.in_(ids)
+    if action == 'status':
+        new_status = request.form.get('status', '')
+        if new_status not in ProjectTask.STATUS_LABELS:
+            flash('Неизвестный статус.', 'danger')
+            return redirect_back(back)
+        values = {'status': new_status}
+        if new_status == 'done':
+            values['completed_at'] = datetime.utcnow()
+        elif new_status == 'open':
+            values['completed_at'] = None
+        stmt = db.update(ProjectTask).where(selected).values(values)
+    elif action == 'delete':
+        stmt = db.delete(ProjectTask).where(selected)
+    else:
+        flash('Неизвестное действие.', 'danger')
+        return redirect_back(back)
+
+    owners = db.session.query(ProjectTask.id, ProjectTask.project_id).filter(selected).all()
+    result = db.session.execute(stmt, execution_options={'synchronize_session': False})
+    publish_owned('task', owners, 'deleted' if action == 'delete' else 'updated')
+    if action == 'delete':
+        record_owned('task', owners, 'bulk_deleted')
+    else:
+        record_owned('task', owners, 'bulk_updated', {'status': [None, new_status]})
+    db.session.commit()
+    flash(f'Обновлено задач: {result.rowcount}.', 'success')
+    return redirect_back(back)
+
+
 # ======================== DOCUMENTS ========================
 
 @projects_bp.route('/<int:project_id>/documents/upload', methods=['POST'])
@@ -488,15 +651,27 @@ def document_upload(project_id):
     ext = original.rsplit('.', 1)[1].lower() if '.' in original else 'bin'
     stored_name = f'{uuid.uuid4().hex}.{ext}'
 
-    file.save(os.path.join(current_app.config['UPLOAD_FOLDER'], stored_name))
+    file.save(os.path.join(upload_folder(), stored_name))
+
+    encoding = ''
+    if ext in current_app.config['COMPRESSIBLE_EXTENSIONS']:
+        stored_name, encoding = compress_stored_file(
+            upload_folder(),
+            stored_name,
+            current_app.config['DOCUMENT_COMPRESSION'],
+            current_app.config['DOCUMENT_COMPRESSION_MIN_SAVING'],
+        )
 
     doc = Document(
         project_id=project_id,
         doc_type=doc_type,
         file_name=stored_name,
         original_name=file.filename,
+        encoding=encoding,
     )
     db.session.add(doc)
+    db.session.flush()
+    publish('document', [doc.id], 'created', project_id=project_id)
     db.session.commit()
     flash('Документ загружен.', 'success')
     return redirect(url_for('projects.project_detail', project_id=project_id, tab='documents'))
@@ -508,12 +683,34 @@ def document_download(doc_id):
     doc = db.session.get(Document, doc_id)
     if not doc:
         abort(404)
-    return send_from_directory(
-        current_app.config['UPLOAD_FOLDER'],
-        doc.file_name,
-        as_attachment=True,
-        download_name=doc.original_name,
-    )
+    folder = upload_folder()
+    if not doc.encoding:
+        return send_from_directory(
+            folder,
+            doc.file_name,
+            as_attachment=True,
+            download_name=doc.original_name,
+        )
+
+    # Clients that accept the stored encoding get the compressed bytes as is
+    if request.accept_encodings[doc.encoding]:
+        response = send_from_directory(
+            folder,
+            doc.file_name,
+            as_attachment=True,
+            download_name=doc.original_name,
+        )
+        response.headers['Content-Encoding'] = doc.encoding
+    else:
+        if not os.path.isfile(os.path.join(folder, doc.file_name)):
+            abort(404)
+        response = send_file(
+            open_decoded(folder, doc.file_name, doc.encoding),
+            as_attachment=True,
+            download_name=doc.original_name,
+        )
+    response.vary.add('Accept-Encoding')
+    return response
 
 
 @projects_bp.route('/documents/<int:doc_id>/delete', methods=['POST'])
@@ -523,10 +720,11 @@ def document_delete(doc_id):
     if not doc:
         abort(404)
     pid = doc.project_id
-    filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], doc.file_name)
+    filepath = os.path.join(upload_folder(), doc.file_name)
     if os.path.exists(filepath):
         os.remove(filepath)
     db.session.delete(doc)
+    publish('document', [doc_id], 'deleted', project_id=pid)
     db.session.commit()
     flash('Документ удалён.', 'success')
     return redirect(url_for('projects.project_detail', project_id=pid, tab='documents'))
@@ -541,6 +739,7 @@ def project_commission_set(project_id):
     if not project:
         abort(404)
     project.commission_percent = parse_decimal(request.form.get('commission_percent'), 0)
+    publish('project', [project.id], 'updated', project_id=project.id)
     db.session.commit()
     flash('Процент комиссии обновлён.', 'success')
     return redirect(url_for('projects.project_detail', project_id=project_id, tab='main'))
@@ -0,0 +1,30 @@
+from flask import Blueprint, render_template, request, redirect, url_for, flash
+from flask_login import login_required, current_user
+
+from models import db, User, OutboxMessage
+
+reminders_bp = Blueprint('reminders', __name__, url_prefix='/reminders')
+
+RECENT_MESSAGES = 20
+
+
+@reminders_bp.route('/', methods=['GET', 'POST'])
+@login_required
+def reminder_settings():
+    user = db.session.get(User, current_user.id)
+    if request.method == 'POST':
+        email = request.form.get('email', '').strip()
+        enabled = bool(request.form.get('reminders_enabled'))
+        if enabled and '@' not in email:
+            flash('Укажите адрес электронной почты для напоминаний.', 'danger')
+        else:
+            user.email = email
+            user.reminders_enabled = enabled
+            db.session.commit()
+            flash('Напоминания включены.' if enabled else 'Напоминания отключены.', 'success')
+            return redirect(url_for('reminders.reminder_settings'))
+    messages = (
+        OutboxMessage.query.filter_by(user_id=user.id)
+        .order_by(OutboxMessage.id.desc()).limit(RECENT_MESSAGES).all()
+    )
+    return render_template('reminders.html', user=user, messages=messages)
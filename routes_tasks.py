@@ -0,0 +1,138 @@
+from datetime import date, timedelta
+
+from flask import Blueprint, render_template, request, current_app
+from flask_login import login_required
+from sqlalchemy import select, func, or_, and_
+
+from models import db, Project, ProjectTask, PaymentPlanItem, Variation, ExtraPaymentPlanItem
+
+tasks_bp = Blueprint('tasks', __name__, url_prefix='/tasks')
+
+VIEWS = {
+    'overdue': 'Просрочено',
+    'week': 'На этой неделе',
+    'open': 'Все открытые',
+    'nodate': 'Без срока',
+}
+
+MAX_OVERDUE_PAYMENTS = 200
+
+
+def view_condition(view, today):
+    """Filter for one board view; every one is a range on ``(status, deadline_date)``."""
+    conditions = [ProjectTask.status == 'open']
+    if view == 'overdue':
+        conditions.append(ProjectTask.deadline_date < today)
+    elif view == 'week':
+        conditions.append(ProjectTask.deadline_date.between(today, today + timedelta(days=6)))
+    elif view == 'nodate':
+        conditions.append(ProjectTask.deadline_date.is_(None))
+    else:
+        conditions.append(ProjectTask.deadline_date.isnot(None))
+    return and_(*conditions)
+
+
+def parse_cursor(value):
+    """``<YYYY-MM-DD>:<id>`` of the last row shown (``:<id>`` for tasks without a deadline)."""
+    deadline, _, last_id = (value or '').partition(':')
+    if not last_id.isdigit():
+        return None
+    try:
+        return (date.fromisoformat(deadline) if deadline else None), int(last_id)
+    except ValueError:
+        return None
+
+
+def board_page(view, today, cursor, per_page):
+    stmt = (
+        select(
+            ProjectTask.id, ProjectTask.title, ProjectTask.deadline_date, ProjectTask.project_id,
+            Project.project_name,
+        )
+        .join(Project, Project.id == ProjectTask.project_id)
+        .where(view_condition(view, today))
+        .order_by(ProjectTask.deadline_date, ProjectTask.id)
+        .limit(per_page + 1)
+    )
+    if cursor:
+        deadline, last_id = cursor
+        if deadline is None:
+            stmt = stmt.where(ProjectTask.id > last_id)
+        else:
+            stmt = stmt.where(or_(
+                ProjectTask.deadline_date > deadline,
+                and_(ProjectTask.deadline_date == deadline, ProjectTask.id > last_id),
+            ))
+    rows = db.session.execute(stmt).all()
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        last = rows[-1]
+        next_cursor = f"{last.deadline_date.isoformat() if last.deadline_date else ''}:{last.id}"
+    return rows, next_cursor
+
+
+def group_by_project(rows):
+    """Keep the deadline order: projects appear in the order of their most urgent task."""
+    groups = {}
+    for r in rows:
+        groups.setdefault((r.project_id, r.project_name), []).append(r)
+    return [{'project_id': pid, 'project_name': name, 'items': items} for (pid, name), items in groups.items()]
+
+
+def overdue_payments(today):
+    """Invoiced stages unpaid for longer than ``PAYMENT_TERMS_DAYS``, contract and variation."""
+    cutoff = today - timedelta(days=current_app.config['PAYMENT_TERMS_DAYS'])
+    contract = (
+        select(
+            PaymentPlanItem.id, PaymentPlanItem.title, PaymentPlanItem.invoice_date,
+            Project.id.label('project_id'), Project.project_name, Project.currency,
+            db.literal('').label('variation_title'),
+            (PaymentPlanItem.amount_minor / 100.0).label('amount'),
+        )
+        .join(Project, Project.id == PaymentPlanItem.project_id)
+        .where(PaymentPlanItem.invoice_status == 'invoiced', PaymentPlanItem.invoice_date < cutoff)
+    )
+    extra = (
+        select(
+            ExtraPaymentPlanItem.id, ExtraPaymentPlanItem.title, ExtraPaymentPlanItem.invoice_date,
+            Project.id.label('project_id'), Project.project_name, Project.currency,
+            Variation.title.label('variation_title'),
+            (ExtraPaymentPlanItem.amount_minor / 100.0).label('amount'),
+        )
+        .join(Variation, Variation.id == ExtraPaymentPlanItem.variation_id)
+        .join(Project, Project.id == Variation.project_id)
+        .where(ExtraPaymentPlanItem.invoice_status == 'invoiced', ExtraPaymentPlanItem.invoice_date < cutoff)
+    )
+    union = contract.union_all(extra).subquery()
+    stmt = select(union).order_by(union.c.invoice_date, union.c.id).limit(MAX_OVERDUE_PAYMENTS)
+    return db.session.execute(stmt).all()
+
+
+@tasks_bp.route('/')
+@login_required
+def task_board():
+    view = request.args.get('view', 'overdue')
+    if view not in VIEWS:
+        view = 'overdue'
+    today = date.today()
+    per_page = current_app.config['PER_PAGE']
+
+    rows, next_cursor = board_page(view, today, parse_cursor(request.args.get('after')), per_page)
+    counts = {
+        v: db.session.scalar(select(func.count()).select_from(ProjectTask).where(view_condition(v, today)))
+        for v in VIEWS
+    }
+
+    return render_template(
+        'tasks/board.html',
+        view=view,
+        views=VIEWS,
+        counts=counts,
+        groups=group_by_project(rows),
+        next_cursor=next_cursor,
+        is_first_page=not request.args.get('after'),
+        payments=overdue_payments(today),
+        payment_terms=current_app.config['PAYMENT_TERMS_DAYS'],
+        today=today,
+    )
@@ -0,0 +1,174 @@
+import hmac
+from collections import OrderedDict
+from threading import Lock
+
+from flask import Blueprint, request, jsonify
+from sqlalchemy.exc import IntegrityError
+
+from models import db, Lead, WebhookReceipt, normalize_phone
+from lead_import import COLUMN_ALIASES
+from write_buffer import BatchWriter
+from changefeed import publish
+from tenancy import current_tenant, tenant_tokens
+
+webhooks_bp = Blueprint('webhooks', __name__, url_prefix='/webhooks')
+
+MAX_ITEMS_PER_REQUEST = 1000
+RECENT_KEYS_SIZE = 100000
+
+FIELD_BY_ALIAS = {
+    alias: field for field, aliases in COLUMN_ALIASES.items() for alias in aliases
+}
+FIELD_LIMITS = {
+    'client_name': 200,
+    'phone': 50,
+    'location_text': 300,
+    'request_description': 10000,
+    'comment': 10000,
+}
+
+
+def write_leads(items):
+    """Insert a batch of queued webhook leads, dropping already seen idempotency keys."""
+    keys = [i['key'] for i in items if i['key']]
+    seen = set()
+    if keys:
+        seen = {
+            k for (k,) in db.session.query(WebhookReceipt.idempotency_key)
+            .filter(WebhookReceipt.idempotency_key.in_(keys))
+        }
+    try:
+        _insert_batch(items, set(seen))
+        db.session.commit()
+    except IntegrityError:
+        # another worker stored some of the same keys meanwhile; go row by row
+        db.session.rollback()
+        for item in items:
+            try:
+                _insert_batch([item], seen)
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+
+
+def _insert_batch(items, seen):
+    leads = []
+    receipts = []
+    for item in items:
+        if item['key'] in seen:
+            continue
+        if item['key']:
+            seen.add(item['key'])
+        lead = Lead(**item['lead'])
+        leads.append(lead)
+        receipts.append((item['key'], lead))
+    db.session.add_all(leads)
+    db.session.flush()
+    if leads:
+        publish('lead', [lead.id for lead in leads], 'created')
+    db.session.add_all([
+        WebhookReceipt(idempotency_key=key, lead_id=lead.id) for key, lead in receipts if key
+    ])
+
+
+_recent_keys = OrderedDict()
+_recent_lock = Lock()
+
+
+def _forget_keys(tenant, items):
+    """Let retries of items that were never written through again."""
+    with _recent_lock:
+        for item in items:
+            _recent_keys.pop((tenant, item['key']), None)
+
+
+lead_buffer = BatchWriter('webhook-leads', write_leads, on_drop=_forget_keys)
+
+
+def _is_retry(key):
+    """True if ``key`` was already accepted by this process recently (for the current tenant)."""
+    key = (current_tenant(), key)
+    with _recent_lock:
+        if key in _recent_keys:
+            return True
+        _recent_keys[key] = True
+        if len(_recent_keys) > RECENT_KEYS_SIZE:
+            _recent_keys.popitem(last=False)
+        return False
+
+
+def init_webhooks(app):
+    lead_buffer.init_app(
+        app,
+        max_rows=app.config['WEBHOOK_FLUSH_MAX_ROWS'],
+        interval=app.config['WEBHOOK_FLUSH_INTERVAL_MS'] / 1000,
+        max_pending=app.config['WEBHOOK_BUFFER_MAX'],
+    )
+
+
+def token_source():
+    token = request.headers.get('X-Webhook-Token') or request.args.get('token', '')
+    _, webhook_tokens = tenant_tokens()
+    for source, expected in webhook_tokens.items():
+        if token and hmac.compare_digest(token, expected):
+            return source
+    return None
+
+
+def parse_lead(payload, source):
+    if not isinstance(payload, dict):
+        return None, 'Ожидается JSON-объект'
+    values = {}
+    for key, value in payload.items():
+        field = FIELD_BY_ALIAS.get(str(key).strip().lower())
+        if field in FIELD_LIMITS and field not in values and value is not None:
+            values[field] = str(value).strip()[:FIELD_LIMITS[field]]
+    if not values.get('client_name'):
+        return None, 'Не указано имя клиента'
+    phone = normalize_phone(values.get('phone', ''))
+    values['phone'] = phone
+    values['source'] = source
+    values['status'] = 'new'
+    return values, None
+
+
+@webhooks_bp.route('/leads', methods=['POST'])
+def webhook_leads():
+    source = token_source()
+    if source is None:
+        return jsonify(error='Неверный токен.'), 401
+
+    payload = request.get_json(silent=True)
+    if payload is None:
+        return jsonify(error='Ожидается JSON.'), 400
+    batch = payload if isinstance(payload, list) else [payload]
+    if len(batch) > MAX_ITEMS_PER_REQUEST:
+        return jsonify(error=f'Не более {MAX_ITEMS_PER_REQUEST} лидов за запрос.'), 413
+
+    header_key = request.headers.get('Idempotency-Key', '').strip()
+    items = []
+    errors = []
+    duplicates = 0
+    for idx, entry in enumerate(batch):
+        lead, error = parse_lead(entry, source)
+        if error:
+            errors.append({'index': idx, 'error': error})
+            continue
+        key = ''
+        if isinstance(entry, dict):
+            key = str(entry.get('idempotency_key') or entry.get('id') or '').strip()
+        if not key and header_key:
+            key = header_key if len(batch) == 1 else f'{header_key}:{idx}'
+        if key:
+            key = f'{source}:{key}'[:200]
+            if _is_retry(key):
+                duplicates += 1
+                continue
+        items.append({'key': key, 'lead': lead})
+
+    if items and not lead_buffer.submit(items):
+        _forget_keys(current_tenant(), items)
+        return jsonify(error='Очередь переполнена, повторите позже.'), 503
+
+    status = 202 if items or duplicates else 400
+    return jsonify(accepted=len(items), duplicates=duplicates, errors=errors), status
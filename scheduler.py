@@ -0,0 +1,160 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, insert, update, delete
+from sqlalchemy.exc import IntegrityError
+
+from models import db, JobRun
+from tenancy import tenant_names, tenant_context, tenant_engines
+
+log = logging.getLogger(__name__)
+
+
+class Scheduler:
+    """Per-process thread running daily jobs at a set UTC time and interval jobs.
+
+    Every worker process checks the clock, but a job runs only in the one
+    that inserts its ``JobRun`` row first: one row per day for daily jobs,
+    one per period for interval jobs. A failed run deletes its claim, so
+    the next check retries it; a claim left unfinished for ``claim_timeout``
+    seconds (its worker died) is taken over. In multi-tenant mode each job
+    runs once per tenant.
+
+    The thread starts with the app, except under ``flask`` CLI commands;
+    forked workers start their own on their first request.
+    """
+
+    def __init__(self, check_interval=60, claim_timeout=3 * 3600):
+        self.check_interval = check_interval
+        self.claim_timeout = claim_timeout
+        self.enabled = True
+        self.app = None
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._settled = set()  # (claim, tenant, day) finished here or elsewhere
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config['SCHEDULER_ENABLED']
+        self.check_interval = app.config['SCHEDULER_CHECK_INTERVAL']
+        self.claim_timeout = app.config['SCHEDULER_CLAIM_TIMEOUT']
+        app.before_request(self.ensure_thread)
+        if os.environ.get('FLASK_RUN_FROM_CLI') != 'true':
+            self.ensure_thread()
+
+    def daily(self, name, at, fn):
+        """Run ``fn()`` once a day, at the first check after ``at`` (``'HH:MM'``, UTC) that day."""
+        hour, minute = (int(part) for part in at.split(':'))
+        self.jobs[name] = (lambda now: name if (now.hour, now.minute) >= (hour, minute) else None, fn)
+
+    def every(self, name, seconds, fn):
+        """Run ``fn()`` once per ``seconds``-long period (at the first check within it)."""
+        epoch = datetime(1970, 1, 1)
+        self.jobs[name] = (lambda now: f'{name}:{int((now - epoch).total_seconds()) // seconds}', fn)
+
+    def ensure_thread(self):
+        if not self.enabled or (self._thread is not None and self._pid == os.getpid()):
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='scheduler', daemon=True)
+            self._thread.start()
+
+    def due(self, now):
+        """``(claim, fn)`` of every job due at ``now``."""
+        due = []
+        for claim_of, fn in self.jobs.values():
+            claim = claim_of(now)
+            if claim is not None:
+                due.append((claim, fn))
+        return due
+
+    def _claim(self, claim, day):
+        """True if the claim is ours now, False if the job is done, None if it runs elsewhere."""
+        for _ in range(2):
+            try:
+                db.session.execute(insert(JobRun).values(job=claim, run_on=day))
+                db.session.commit()
+                return True
+            except IntegrityError:
+                db.session.rollback()
+            this_run = (JobRun.job == claim, JobRun.run_on == day)
+            finished = db.session.execute(select(JobRun.finished_at).where(*this_run)).scalar()
+            if finished is not None:
+                return False
+            # only one process gets to delete a stale claim and try again
+            stale = db.session.execute(delete(JobRun).where(
+                *this_run, JobRun.finished_at.is_(None),
+                JobRun.started_at < datetime.utcnow() - timedelta(seconds=self.claim_timeout),
+            ))
+            db.session.commit()
+            if not stale.rowcount:
+                return None
+            log.warning('scheduler: %s was never finished, running it again', claim)
+        return None
+
+    def run(self, claim, fn, day):
+        """Run ``fn`` unless some process already claimed ``claim`` for ``day``.
+
+        True if it ran here, False if it ran elsewhere, None while another
+        process is still running it.
+        """
+        claimed = self._claim(claim, day)
+        if not claimed:
+            return claimed
+        this_run = (JobRun.job == claim, JobRun.run_on == day)
+        try:
+            fn()
+        except Exception:
+            db.session.rollback()
+            db.session.execute(delete(JobRun).where(*this_run))
+            db.session.commit()
+            raise
+        db.session.execute(update(JobRun).where(*this_run).values(finished_at=datetime.utcnow()))
+        if ':' in claim:
+            # interval jobs claim a row per period; older ones have served their purpose
+            name = claim.split(':', 1)[0]
+            db.session.execute(delete(JobRun).where(
+                JobRun.job.startswith(name + ':'), JobRun.run_on < day - timedelta(days=2),
+            ))
+        db.session.commit()
+        return True
+
+    def run_pending(self, now=None):
+        now = now or datetime.utcnow()
+        self._settled = {key for key in self._settled if key[2] == now.date()}
+        for claim, fn in self.due(now):
+            with self.app.app_context():
+                for tenant in tenant_names():
+                    key = (claim, tenant, now.date())
+                    if key in self._settled:
+                        continue
+                    with tenant_context(tenant):
+                        try:
+                            ran = self.run(claim, fn, now.date())
+                            if ran:
+                                log.info('scheduler: %s done%s', claim, f' for {tenant}' if tenant else '')
+                            if ran is not None:
+                                self._settled.add(key)
+                        except Exception:
+                            log.exception('scheduler: %s failed%s', claim, f' for {tenant}' if tenant else '')
+
+    def _run(self):
+        while True:
+            time.sleep(self.check_interval)
+            try:
+                self.run_pending()
+            except Exception:
+                log.exception('scheduler: check failed')
+            # engines are otherwise only swept when some tenant is used
+            tenant_engines.close_idle()
+
+
+scheduler = Scheduler()
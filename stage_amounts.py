@@ -0,0 +1,107 @@
+from sqlalchemy import event, select, update, func, cast, or_, Integer
+
+from models import db, Project, PaymentPlanItem, Variation, ExtraPaymentPlanItem
+
+STAGE_COLUMNS = ('amount_minor', 'commission_minor')
+
+PENDING_KEY = 'stage_amounts_pending'
+
+
+def _minor(base, percent, commission_percent=None):
+    """``base * percent / 100`` (times ``commission_percent / 100``) in minor units."""
+    value = func.coalesce(base, 0) * percent
+    if commission_percent is not None:
+        value = value * func.coalesce(commission_percent, 0) / 100
+    return cast(func.round(value), Integer)
+
+
+def refresh_stage_amounts(project_ids=None, variation_ids=None, connection=None):
+    """Recompute persisted stage amounts with two set-based UPDATEs.
+
+    ``project_ids`` refreshes contract stages and every variation stage of
+    those projects; ``variation_ids`` refreshes the stages of those
+    variations. With neither given, every stage is recomputed.
+    """
+    execute = (connection or db.session).execute
+    everything = project_ids is None and variation_ids is None
+    project_ids = list(project_ids or ())
+    variation_ids = list(variation_ids or ())
+
+    contract_amount = select(Project.contract_amount).where(Project.id == PaymentPlanItem.project_id) \
+        .scalar_subquery()
+    commission_percent = select(Project.commission_percent).where(Project.id == PaymentPlanItem.project_id) \
+        .scalar_subquery()
+    stmt = update(PaymentPlanItem).values(
+        amount_minor=_minor(contract_amount, PaymentPlanItem.percent),
+        commission_minor=_minor(contract_amount, PaymentPlanItem.percent, commission_percent),
+    )
+    if not everything:
+        stmt = stmt.where(PaymentPlanItem.project_id.in_(project_ids))
+    if everything or project_ids:
+        execute(stmt, execution_options={'synchronize_session': False})
+
+    extra_amount = select(Variation.extra_amount).where(Variation.id == ExtraPaymentPlanItem.variation_id) \
+        .scalar_subquery()
+    extra_commission = (
+        select(Project.commission_percent)
+        .join(Variation, Variation.project_id == Project.id)
+        .where(Variation.id == ExtraPaymentPlanItem.variation_id)
+        .scalar_subquery()
+    )
+    stmt = update(ExtraPaymentPlanItem).values(
+        amount_minor=_minor(extra_amount, ExtraPaymentPlanItem.percent),
+        commission_minor=_minor(extra_amount, ExtraPaymentPlanItem.percent, extra_commission),
+    )
+    if not everything:
+        stmt = stmt.where(or_(
+            ExtraPaymentPlanItem.variation_id.in_(variation_ids),
+            ExtraPaymentPlanItem.variation_id.in_(
+                select(Variation.id).where(Variation.project_id.in_(project_ids))
+            ),
+        ))
+    if everything or project_ids or variation_ids:
+        execute(stmt, execution_options={'synchronize_session': False})
+
+
+def _changed(obj, *keys):
+    state = db.inspect(obj)
+    return any(state.attrs[key].history.has_changes() for key in keys)
+
+
+def _after_flush(session, flush_context):
+    projects, variations = set(), set()
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, PaymentPlanItem) and (obj in session.new or _changed(obj, 'percent', 'project_id')):
+            projects.add(obj.project_id)
+        elif isinstance(obj, ExtraPaymentPlanItem) and (
+            obj in session.new or _changed(obj, 'percent', 'variation_id')
+        ):
+            variations.add(obj.variation_id)
+        elif isinstance(obj, Project) and obj not in session.new and _changed(
+            obj, 'contract_amount', 'commission_percent'
+        ):
+            projects.add(obj.id)
+        elif isinstance(obj, Variation) and obj not in session.new and _changed(obj, 'extra_amount'):
+            variations.add(obj.id)
+    if projects or variations:
+        pending = session.info.setdefault(PENDING_KEY, [set(), set()])
+        pending[0].update(projects)
+        pending[1].update(variations)
+
+
+def _after_flush_postexec(session, flush_context):
+    pending = session.info.pop(PENDING_KEY, None)
+    if not pending:
+        return
+    projects, variations = pending
+    refresh_stage_amounts(projects, variations, connection=session.connection())
+    # loaded stages still hold the old values; expiring all of them is cheap
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, (PaymentPlanItem, ExtraPaymentPlanItem)):
+            session.expire(obj, STAGE_COLUMNS)
+
+
+def init_stage_amounts(app):
+    if not event.contains(db.session, 'after_flush', _after_flush):
+        event.listen(db.session, 'after_flush', _after_flush)
+        event.listen(db.session, 'after_flush_postexec', _after_flush_postexec)
@@ -0,0 +1,74 @@
+import logging
+import os
+import time
+
+from flask import request
+
+log = logging.getLogger(__name__)
+
+
+def process_start_time():
+    """Epoch time this process was started (forked), from /proc; import time elsewhere."""
+    try:
+        with open('/proc/self/stat') as f:
+            # fields after the parenthesised command name; starttime is field 22
+            ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return time.time() - uptime + ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return time.time()
+
+
+class StartupTimer:
+    """Durations of the ``create_app`` phases and the time to the first response.
+
+    Everything is logged at INFO and kept in ``app.extensions['startup']``
+    (milliseconds) so deploys can track time-to-first-request.
+    """
+
+    def __init__(self):
+        self.process_started = process_start_time()
+        self.phases = []
+        self.first_request = None
+        self._last = time.perf_counter()
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, round((now - self._last) * 1000, 1)))
+        self._last = now
+
+    def report(self):
+        return {
+            'since_process_start_ms': round((time.time() - self.process_started) * 1000, 1),
+            'phases_ms': dict(self.phases),
+            'first_request': self.first_request,
+        }
+
+    def init_app(self, app):
+        app.extensions['startup'] = self
+        log.info(
+            'create_app done %.0f ms after process start (%s)',
+            (time.time() - self.process_started) * 1000,
+            ', '.join(f'{name} {ms:.0f} ms' for name, ms in self.phases),
+        )
+
+        @app.before_request
+        def start_first_request_timer():
+            if self.first_request is None:
+                request.environ['startup.request_started'] = time.perf_counter()
+
+        @app.after_request
+        def log_first_request(response):
+            started = request.environ.pop('startup.request_started', None)
+            if started is not None and self.first_request is None:
+                self.first_request = {
+                    'path': request.path,
+                    'handler_ms': round((time.perf_counter() - started) * 1000, 1),
+                    'since_process_start_ms': round((time.time() - self.process_started) * 1000, 1),
+                }
+                log.info(
+                    'first request %s served in %.0f ms, %.0f ms after process start',
+                    request.path, self.first_request['handler_ms'], self.first_request['since_process_start_ms'],
+                )
+            return response
@@ -0,0 +1,486 @@
+import csv
+import logging
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import select, func, or_
+
+from models import db, Project, PaymentPlanItem, Variation, ExtraPaymentPlanItem, ChangeLog
+from changefeed import latest_change_id, pruned_through
+from exports import project_totals_select, commission_figures
+from tenancy import current_tenant, tenant_context
+
+try:
+    import openpyxl
+    from openpyxl.styles import Font
+except ImportError:  # optional dependency, only needed for .xlsx statements
+    openpyxl = None
+
+try:
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import A4, landscape
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
+except ImportError:  # optional dependency, only needed for .pdf statements
+    pdfmetrics = None
+
+log = logging.getLogger(__name__)
+
+# bump when the layout changes, so statements cached by an older version are rebuilt
+LAYOUT_VERSION = 1
+
+MIMETYPES = {
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'pdf': 'application/pdf',
+    'csv': 'text/csv',
+}
+
+HEADER = [
+    'Доп. работа', 'Этап', 'Процент', 'Сумма', 'Статус', 'Дата счёта', 'Дата оплаты', 'Комиссия',
+]
+
+PDF_FONT = 'StatementFont'
+
+# change-log entities whose changes show up in a statement
+STATEMENT_ENTITIES = ('project', 'payment', 'extra_payment', 'variation')
+
+
+class StatementError(Exception):
+    pass
+
+
+def _pdf_font():
+    """Register the TTF font with Cyrillic glyphs once; False when there is none."""
+    if PDF_FONT in pdfmetrics.getRegisteredFontNames():
+        return True
+    path = current_app.config['STATEMENT_PDF_FONT']
+    if not path or not os.path.isfile(path):
+        return False
+    pdfmetrics.registerFont(TTFont(PDF_FONT, path))
+    return True
+
+
+def available_formats():
+    formats = []
+    if openpyxl is not None:
+        formats.append('xlsx')
+    if pdfmetrics is not None and _pdf_font():
+        formats.append('pdf')
+    formats.append('csv')
+    return formats
+
+
+# ======================== DATA ========================
+
+def data_version(project_id=None):
+    """Newest change-log id that can affect the statement of ``project_id`` (or of all projects).
+
+    Changes recorded without a project ("many rows changed") count for
+    every statement.
+    """
+    query = select(func.max(ChangeLog.id)).where(ChangeLog.entity.in_(STATEMENT_ENTITIES))
+    if project_id is not None:
+        query = query.where(or_(ChangeLog.project_id == project_id, ChangeLog.project_id.is_(None)))
+    return db.session.execute(query).scalar() or 0
+
+
+def _period_conditions(model, start, end):
+    if start is None and end is None:
+        return []
+    conditions = [model.invoice_status == 'paid']
+    if start is not None:
+        conditions.append(model.paid_date >= start)
+    if end is not None:
+        conditions.append(model.paid_date <= end)
+    return conditions
+
+
+def statement_stages(project_id=None, start=None, end=None):
+    """Contract and variation stages of one project or all, paid within ``start``..``end`` if given."""
+    contract = (
+        select(
+            PaymentPlanItem.project_id, db.literal('').label('variation_title'),
+            PaymentPlanItem.id.label('item_id'), PaymentPlanItem.title, PaymentPlanItem.percent,
+            PaymentPlanItem.amount_minor, PaymentPlanItem.commission_minor, PaymentPlanItem.invoice_status,
+            PaymentPlanItem.invoice_date, PaymentPlanItem.paid_date, db.literal(0).label('kind'),
+        )
+        .where(*_period_conditions(PaymentPlanItem, start, end))
+    )
+    extra = (
+        select(
+            Variation.project_id, Variation.title.label('variation_title'),
+            ExtraPaymentPlanItem.id.label('item_id'), ExtraPaymentPlanItem.title, ExtraPaymentPlanItem.percent,
+            ExtraPaymentPlanItem.amount_minor, ExtraPaymentPlanItem.commission_minor,
+            ExtraPaymentPlanItem.invoice_status, ExtraPaymentPlanItem.invoice_date, ExtraPaymentPlanItem.paid_date,
+            db.literal(1).label('kind'),
+        )
+        .join(Variation, Variation.id == ExtraPaymentPlanItem.variation_id)
+        .where(*_period_conditions(ExtraPaymentPlanItem, start, end))
+    )
+    if project_id is not None:
+        contract = contract.where(PaymentPlanItem.project_id == project_id)
+        extra = extra.where(Variation.project_id == project_id)
+    union = contract.union_all(extra).subquery()
+    return db.session.execute(
+        select(union).order_by(union.c.project_id, union.c.kind, union.c.item_id)
+    ).all()
+
+
+def project_ids_paid_in(start, end):
+    """Projects with a stage paid within ``start``..``end``: one statement each at month end."""
+    return sorted({s.project_id for s in statement_stages(None, start, end)})
+
+
+def statement_data(project_id=None, start=None, end=None):
+    """Everything a statement shows, grouped by project, with totals per currency.
+
+    A project statement without a period has the figures of
+    ``commission_detail``; with a period (and for all projects) it lists
+    the stages paid in that period and the commission received for them.
+    """
+    stages = statement_stages(project_id, start, end)
+    ids = {s.project_id for s in stages}
+    if project_id is not None:
+        ids.add(project_id)
+    projects = {
+        r.id: r for r in db.session.execute(
+            project_totals_select(list(ids)).order_by(None).order_by(Project.project_name, Project.id)
+        )
+    }
+    if project_id is not None and project_id not in projects:
+        raise StatementError('Проект не найден.')
+
+    groups = {pid: [] for pid in projects}
+    for s in stages:
+        groups[s.project_id].append({
+            'variation_title': s.variation_title,
+            'title': s.title,
+            'percent': float(s.percent or 0),
+            'amount': (s.amount_minor or 0) / 100,
+            'status': PaymentPlanItem.STATUS_LABELS.get(s.invoice_status, s.invoice_status),
+            'invoice_date': s.invoice_date,
+            'paid_date': s.paid_date,
+            'commission': (s.commission_minor or 0) / 100,
+            'is_paid': s.invoice_status == 'paid',
+        })
+
+    result, totals = [], {}
+    for pid, r in projects.items():
+        received = sum(s['commission'] for s in groups[pid] if s['is_paid'])
+        entry = {
+            'id': pid,
+            'name': r.project_name,
+            'client': r.client_name,
+            'currency': r.currency,
+            'commission_percent': float(r.commission_percent or 0),
+            'stages': groups[pid],
+            'received': received,
+            # the full picture only makes sense without a period
+            'figures': commission_figures(r) if start is None and end is None else None,
+        }
+        result.append(entry)
+        totals.setdefault(r.currency, {'received': 0.0})['received'] += received
+
+    if project_id is not None:
+        title = f'Комиссия: {projects[project_id].project_name}'
+    else:
+        title = 'Комиссия по всем проектам'
+    return {
+        'title': title,
+        'period': _period_label(start, end),
+        'generated_at': datetime.now(),
+        'projects': result,
+        'totals': totals,
+    }
+
+
+def _date(d):
+    return d.strftime('%d.%m.%Y') if d else ''
+
+
+def _period_label(start, end):
+    if start is None and end is None:
+        return ''
+    return f"Оплаты за период {_date(start) or '…'} — {_date(end) or '…'}"
+
+
+def _summary_rows(project):
+    """Rows under a project's stages, laid out like the stage rows."""
+    f, cur = project['figures'], project['currency']
+    if f is None:
+        lines = [('Получено за период', project['received'])]
+    else:
+        lines = [
+            ('Комиссия по контракту', f['total']),
+            ('Комиссия по доп. работам', f['var_total']),
+            ('Итого комиссия', f['grand_total']),
+            ('Итого получено', f['total_received']),
+            ('Осталось получить', f['pending']),
+        ]
+    return [['', f'{label}, {cur}', '', '', '', '', '', round(value, 2)] for label, value in lines]
+
+
+def _total_rows(data):
+    return [
+        ['Итого получено', cur, '', '', '', '', '', round(total['received'], 2)]
+        for cur, total in sorted(data['totals'].items())
+    ]
+
+
+def _stage_row(s):
+    return [
+        s['variation_title'], s['title'], round(s['percent'], 2), round(s['amount'], 2), s['status'],
+        _date(s['invoice_date']), _date(s['paid_date']), round(s['commission'], 2),
+    ]
+
+
+def _project_heading(p):
+    heading = f"{p['name']} — {p['currency']}, комиссия {p['commission_percent']:.2f}%"
+    return heading + (f" ({p['client']})" if p['client'] else '')
+
+
+# ======================== WRITERS ========================
+
+def write_csv(data, path):
+    with open(path, 'w', encoding='utf-8-sig', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow([data['title']])
+        if data['period']:
+            writer.writerow([data['period']])
+        for p in data['projects']:
+            writer.writerow([])
+            writer.writerow([_project_heading(p)])
+            writer.writerow(HEADER)
+            writer.writerows(_stage_row(s) for s in p['stages'])
+            writer.writerows(_summary_rows(p))
+        writer.writerow([])
+        writer.writerows(_total_rows(data))
+
+
+def write_xlsx(data, path):
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.title = 'Комиссия'
+    bold = Font(bold=True)
+    money = '#,##0.00'
+
+    def append(values, font=None, money_columns=(4, 8)):
+        sheet.append(values)
+        for cell in sheet[sheet.max_row]:
+            if font is not None:
+                cell.font = font
+            if cell.column in money_columns and isinstance(cell.value, float):
+                cell.number_format = money
+
+    append([data['title']], Font(bold=True, size=14))
+    if data['period']:
+        append([data['period']])
+    for p in data['projects']:
+        append([])
+        append([_project_heading(p)], bold)
+        append(HEADER, bold)
+        for s in p['stages']:
+            append(_stage_row(s))
+        for row in _summary_rows(p):
+            append(row, bold)
+    append([])
+    for row in _total_rows(data):
+        append(row, bold)
+    for column, width in zip('ABCDEFGH', (24, 36, 10, 16, 16, 12, 12, 16)):
+        sheet.column_dimensions[column].width = width
+    workbook.save(path)
+
+
+def _pdf_cell(value):
+    return f'{value:,.2f}' if isinstance(value, float) else value
+
+
+def write_pdf(data, path):
+    styles = getSampleStyleSheet()
+    for style in styles.byName.values():
+        style.fontName = PDF_FONT
+    doc = SimpleDocTemplate(path, pagesize=landscape(A4), title=data['title'])
+    story = [Paragraph(data['title'], styles['Title'])]
+    if data['period']:
+        story.append(Paragraph(data['period'], styles['Normal']))
+    grid = TableStyle([
+        ('FONTNAME', (0, 0), (-1, -1), PDF_FONT),
+        ('FONTSIZE', (0, 0), (-1, -1), 8),
+        ('GRID', (0, 0), (-1, -1), 0.25, colors.grey),
+        ('BACKGROUND', (0, 0), (-1, 0), colors.whitesmoke),
+        ('ALIGN', (2, 1), (3, -1), 'RIGHT'),
+        ('ALIGN', (7, 1), (7, -1), 'RIGHT'),
+    ])
+    for p in data['projects']:
+        story += [Spacer(1, 12), Paragraph(_project_heading(p), styles['Heading3'])]
+        rows = [HEADER] + [_stage_row(s) for s in p['stages']] + _summary_rows(p)
+        story.append(Table([[_pdf_cell(v) for v in row] for row in rows], repeatRows=1, style=grid))
+    story.append(Spacer(1, 12))
+    for row in _total_rows(data):
+        story.append(Paragraph(f'{row[0]}: {row[-1]:,.2f} {row[1]}', styles['Heading4']))
+    story.append(Paragraph(f"Сформировано {data['generated_at']:%d.%m.%Y %H:%M}", styles['Normal']))
+    doc.build(story)
+
+
+WRITERS = {'xlsx': write_xlsx, 'pdf': write_pdf, 'csv': write_csv}
+
+
+# ======================== CACHE ========================
+
+def cache_dir():
+    root = current_app.config['STATEMENT_CACHE_DIR']
+    tenant = current_tenant()
+    return os.path.join(root, tenant) if tenant else root
+
+
+def statement_name(project_id=None, start=None, end=None):
+    name = f'project-{project_id}' if project_id is not None else 'all'
+    if start is not None or end is not None:
+        name += f"_{start.isoformat() if start else ''}_{end.isoformat() if end else ''}"
+    return name
+
+
+def statement_path(fmt, project_id, start, end, version):
+    """Cache file of a statement built when ``version`` was the newest change-log id."""
+    name = statement_name(project_id, start, end)
+    return os.path.join(cache_dir(), f'{name}.v{LAYOUT_VERSION}-{version}.{fmt}')
+
+
+def _cached_versions(fmt, project_id, start, end):
+    """``{version: path}`` of the cached files of one statement."""
+    directory = cache_dir()
+    pattern = re.compile(rf'{re.escape(statement_name(project_id, start, end))}\.v{LAYOUT_VERSION}-(\d+)\.{fmt}')
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return {}
+    versions = {}
+    for name in names:
+        match = pattern.fullmatch(name)
+        if match:
+            versions[int(match.group(1))] = os.path.join(directory, name)
+    return versions
+
+
+def cached_statement(fmt, project_id=None, start=None, end=None):
+    """Path of the cached statement if nothing it shows changed since it was built, else None.
+
+    Once pruning has passed the version of a file, its changes can no
+    longer be checked and the statement is built again.
+    """
+    versions = _cached_versions(fmt, project_id, start, end)
+    if not versions:
+        return None
+    newest = max(versions)
+    if newest < max(data_version(project_id), pruned_through()):
+        return None
+    return versions[newest]
+
+
+def build_statement(fmt, project_id=None, start=None, end=None):
+    """Write the statement to the cache unless an up-to-date one is there; returns its path.
+
+    The file is written under a temporary name and renamed, so readers
+    never see half of it. Older files of the same statement are deleted
+    afterwards; newer ones, built by another worker meanwhile, are kept.
+    """
+    if fmt not in available_formats():
+        raise StatementError(f'Формат {fmt} недоступен.')
+    path = cached_statement(fmt, project_id, start, end)
+    if path is not None:
+        return path
+    # read before the data, so a change landing in between only makes the file look older
+    version = max(latest_change_id(), pruned_through())
+    path = statement_path(fmt, project_id, start, end, version)
+    if os.path.isfile(path):
+        return path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    data = statement_data(project_id, start, end)
+    tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        WRITERS[fmt](data, tmp)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    for older, older_path in _cached_versions(fmt, project_id, start, end).items():
+        if older < version:
+            try:
+                os.remove(older_path)
+            except OSError:
+                pass
+    return path
+
+
+class StatementWorker:
+    """Builds statements on a small thread pool, off the request path.
+
+    Requests for a statement that is already being built share its future,
+    so a burst of downloads of the same statement builds it once.
+    """
+
+    def __init__(self, max_workers=2):
+        self.app = None
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='statements')
+        self._futures = {}
+
+    def init_app(self, app):
+        self.app = app
+        self._executor.shutdown(wait=False)
+        self._executor = ThreadPoolExecutor(
+            max_workers=app.config['STATEMENT_WORKERS'], thread_name_prefix='statements',
+        )
+
+    def _build(self, tenant, spec):
+        with self.app.app_context(), tenant_context(tenant):
+            try:
+                return build_statement(*spec)
+            except StatementError:
+                raise
+            except Exception:
+                log.exception('statement %s failed%s', spec, f' for {tenant}' if tenant else '')
+                raise
+
+    def submit(self, fmt, project_id=None, start=None, end=None):
+        """Future of the statement's path, building it in the background if needed."""
+        tenant = current_tenant()
+        key = (tenant, fmt, project_id, start, end)
+        with self._lock:
+            future = self._futures.get(key)
+            if future is None or future.done():
+                future = self._executor.submit(self._build, tenant, (fmt, project_id, start, end))
+                self._futures[key] = future
+                future.add_done_callback(lambda f, key=key: self._forget(key, f))
+            return future
+
+    def _forget(self, key, future):
+        with self._lock:
+            if self._futures.get(key) is future:
+                del self._futures[key]
+
+
+statement_worker = StatementWorker()
+
+
+def month_end_statements(fmt, start, end):
+    """Build the period statement and one per project paid in it, in parallel.
+
+    Returns ``(paths, failures)``; statements already cached for the
+    current data version are not rebuilt.
+    """
+    specs = [(fmt, None, start, end)] + [(fmt, pid, start, end) for pid in project_ids_paid_in(start, end)]
+    futures = [statement_worker.submit(*spec) for spec in specs]
+    paths, failures = [], []
+    for spec, future in zip(specs, futures):
+        try:
+            paths.append(future.result())
+        except Exception as e:
+            failures.append((spec, e))
+    return paths, failures
@@ -0,0 +1,72 @@
+import gzip
+import os
+import shutil
+
+try:
+    import zstandard
+except ImportError:  # optional dependency
+    zstandard = None
+
+CHUNK_SIZE = 64 * 1024
+
+SUFFIXES = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+
+def resolve_encoding(method):
+    if method == 'zstd' and zstandard is None:
+        return 'gzip'
+    if method in SUFFIXES:
+        return method
+    return ''
+
+
+def _open_writer(path, encoding):
+    if encoding == 'zstd':
+        raw = open(path, 'wb')
+        return zstandard.ZstdCompressor(level=10).stream_writer(raw, closefd=True)
+    return gzip.open(path, 'wb', compresslevel=6)
+
+
+def _open_reader(path, encoding):
+    if encoding == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('Для чтения файла нужен пакет zstandard.')
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    if encoding == 'gzip':
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def compress_stored_file(folder, file_name, method, min_saving=0.1):
+    """Compress ``folder/file_name`` in place when it saves enough space.
+
+    Returns ``(file_name, encoding)`` of the file that ended up on disk; the
+    original is kept untouched when compression does not pay off.
+    """
+    encoding = resolve_encoding(method)
+    if not encoding:
+        return file_name, ''
+
+    src = os.path.join(folder, file_name)
+    packed_name = file_name + SUFFIXES[encoding]
+    dst = os.path.join(folder, packed_name)
+
+    with open(src, 'rb') as fin, _open_writer(dst, encoding) as fout:
+        shutil.copyfileobj(fin, fout, CHUNK_SIZE)
+
+    original_size = os.path.getsize(src)
+    packed_size = os.path.getsize(dst)
+    if original_size == 0 or packed_size > original_size * (1 - min_saving):
+        os.remove(dst)
+        return file_name, ''
+
+    os.remove(src)
+    return packed_name, encoding
+
+
+def open_decoded(folder, file_name, encoding):
+    """File-like object yielding the original bytes of a stored document."""
+    return _open_reader(os.path.join(folder, file_name), encoding)
@@ -0,0 +1,339 @@
+import json
+import os
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from flask import current_app, g, has_app_context, has_request_context
+from flask_sqlalchemy.session import Session as FlaskSession
+from sqlalchemy import create_engine
+
+TENANT_NAME = re.compile(r'^[a-z0-9][a-z0-9_-]{0,62}$')
+SESSION_TENANT_KEY = '_tenant'
+TOKENS_FILE = 'tokens.json'
+
+
+class UnknownTenant(LookupError):
+    pass
+
+
+def current_tenant():
+    """Name of the tenant the current app context works for (None in single-tenant mode)."""
+    if not has_app_context():
+        return None
+    return g.get('tenant')
+
+
+def tenant_dir(name, root=None):
+    return os.path.join(root or current_app.config['TENANT_ROOT'], name)
+
+
+def tenant_exists(name):
+    return bool(name) and bool(TENANT_NAME.match(name)) and os.path.isdir(tenant_dir(name))
+
+
+def tenant_names():
+    """Every tenant with a folder under ``TENANT_ROOT``, or ``[None]`` without tenants."""
+    if not current_app.config['MULTI_TENANT']:
+        return [None]
+    root = current_app.config['TENANT_ROOT']
+    return sorted(n for n in os.listdir(root) if TENANT_NAME.match(n) and os.path.isdir(os.path.join(root, n)))
+
+
+def upload_folder():
+    """Upload root of the current tenant, or ``UPLOAD_FOLDER`` without tenants."""
+    tenant = current_tenant()
+    if tenant:
+        return os.path.join(tenant_dir(tenant), 'uploads')
+    return current_app.config['UPLOAD_FOLDER']
+
+
+_token_files = {}  # tenant -> (mtime, tokens)
+
+
+def tenant_tokens():
+    """``(api_tokens, webhook_tokens)`` accepted for the current tenant.
+
+    Without tenants they are ``API_TOKENS`` and ``WEBHOOK_TOKENS``. In
+    multi-tenant mode every tenant has its own in ``<tenant>/tokens.json``
+    (``{"api": [...], "webhooks": {"source": "token"}}``), so a token only
+    opens the tenant it was issued for, whatever tenant the request names.
+    """
+    config = current_app.config
+    if not config['MULTI_TENANT']:
+        return config['API_TOKENS'], config['WEBHOOK_TOKENS']
+    tenant = current_tenant()
+    if not tenant:
+        return [], {}
+    path = os.path.join(tenant_dir(tenant), TOKENS_FILE)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return [], {}
+    cached = _token_files.get(tenant)
+    if cached is None or cached[0] != mtime:
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        tokens = (
+            [str(t) for t in data.get('api', []) if t],
+            {str(source): str(t) for source, t in data.get('webhooks', {}).items() if t},
+        )
+        cached = _token_files[tenant] = (mtime, tokens)
+    return cached[1]
+
+
+@contextmanager
+def tenant_context(name):
+    """Run a block against tenant ``name`` inside an existing app context.
+
+    The scoped session is dropped on the way in and out, so no object loaded
+    from one tenant's database leaks into another's.
+    """
+    from models import db
+
+    previous = g.get('tenant')
+    db.session.remove()
+    g.tenant = name
+    try:
+        yield
+    finally:
+        db.session.remove()
+        g.tenant = previous
+
+
+def tenant_from_host(host):
+    host = (host or '').split(':', 1)[0].lower()
+    config = current_app.config
+    if host in config['TENANT_HOSTS']:
+        return config['TENANT_HOSTS'][host]
+    domain = config['TENANT_DOMAIN']
+    if domain and host.endswith('.' + domain):
+        return host[:-len(domain) - 1]
+    return None
+
+
+def schema_fingerprint():
+    """Positive 31-bit checksum of the tables, columns and indexes the models declare."""
+    from models import db
+
+    parts = []
+    for table in db.metadata.sorted_tables:
+        parts.append(table.name + (' autoincrement' if table.kwargs.get('sqlite_autoincrement') else ''))
+        parts.extend(f'{c.name}:{c.type!r}' for c in table.columns)
+        parts.extend(sorted(i.name for i in table.indexes))
+    return zlib.crc32('\n'.join(parts).encode('utf-8')) & 0x7fffffff
+
+
+def prepare_database(engine, force=False):
+    """Create missing tables and columns, backfill new derived columns, add the first admin.
+
+    The schema fingerprint is stored in ``PRAGMA user_version`` afterwards;
+    while it matches, a start-up costs a single pragma read.
+    """
+    from models import db, User, upgrade_schema
+    from stage_amounts import refresh_stage_amounts
+    from lead_archive import reserve_archived_ids
+    from auth import password_hasher
+
+    fingerprint = schema_fingerprint()
+    if not force:
+        with engine.connect() as conn:
+            if conn.exec_driver_sql('PRAGMA user_version').scalar() == fingerprint:
+                return False
+    db.metadata.create_all(engine)
+    added = upgrade_schema(engine)
+    with engine.begin() as conn:
+        if {('payment_plan_item', 'amount_minor'), ('extra_payment_plan_item', 'amount_minor')} & added:
+            refresh_stage_amounts(connection=conn)
+        reserve_archived_ids(connection=conn)
+        if conn.execute(db.select(User.id).where(User.username == 'admin')).first() is None:
+            conn.execute(db.insert(User).values(
+                username='admin', password_hash=password_hasher.hash('admin'), must_change_password=True,
+            ))
+        conn.exec_driver_sql(f'PRAGMA user_version = {fingerprint}')
+    return True
+
+
+class TenantEngines:
+    """LRU of per-tenant SQLite engines.
+
+    An engine is created (and its database prepared) on the first request
+    for a tenant in this process. Engines unused for ``idle_timeout`` seconds,
+    or pushed out by ``maxsize``, are disposed, which closes their pooled
+    connections; the next request simply opens them again.
+    """
+
+    def __init__(self, maxsize=32, idle_timeout=600):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self._engines = OrderedDict()
+        self._lock = threading.Lock()
+        self._opening = {}
+        self._swept = time.monotonic()
+
+    def configure(self, app):
+        self.maxsize = app.config['TENANT_ENGINE_CACHE_SIZE']
+        self.idle_timeout = app.config['TENANT_IDLE_TIMEOUT']
+
+    def engine(self, name):
+        now = time.monotonic()
+        evicted = []
+        with self._lock:
+            entry = self._engines.get(name)
+            if entry is not None:
+                entry[1] = now
+                self._engines.move_to_end(name)
+                if now - self._swept > 60:
+                    evicted = self._evict(now)
+        if entry is not None:
+            _forget_tenants(evicted)
+            return entry[0]
+        with self._lock:
+            opening = self._opening.setdefault(name, threading.Lock())
+        # prepare outside the registry lock so other tenants are not held up
+        with opening:
+            with self._lock:
+                entry = self._engines.get(name)
+                if entry is not None:
+                    return entry[0]
+            if not tenant_exists(name):
+                raise UnknownTenant(name)
+            engine = create_engine('sqlite:///' + os.path.join(tenant_dir(name), 'crm.db'))
+            prepare_database(engine)
+            with self._lock:
+                self._engines[name] = [engine, now]
+                self._opening.pop(name, None)
+                evicted = self._evict(now)
+        _forget_tenants(evicted)
+        return engine
+
+    def _evict(self, now):
+        """Dispose idle or surplus engines (lock held); returns their tenant names."""
+        self._swept = now
+        evicted = []
+        for name in list(self._engines):
+            engine, last_used = self._engines[name]
+            if len(self._engines) > self.maxsize or now - last_used > self.idle_timeout:
+                del self._engines[name]
+                engine.dispose()
+                evicted.append(name)
+        return evicted
+
+    def close_idle(self):
+        with self._lock:
+            evicted = self._evict(time.monotonic())
+        _forget_tenants(evicted)
+
+    def open_tenants(self):
+        with self._lock:
+            return list(self._engines)
+
+
+tenant_engines = TenantEngines()
+
+
+class TenantSession(FlaskSession):
+    """Routes every statement to the engine of the current tenant, if there is one."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            tenant = current_tenant()
+            if tenant:
+                return tenant_engines.engine(tenant)
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+_tenant_locals = []
+
+
+def _forget_tenants(names):
+    """Drop the per-process state of tenants whose database was closed."""
+    for name in names:
+        for local in _tenant_locals:
+            local.discard(name)
+        _token_files.pop(name, None)
+
+
+class TenantLocal:
+    """One ``factory(tenant)`` instance per tenant, used as if it were the instance.
+
+    Keeps per-process caches (users, calendar feeds, FX rates, ...) from
+    mixing data of different tenants. A tenant's instance is dropped when
+    its engine is closed for idleness and rebuilt on the next use.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._instances = {}
+        self._lock = threading.Lock()
+        _tenant_locals.append(self)
+
+    def discard(self, tenant):
+        with self._lock:
+            self._instances.pop(tenant, None)
+
+    def get(self, tenant=None):
+        key = tenant if tenant is not None else (current_tenant() or '')
+        instance = self._instances.get(key)
+        if instance is None:
+            with self._lock:
+                instance = self._instances.get(key)
+                if instance is None:
+                    instance = self._instances[key] = self._factory(key)
+        return instance
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+def resolve_tenant():
+    """``before_request`` hook: pick the tenant from the host, the session or the request.
+
+    A tenant named by the request itself (``X-Tenant`` header or ``tenant``
+    argument) is only honoured when the session is not tied to a tenant, i.e.
+    for token-authenticated calls such as calendar feeds, webhooks and the API.
+    """
+    from flask import request, session, redirect, url_for
+
+    name = tenant_from_host(request.host)
+    if name is not None and '_user_id' in session and session.get(SESSION_TENANT_KEY) != name:
+        # a login is only valid in the tenant it was made in: user ids repeat across databases
+        session.clear()
+        g.tenant = name if tenant_exists(name) else None
+        return redirect(url_for('auth_login'))
+    if name is None:
+        name = session.get(SESSION_TENANT_KEY)
+    if name is None and request.endpoint == 'auth_login' and request.method == 'POST':
+        name = request.form.get('tenant', '').strip().lower()
+    if name is None:
+        name = request.headers.get('X-Tenant') or request.args.get('tenant')
+    if name and tenant_exists(name):
+        g.tenant = name
+        return None
+    g.tenant = None
+    if request.endpoint in ('auth_login', 'static'):
+        return None
+    from flask import abort
+    if request.endpoint and request.endpoint.startswith(('api.', 'webhooks.', 'calendar.calendar_ics')):
+        abort(404)
+    return redirect(url_for('auth_login'))
+
+
+def init_tenancy(app):
+    if not app.config['MULTI_TENANT']:
+        return
+    tenant_engines.configure(app)
+    os.makedirs(app.config['TENANT_ROOT'], exist_ok=True)
+    app.before_request_funcs.setdefault(None, []).insert(0, resolve_tenant)
+
+    from flask import appcontext_pushed
+
+    def cli_tenant(sender, **extra):
+        # CLI commands and scripts choose the tenant with CRM_TENANT
+        if not has_request_context() and 'tenant' not in g:
+            g.tenant = os.environ.get('CRM_TENANT') or None
+
+    appcontext_pushed.connect(cli_tenant, app, weak=False)
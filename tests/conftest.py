@@ -0,0 +1,40 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app  # noqa: E402
+from config import Config  # noqa: E402
+from audit import audit_buffer  # noqa: E402
+from routes_webhooks import lead_buffer  # noqa: E402
+from tenancy import tenant_engines  # noqa: E402
+
+
+@pytest.fixture
+def make_app(tmp_path, monkeypatch):
+    """``make_app(**config)``: an app on throwaway databases, without the scheduler."""
+
+    def make(**overrides):
+        settings = {
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmp_path / 'crm.db'),
+            'UPLOAD_FOLDER': str(tmp_path / 'uploads'),
+            'TENANT_ROOT': str(tmp_path / 'tenants'),
+            'JINJA_BYTECODE_CACHE_DIR': '',
+            'SCHEDULER_ENABLED': False,
+            'BCRYPT_ROUNDS': 4,
+            'TESTING': True,
+        }
+        settings.update(overrides)
+        for key, value in settings.items():
+            monkeypatch.setattr(Config, key, value, raising=False)
+        return create_app()
+
+    yield make
+    # buffered writes belong to this test's databases
+    audit_buffer.flush()
+    lead_buffer.flush()
+    # tenant engines are per process; don't let the next test reuse these databases
+    tenant_engines.idle_timeout = -1
+    tenant_engines.close_idle()
@@ -0,0 +1,63 @@
+import routes_events
+from models import db, User, ChangeLog
+from auth import password_hasher
+from changefeed import ChangeFeed, publish
+
+
+def _login(app):
+    with app.app_context():
+        admin = User.query.filter_by(username='admin').one()
+        admin.password_hash = password_hasher.hash('secret')
+        admin.must_change_password = False
+        db.session.commit()
+    client = app.test_client()
+    client.post('/login', data={'username': 'admin', 'password': 'secret'})
+    return client
+
+
+def test_pruning_everything_does_not_reset_the_feed(make_app):
+    app = make_app()
+    feed = ChangeFeed()
+    feed.init_app(app)
+    with app.app_context():
+        publish('lead', [1, 2, 3], 'created')
+        db.session.commit()
+    assert [c['entity_id'] for c in feed._poll()] == [1, 2, 3]
+    with app.app_context():
+        db.session.query(ChangeLog).delete()
+        db.session.commit()
+    assert feed._poll() == []
+    with app.app_context():
+        publish('lead', [4], 'created')
+        db.session.commit()
+    assert [c['id'] for c in feed._poll()] == [4]
+
+
+def test_stream_resets_clients_too_far_behind(make_app, monkeypatch):
+    app = make_app()
+    client = _login(app)
+    with app.app_context():
+        publish('lead', list(range(1, 11)), 'created')
+        db.session.commit()
+
+    response = client.get('/events/?after=2')
+    chunks = response.response
+    assert next(chunks).startswith(b'retry')
+    assert next(chunks).startswith(b'id: 3\n')
+    response.close()
+
+    with app.app_context():
+        db.session.query(ChangeLog).filter(ChangeLog.id <= 5).delete()
+        db.session.commit()
+    response = client.get('/events/?after=2')
+    chunks = response.response
+    assert next(chunks).startswith(b'retry')
+    assert next(chunks).startswith(b'event: reset')
+    response.close()
+
+    monkeypatch.setattr(routes_events, 'BACKLOG_LIMIT', 3)
+    response = client.get('/events/?after=6')
+    chunks = response.response
+    assert next(chunks).startswith(b'retry')
+    assert next(chunks).startswith(b'event: reset')
+    response.close()
@@ -0,0 +1,18 @@
+from datetime import date
+
+from models import db, Project
+
+
+def test_end_date_expr_agrees_with_end_date(make_app):
+    app = make_app()
+    with app.app_context():
+        db.session.add_all([
+            Project(project_name='no start', duration_days=30),
+            Project(project_name='no duration', start_date=date(2024, 1, 1)),
+            Project(project_name='zero duration', start_date=date(2024, 1, 1), duration_days=0),
+            Project(project_name='dated', start_date=date(2024, 1, 1), duration_days=45),
+        ])
+        db.session.commit()
+        rows = db.session.query(Project, Project.end_date_expr()).order_by(Project.id).all()
+        assert [(p.end_date.isoformat() if p.end_date else None) for p, _ in rows] == [end for _, end in rows]
+        assert rows[-1][1] == '2024-02-15'
@@ -0,0 +1,23 @@
+from datetime import date, timedelta
+
+from models import db, User, Project, OutboxMessage
+from reminders import queue_digests
+
+
+def test_project_without_duration_does_not_break_digests(make_app):
+    app = make_app()
+    today = date(2024, 3, 1)
+    with app.app_context():
+        admin = User.query.filter_by(username='admin').one()
+        admin.email = 'admin@example.com'
+        admin.reminders_enabled = True
+        db.session.add_all([
+            Project(project_name='open-ended', status='active', start_date=today - timedelta(days=10)),
+            Project(project_name='due', status='active', start_date=today - timedelta(days=10), duration_days=12),
+        ])
+        db.session.commit()
+
+        assert queue_digests(today) == 1
+        body = db.session.query(OutboxMessage.body).scalar()
+        assert 'due' in body
+        assert 'open-ended' not in body
@@ -0,0 +1,35 @@
+import os
+
+from models import db, User
+from auth import password_hasher
+from tenancy import tenant_context, tenant_engines, tenant_dir
+
+
+def _tenant(app, name):
+    with app.app_context():
+        os.makedirs(os.path.join(tenant_dir(name), 'uploads'), exist_ok=True)
+        tenant_engines.engine(name)
+        with tenant_context(name):
+            admin = User.query.filter_by(username='admin').one()
+            admin.password_hash = password_hasher.hash('secret')
+            admin.must_change_password = False
+            db.session.commit()
+
+
+def test_session_cookie_does_not_open_another_tenant(make_app):
+    app = make_app(MULTI_TENANT=True, TENANT_DOMAIN='local', SKIP_DB_BOOTSTRAP=True)
+    _tenant(app, 'a')
+    _tenant(app, 'b')
+    client = app.test_client()
+
+    response = client.post('/login', data={'username': 'admin', 'password': 'secret'}, base_url='http://a.local')
+    assert response.status_code == 302
+    assert client.get('/projects/', base_url='http://a.local').status_code == 200
+
+    # replay tenant a's session cookie against tenant b's host
+    cookie = client.get_cookie('session', domain='a.local')
+    client.set_cookie('session', cookie.value, domain='b.local')
+    response = client.get('/projects/', base_url='http://b.local')
+    assert response.status_code == 302
+    assert '/login' in response.headers['Location']
+    assert client.get('/projects/', base_url='http://b.local').status_code == 302
@@ -0,0 +1,132 @@
+import atexit
+import logging
+import os
+import threading
+import time
+
+from tenancy import current_tenant, tenant_context
+
+log = logging.getLogger(__name__)
+
+
+class BatchWriter:
+    """In-process buffer that hands queued items to ``flush_fn`` in batches.
+
+    A background thread flushes every ``interval`` seconds or as soon as
+    ``max_rows`` items are waiting, so many small writes share one
+    transaction and contend less for SQLite's single writer lock.
+    ``flush_fn(items)`` runs inside an application context, once per tenant
+    that queued items, with that tenant selected.
+
+    Items are already acknowledged when they are queued, so a batch that
+    fails (e.g. "database is locked") goes back to the front of the queue
+    and is retried on the next flush, up to ``max_attempts`` times. Items
+    given up on are logged and passed to ``on_drop(tenant, items)``.
+    """
+
+    def __init__(self, name, flush_fn, max_rows=500, interval=0.2, max_pending=50000, max_attempts=5,
+                 on_drop=None):
+        self.name = name
+        self.flush_fn = flush_fn
+        self.max_attempts = max_attempts
+        self.on_drop = on_drop
+        self.max_rows = max_rows
+        self.interval = interval
+        self.max_pending = max_pending
+        self.app = None
+        self._items = []
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        atexit.register(self.flush)
+
+    def init_app(self, app, max_rows=None, interval=None, max_pending=None):
+        self.app = app
+        if max_rows is not None:
+            self.max_rows = max_rows
+        if interval is not None:
+            self.interval = interval
+        if max_pending is not None:
+            self.max_pending = max_pending
+
+    def submit(self, items):
+        """Queue ``items``; returns False when the buffer is full."""
+        self._ensure_thread()
+        with self._cond:
+            if len(self._items) + len(items) > self.max_pending:
+                return False
+            tenant = current_tenant()
+            self._items.extend((tenant, item, 0) for item in items)
+            if len(self._items) >= self.max_rows:
+                self._cond.notify()
+        return True
+
+    def pending(self):
+        with self._cond:
+            return len(self._items)
+
+    def flush(self):
+        """Write everything queued so far, in batches of ``max_rows``.
+
+        Stops at the first failed batch, so a retry waits for the next flush.
+        """
+        if self.app is None:
+            return
+        with self._flush_lock:
+            while True:
+                with self._cond:
+                    batch = self._items[:self.max_rows]
+                    del self._items[:self.max_rows]
+                if not batch:
+                    return
+                by_tenant = {}
+                for tenant, item, attempts in batch:
+                    by_tenant.setdefault(tenant, []).append((item, attempts))
+                failed = []
+                for tenant, entries in by_tenant.items():
+                    try:
+                        with self.app.app_context(), tenant_context(tenant):
+                            self.flush_fn([item for item, _ in entries])
+                    except Exception:
+                        log.exception('%s: failed to write a batch of %d items', self.name, len(entries))
+                        failed.extend((tenant, item, attempts + 1) for item, attempts in entries)
+                if failed:
+                    self._retry_or_drop(failed)
+                    return
+
+    def _retry_or_drop(self, failed):
+        retry = [entry for entry in failed if entry[2] < self.max_attempts]
+        with self._cond:
+            self._items[:0] = retry
+        dropped = {}
+        for tenant, item, attempts in failed:
+            if attempts >= self.max_attempts:
+                dropped.setdefault(tenant, []).append(item)
+        for tenant, items in dropped.items():
+            log.error('%s: dropped %d items%s after %d attempts', self.name, len(items),
+                      f' of {tenant}' if tenant else '', self.max_attempts)
+            if self.on_drop is not None:
+                self.on_drop(tenant, items)
+
+    def _ensure_thread(self):
+        # a forked worker does not inherit the parent's thread
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name=f'{self.name}-writer', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            deadline = time.monotonic() + self.interval
+            with self._cond:
+                while len(self._items) < self.max_rows:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            self.flush()